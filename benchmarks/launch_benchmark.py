@@ -0,0 +1,229 @@
+"""Notebook launch latency benchmark.
+
+Launches and stops a number of real Notebook daemons through :class:`pyramid_notebook.notebookmanager.NotebookManager`, one after another or several at a time, and reports where the launch time goes.
+
+The daemon records when it reaches each launch phase in the ``timings`` of its context file, see :func:`pyramid_notebook.server.notebook_daemon.mark`:
+
+* ``requested`` - web server called ``start_notebook``
+
+* ``process_created`` - daemon command process was created
+
+* ``main`` - ``notebook_daemon.py`` was imported and started running
+
+* ``daemonized`` - daemon process detached from the command process
+
+* ``claimed`` - pooled daemon noticed it has been given to a user
+
+* ``notebook_created`` - default notebook file was written
+
+* ``ipython_imported`` - IPython and traitlets were imported
+
+* ``app_starting`` - Notebook configuration was done and the Notebook application is being started
+
+* ``ready`` - web server got an answer from Notebook over HTTP
+
+Pooled daemons start before they are requested, so for them the breakdown starts from ``claimed``.
+
+With ``--profile DIR`` each daemon dumps cProfile stats of its startup, up to the point the Notebook event loop runs, to ``DIR/daemon-<pid>.prof``. Look at them with::
+
+    python -m pstats DIR/daemon-1234.prof
+
+Run::
+
+    python benchmarks/launch_benchmark.py --notebooks 10 --concurrency 1 --output launch-benchmark.json
+"""
+# Standard Library
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+#: Launch phases in the order daemons go through them
+PHASES = ["requested", "process_created", "main", "daemonized", "claimed", "notebook_created", "ipython_imported", "app_starting", "ready"]
+
+
+def get_phase_durations(timings):
+    """Turn phase timestamps to seconds spent getting to each phase from the previous one.
+
+    :return: List of (phase, seconds) tuples
+    """
+    phases = [phase for phase in PHASES if phase in timings]
+
+    # Pooled daemon was started before anybody asked for it
+    if "claimed" in timings:
+        phases = ["requested"] + phases[phases.index("claimed"):]
+
+    return [(phase, timings[phase] - timings[previous]) for previous, phase in zip(phases, phases[1:])]
+
+
+def launch_and_stop(manager, name):
+    """Launch a notebook, wait until it answers, stop it.
+
+    :return: dict with phase durations, total launch time and stop time
+    """
+    context = {
+        "context_hash": 1,
+        "notebook_path": "/notebook/{}/".format(name),
+    }
+
+    started = time.monotonic()
+    context, created = manager.start_notebook_on_demand(name, context)
+    launched = time.monotonic() - started
+    assert created, "Notebook {} was already running".format(name)
+
+    started = time.monotonic()
+    manager.stop_notebook(name)
+    stopped = time.monotonic() - started
+
+    return {
+        "name": name,
+        "launch": launched,
+        "stop": stopped,
+        "phases": dict(get_phase_durations(context.get("timings", {}))),
+        "pooled": "claimed" in context.get("timings", {}),
+    }
+
+
+def wait_for_pool(pool, timeout=120):
+    """Wait until all pool slots have a daemon ready to be claimed."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        ready = [slot for slot in pool.get_slot_folders() if os.path.exists(os.path.join(slot, "ready"))]
+        if len(ready) >= pool.size:
+            return
+        time.sleep(0.1)
+    raise RuntimeError("Notebook pool did not fill up in {} seconds".format(timeout))
+
+
+def drain_pool(pool):
+    """Stop daemons left waiting in the pool."""
+    from pyramid_notebook.server import comm
+
+    # Do not let the refill thread start new ones
+    pool.size = 0
+    for slot in pool.get_slot_folders():
+        ready = comm.read_json(os.path.join(slot, "ready"))
+        if ready and ready.get("pid"):
+            try:
+                os.kill(ready["pid"], signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        pool.remove_slot(slot)
+
+
+def stop_launcher(launcher):
+    """Stop the launcher process we started."""
+    # Third Party
+    import psutil
+
+    for proc in psutil.process_iter():
+        try:
+            if launcher.socket_path in proc.cmdline():
+                proc.terminate()
+        except psutil.Error:
+            pass
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "mean_ms": sum(values) / len(values) * 1000,
+        "min_ms": values[0] * 1000,
+        "max_ms": values[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notebooks", type=int, default=5, help="Number of notebooks to launch")
+    parser.add_argument("--concurrency", type=int, default=1, help="Notebooks launched at the same time")
+    parser.add_argument("--folder", default=None, help="Notebook folder, default is a temporary folder removed afterwards")
+    parser.add_argument("--port-base", type=int, default=41000, help="First port for notebooks")
+    parser.add_argument("--launcher", action="store_true", help="Run daemon commands through the fork server launcher")
+    parser.add_argument("--pool-size", type=int, default=0, help="Prestart this many daemons and wait for them before launching")
+    parser.add_argument("--profile", default=None, help="Folder where daemons dump their startup cProfile stats")
+    parser.add_argument("--output", default="launch-benchmark.json", help="JSON file for the results")
+    args = parser.parse_args()
+
+    # Pyramid Notebook
+    from pyramid_notebook.notebookmanager import NotebookManager
+    from pyramid_notebook.pool import NotebookPool
+    from pyramid_notebook.server.launcher import LauncherClient
+    from pyramid_notebook.server.notebook_daemon import PROFILE_ENV
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+        # Inherited by the daemon commands, including the launcher we start
+        os.environ[PROFILE_ENV] = os.path.join(os.path.abspath(args.profile), "daemon-{pid}.prof")
+
+    folder = args.folder or tempfile.mkdtemp(prefix="notebook-launch-")
+    manager = NotebookManager(folder, min_port=args.port_base, port_range=args.notebooks + args.pool_size + 10, kill_timeout=600)
+
+    if args.launcher:
+        manager.launcher = LauncherClient(os.path.join(folder, "launcher.sock"), manager.python)
+
+    if args.pool_size:
+        manager.pool = NotebookPool(manager, args.pool_size)
+        manager.pool.start()
+        wait_for_pool(manager.pool)
+
+    names = ["bench{}".format(i) for i in range(args.notebooks)]
+    started = time.monotonic()
+    try:
+        if args.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                runs = list(executor.map(lambda name: launch_and_stop(manager, name), names))
+        else:
+            runs = [launch_and_stop(manager, name) for name in names]
+        elapsed = time.monotonic() - started
+    finally:
+        if manager.pool:
+            drain_pool(manager.pool)
+        if manager.launcher:
+            stop_launcher(manager.launcher)
+        if not args.folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    phases = {}
+    for phase in PHASES[1:]:
+        values = [run["phases"][phase] for run in runs if phase in run["phases"]]
+        if values:
+            phases[phase] = summarize(values)
+
+    results = {
+        "elapsed": elapsed,
+        "launch": summarize([run["launch"] for run in runs]),
+        "stop": summarize([run["stop"] for run in runs]),
+        "phases": phases,
+        "runs": runs,
+    }
+
+    report = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "results": results,
+    }
+
+    with open(args.output, "wt") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print("{:18} {:>10} {:>10} {:>10}".format("phase", "mean ms", "min ms", "max ms"))
+    for name, result in list(phases.items()) + [("launch total", results["launch"]), ("stop", results["stop"])]:
+        print("{:18} {:10.1f} {:10.1f} {:10.1f}".format(name, result["mean_ms"], result["min_ms"], result["max_ms"]))
+    print("{} notebooks in {:.1f} seconds, results written to {}".format(len(runs), elapsed, args.output), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
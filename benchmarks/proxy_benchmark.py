@@ -0,0 +1,294 @@
+"""Proxy throughput and latency benchmark suite.
+
+Runs offline against a local stand-in Tornado server playing the Notebook server:
+
+* ``api`` - small JSON API GETs through :class:`pyramid_notebook.proxy.WSGIProxyApplication`
+
+* ``download`` - large file GETs
+
+* ``upload`` - large PUTs
+
+* ``websocket`` - message round trips through :class:`pyramid_notebook.uwsgi.ProxyClient`, with a fake ``uwsgi`` module standing in for the uWSGI websocket API
+
+The WSGI application is called directly, without a WSGI server in between, so the numbers are for our proxy code plus the localhost HTTP round trip.
+
+Results go to a JSON file, so runs of different releases can be compared::
+
+    python benchmarks/proxy_benchmark.py --output results.json
+"""
+# Standard Library
+import argparse
+import asyncio
+import collections
+import datetime
+import io
+import json
+import platform
+import sys
+import threading
+import time
+
+# Third Party
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+
+# Pyramid Notebook
+from pyramid_notebook.testing import install_fake_uwsgi
+
+
+#: Path prefix of the stand-in Notebook server, as in the Notebook base_url
+BASE = "/notebook"
+
+#: Typical Notebook contents API response
+API_BODY = json.dumps({
+    "name": "default.ipynb",
+    "path": "default.ipynb",
+    "type": "notebook",
+    "writable": True,
+    "created": "2018-10-09T12:00:00.000000Z",
+    "last_modified": "2018-10-09T12:00:00.000000Z",
+    "mimetype": None,
+    "content": None,
+    "format": None,
+}).encode("utf-8")
+
+
+class APIHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(API_BODY)
+
+
+class DownloadHandler(tornado.web.RequestHandler):
+
+    def get(self, size):
+        self.set_header("Content-Type", "application/octet-stream")
+        self.write(self.application.blobs[int(size)])
+
+
+class UploadHandler(tornado.web.RequestHandler):
+
+    def put(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"size": len(self.request.body)}))
+
+
+class EchoWebSocket(tornado.websocket.WebSocketHandler):
+
+    def check_origin(self, origin):
+        return True
+
+    def on_message(self, message):
+        self.write_message(message, binary=isinstance(message, bytes))
+
+
+def start_upstream(blob_sizes):
+    """Run the stand-in Notebook server in a background thread.
+
+    :return: Port it listens on
+    """
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        app = tornado.web.Application([
+            (BASE + r"/api/contents/default.ipynb", APIHandler),
+            (BASE + r"/files/blob/(\d+)", DownloadHandler),
+            (BASE + r"/api/contents/upload", UploadHandler),
+            (BASE + r"/api/kernels/bench/channels", EchoWebSocket),
+        ], websocket_max_message_size=256 * 1024 * 1024)
+        app.blobs = {size: b"x" * size for size in blob_sizes}
+        server = tornado.httpserver.HTTPServer(app, max_body_size=1024 * 1024 * 1024)
+        server.add_sockets(sockets)
+        started.set()
+        tornado.ioloop.IOLoop.current().start()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return sockets[0].getsockname()[1]
+
+
+def make_environ(method, path, body=b""):
+    """WSGI environ of a browser request as a WSGI server would give it to us."""
+    environ = {
+        "REQUEST_METHOD": method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8008",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.version": (1, 0),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "HTTP_HOST": "localhost:8008",
+        "HTTP_CONNECTION": "keep-alive",
+        "HTTP_ACCEPT": "application/json, text/javascript, */*; q=0.01",
+        "HTTP_USER_AGENT": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36",
+        "HTTP_ACCEPT_ENCODING": "gzip, deflate, br",
+        "HTTP_COOKIE": "session=0123456789abcdef0123456789abcdef",
+    }
+    if body:
+        environ["CONTENT_LENGTH"] = str(len(body))
+        environ["CONTENT_TYPE"] = "application/octet-stream"
+    return environ
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, bytes_per_request=0):
+    latencies = sorted(latencies)
+    result = {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed if elapsed else None,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+    if bytes_per_request:
+        result["megabytes_per_second"] = bytes_per_request * len(latencies) / elapsed / (1024 * 1024)
+    return result
+
+
+def run_wsgi(app, make_request, count, concurrency):
+    """Call WSGI app count times from concurrency threads.
+
+    :param make_request: Callable returning a fresh environ
+    """
+    latencies = []
+    lock = threading.Lock()
+    statuses = collections.Counter()
+
+    def start_response(status, headers):
+        statuses[status.split(" ", 1)[0]] += 1
+
+    def worker(n):
+        own = []
+        for i in range(n):
+            environ = make_request()
+            start = time.perf_counter()
+            for chunk in app(environ, start_response):
+                pass
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    per_thread = [count // concurrency + (1 if i < count % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(n,)) for n in per_thread]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if set(statuses) != {"200"}:
+        raise RuntimeError("Unexpected response statuses: {}".format(dict(statuses)))
+    return latencies, elapsed
+
+
+def run_websocket(port, message_size, count):
+    """Measure browser -> proxy -> upstream echo -> proxy -> browser round trips."""
+    fake = install_fake_uwsgi()
+
+    # Imports uwsgi, so it must come after the shim is in place
+    from pyramid_notebook.uwsgi import ProxyClient
+
+    ws = ProxyClient("ws://127.0.0.1:{}{}/api/kernels/bench/channels".format(port, BASE), headers=[("Origin", "http://localhost:8008")])
+    ws.connect()
+    thread = threading.Thread(target=ws.run, daemon=True)
+    thread.start()
+
+    # Jupyter messages are JSON text
+    header = b'{"header": {"msg_type": "execute_request"}, "content": {"code": "'
+    message = header + b"x" * max(0, message_size - len(header) - 3) + b'"}}'
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        fake.browser_send(message)
+        reply = fake.browser_recv()
+        latencies.append(time.perf_counter() - t)
+        assert len(reply) == len(message)
+    elapsed = time.perf_counter() - start
+
+    ws.close()
+    return summarize(latencies, elapsed, len(message))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="proxy-benchmark.json", help="JSON file for the results")
+    parser.add_argument("--requests", type=int, default=2000, help="Number of small API calls and websocket messages")
+    parser.add_argument("--large-requests", type=int, default=50, help="Number of large downloads and uploads")
+    parser.add_argument("--large-size", type=int, default=8 * 1024 * 1024, help="Bytes in large downloads and uploads")
+    parser.add_argument("--large-message-size", type=int, default=1024 * 1024, help="Bytes in large websocket messages")
+    parser.add_argument("--concurrency", type=int, default=1, help="Threads calling the proxy at the same time")
+    args = parser.parse_args()
+
+    # Pyramid Notebook
+    from pyramid_notebook.proxy import WSGIProxyApplication
+    from pyramid_notebook.proxy import drop_connection_pool
+
+    port = start_upstream([args.large_size])
+    app = WSGIProxyApplication(port)
+    upload_body = b"u" * args.large_size
+
+    # Warm up connections and code paths
+    run_wsgi(app, lambda: make_environ("GET", BASE + "/api/contents/default.ipynb"), 50, args.concurrency)
+
+    results = {}
+
+    latencies, elapsed = run_wsgi(app, lambda: make_environ("GET", BASE + "/api/contents/default.ipynb"), args.requests, args.concurrency)
+    results["api"] = summarize(latencies, elapsed)
+
+    latencies, elapsed = run_wsgi(app, lambda: make_environ("GET", BASE + "/files/blob/{}".format(args.large_size)), args.large_requests, args.concurrency)
+    results["download"] = summarize(latencies, elapsed, args.large_size)
+
+    latencies, elapsed = run_wsgi(app, lambda: make_environ("PUT", BASE + "/api/contents/upload", upload_body), args.large_requests, args.concurrency)
+    results["upload"] = summarize(latencies, elapsed, args.large_size)
+
+    drop_connection_pool(port)
+
+    results["websocket"] = run_websocket(port, 1024, args.requests)
+    results["websocket_large"] = run_websocket(port, args.large_message_size, args.large_requests)
+
+    report = {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "results": results,
+    }
+
+    with open(args.output, "wt") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for name, result in results.items():
+        line = "{:16} {:8.1f} req/s  p50 {:8.2f} ms  p99 {:8.2f} ms".format(name, result["requests_per_second"], result["p50_ms"], result["p99_ms"])
+        if "megabytes_per_second" in result:
+            line += "  {:8.1f} MB/s".format(result["megabytes_per_second"])
+        print(line)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Microbenchmark of per-request overhead of WSGIProxyApplication.
+
+Upstream is a fake connection returning a canned response, so this measures only our own request and response translation, not the network or the Notebook server.
+
+Run::
+
+    python benchmarks/proxy_overhead.py
+"""
+# Standard Library
+import argparse
+import io
+import socket
+import timeit
+
+# Pyramid Notebook
+from pyramid_notebook.proxy import WSGIProxyApplication
+from pyramid_notebook.proxy import drop_connection_pool
+
+
+#: Socket which never becomes readable, so pooled fake connections look alive
+_idle_sock, _ = socket.socketpair()
+
+
+class FakeResponse:
+
+    status = 200
+    reason = "OK"
+
+    def __init__(self, body):
+        self.body = io.BytesIO(body)
+        self.length = len(body)
+        self.headers = [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("Server", "TornadoServer/5.1.1"),
+            ("Date", "Mon, 01 Jan 2018 00:00:00 GMT"),
+            ("Etag", '"abcdef"'),
+            ("X-Content-Type-Options", "nosniff"),
+            ("Content-Security-Policy", "frame-ancestors 'self'; report-uri /notebook/api/security/csp-report"),
+        ]
+
+    def getheaders(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        for key, value in self.headers:
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def read(self, amt=None):
+        return self.body.read(amt)
+
+    def readinto(self, b):
+        return self.body.readinto(b)
+
+
+class FakeConnection:
+
+    body = b'{"name": "default.ipynb", "type": "notebook"}'
+
+    def __init__(self, host):
+        self.sock = _idle_sock
+
+    def request(self, method, url, body=None, headers={}, **kwargs):
+        pass
+
+    def getresponse(self):
+        return FakeResponse(self.body)
+
+    def close(self):
+        pass
+
+
+class FakeProxyApplication(WSGIProxyApplication):
+    connection_class = FakeConnection
+
+
+def make_environ():
+    """Environ of a typical Notebook API call as a browser sends it through uWSGI."""
+    return {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": "/notebook/api/contents/default.ipynb",
+        "QUERY_STRING": "type=notebook&_=1514764800000",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8008",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(b""),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.version": (1, 0),
+        "wsgi.multithread": False,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "uwsgi.version": b"2.0.17",
+        "uwsgi.node": b"localhost",
+        "HTTP_HOST": "localhost:8008",
+        "HTTP_CONNECTION": "keep-alive",
+        "HTTP_ACCEPT": "application/json, text/javascript, */*; q=0.01",
+        "HTTP_X_REQUESTED_WITH": "XMLHttpRequest",
+        "HTTP_USER_AGENT": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36",
+        "HTTP_REFERER": "http://localhost:8008/notebook/notebooks/default.ipynb",
+        "HTTP_ACCEPT_ENCODING": "gzip, deflate, br",
+        "HTTP_ACCEPT_LANGUAGE": "en-US,en;q=0.9",
+        "HTTP_COOKIE": "session=0123456789abcdef0123456789abcdef; _xsrf=2|abcdef|0123456789|1514764800",
+    }
+
+
+def start_response(status, headers):
+    pass
+
+
+def run(app, n):
+    for i in range(n):
+        environ = make_environ()
+        for chunk in app(environ, start_response):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = FakeProxyApplication(1)
+    try:
+        # Best of several runs filters out noise from other processes
+        best = min(timeit.repeat(lambda: run(app, args.requests), number=1, repeat=args.repeat))
+    finally:
+        drop_connection_pool(1)
+
+    print("{:.2f} us per proxied request ({} requests, best of {})".format(best / args.requests * 1e6, args.requests, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
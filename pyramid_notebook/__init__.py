@@ -1,5 +1,52 @@
 """Pyramid Notebook."""
+# Standard Library
+import os
 
 
 def includeme(config):
-    pass
+    """Set up a shared :py:class:`pyramid_notebook.notebookmanager.NotebookManager` from ``pyramid_notebook.*`` settings.
+
+    The manager is available as ``registry.notebook_manager``.
+    """
+    # Imported here, so that the daemon process importing our package does not pay for these
+    from pyramid.settings import asbool
+
+    from pyramid_notebook.culler import IdleCuller
+    from pyramid_notebook.metrics import MetricsStore
+    from pyramid_notebook.metrics import set_metrics_store
+    from pyramid_notebook.notebookmanager import NotebookManager
+    from pyramid_notebook.pool import NotebookPool
+    from pyramid_notebook.server.launcher import LauncherClient
+    from pyramid_notebook.utils import run_after_fork
+
+    settings = config.registry.settings
+    manager = NotebookManager.from_settings(settings)
+
+    launcher_socket = settings.get("pyramid_notebook.launcher_socket", "").strip()
+    if launcher_socket:
+        manager.launcher = LauncherClient(launcher_socket, manager.python)
+
+    pool_size = int(settings.get("pyramid_notebook.pool_size", 0))
+    if pool_size:
+        manager.pool = NotebookPool(manager, pool_size, refill_interval=float(settings.get("pyramid_notebook.pool_refill_interval", 5)))
+        # includeme runs in the uWSGI master, so start refilling in the workers to have the pool warm before the first claim
+        run_after_fork(manager.pool.start)
+
+    idle_timeout = float(settings.get("pyramid_notebook.idle_timeout", 0))
+    if idle_timeout:
+        manager.culler = IdleCuller(manager, idle_timeout, interval=float(settings.get("pyramid_notebook.cull_interval", 60)))
+        run_after_fork(manager.culler.start)
+
+    config.registry.notebook_manager = manager
+
+    if asbool(settings.get("pyramid_notebook.metrics", False)):
+        store = MetricsStore(os.path.join(manager.notebook_folder, ".metrics"), interval=float(settings.get("pyramid_notebook.metrics_interval", 5)))
+        # includeme runs in the uWSGI master, so the dump thread is started in each worker on its first recording
+        set_metrics_store(store)
+        config.registry.notebook_metrics_store = store
+
+    metrics_path = settings.get("pyramid_notebook.metrics_path", "").strip()
+    if metrics_path:
+        config.add_route("notebook_metrics", metrics_path)
+        permission = settings.get("pyramid_notebook.metrics_permission", "").strip() or "notebook_metrics"
+        config.add_view("pyramid_notebook.views.notebook_metrics", route_name="notebook_metrics", permission=permission)
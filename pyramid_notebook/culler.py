@@ -0,0 +1,96 @@
+"""Stop Notebook daemons nobody has used for a while.
+
+The web server records user activity by touching an ``activity`` file in the notebook work folder whenever it proxies an HTTP request or a websocket frame, see :py:meth:`pyramid_notebook.notebookmanager.NotebookManager.touch_activity`. The culler periodically stops notebooks whose activity file is older than the idle timeout. Stopping the daemon makes Notebook shut down its kernels.
+
+This is independent of ``kill_timeout``, which still kills a daemon after a fixed time however active its user is.
+"""
+# Standard Library
+import fcntl
+import logging
+import os
+import threading
+
+# Pyramid Notebook
+from pyramid_notebook import metrics
+from pyramid_notebook.server import comm
+from pyramid_notebook.utils import ProcessThread
+
+
+logger = logging.getLogger(__name__)
+
+
+class IdleCuller:
+    """Periodically stop idle notebooks.
+
+    Each web server process can have its own :py:class:`IdleCuller` object pointing to the same notebook folder. Only one of them culls at a time.
+    """
+
+    def __init__(self, manager, idle_timeout, interval=60.0):
+        """
+        :param manager: :py:class:`pyramid_notebook.notebookmanager.NotebookManager` whose notebooks we stop
+
+        :param idle_timeout: Seconds without proxied requests or websocket frames after a notebook is stopped
+
+        :param interval: Seconds between checks for idle notebooks
+        """
+        self.manager = manager
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+
+        self.wakeup = threading.Event()
+        self.thread = ProcessThread(self.run, "notebook-culler")
+
+    def get_names(self):
+        """List names of notebooks which have a work folder."""
+        return self.manager.get_notebook_names()
+
+    def is_idle(self, name):
+        """Check if a named notebook is running and has not been used within the idle timeout."""
+        context = self.manager.get_context(name)
+        if not context or not context.get("pid") or not comm.check_pid(context["pid"]):
+            return False
+
+        idle_time = self.manager.get_idle_time(name)
+        return idle_time is not None and idle_time > self.idle_timeout
+
+    def cull(self):
+        """Stop all idle notebooks.
+
+        :return: List of names of stopped notebooks
+        """
+        stopped = []
+
+        # Several web server processes may cull at the same time
+        with open(os.path.join(self.manager.notebook_folder, "cull.lock"), "wt") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            for name in self.get_names():
+                if not self.is_idle(name):
+                    continue
+
+                # Do not stop a notebook somebody is launching right now
+                with self.manager.lock_notebook(name):
+                    if not self.is_idle(name):
+                        continue
+
+                    logger.info("Stopping notebook %s, idle for %d seconds", name, self.manager.get_idle_time(name))
+                    self.manager.stop_notebook(name)
+                    metrics.inc("pyramid_notebook_culled_total")
+                    stopped.append(name)
+
+        return stopped
+
+    def run(self):
+        """Background cull loop."""
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+            try:
+                self.cull()
+            except Exception as e:
+                logger.exception(e)
+
+    def start(self):
+        """Start background culling in this process, if not running yet."""
+        self.thread.start()
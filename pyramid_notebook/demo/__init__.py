@@ -28,11 +28,14 @@ def main(global_config, **settings):
     config.add_jinja2_renderer('.html')
     config.add_jinja2_search_path('pyramid_notebook:demo/templates', name='.html')
 
+    config.include('pyramid_notebook')
+
     config.add_route('home', '/')
     config.add_route('login', '/login')
     config.add_route('shell1', '/shell1')
     config.add_route('shell2', '/shell2')
     config.add_route('shutdown_notebook', '/notebook/shutdown')
+    config.add_route('notebook_status', '/notebook/status')
     config.add_route('notebook_proxy', '/notebook/*remainder')
 
     config.scan(views)
@@ -11,6 +11,7 @@ from pyramid.view import view_config
 from pyramid_notebook import startup
 from pyramid_notebook.views import launch_notebook
 from pyramid_notebook.views import notebook_proxy as _notebook_proxy
+from pyramid_notebook.views import notebook_status as _notebook_status
 from pyramid_notebook.views import shutdown_notebook as _shutdown_notebook
 
 
@@ -98,6 +99,19 @@ def shutdown_notebook(request):
     return HTTPFound(request.route_url("home"))
 
 
+@view_config(route_name="notebook_status")
+def notebook_status(request):
+    # Make sure we have a logged in user
+    auth = request.registry.queryUtility(IAuthenticationPolicy)
+    username = auth.authenticated_userid(request)
+
+    if not username:
+        # This will trigger HTTP Basic Auth dialog, as per basic_challenge handler below
+        raise httpexceptions.HTTPForbidden("You need to be logged in. Hint: user / password")
+
+    return _notebook_status(request, username)
+
+
 @forbidden_view_config()
 def basic_challenge(request):
     response = HTTPUnauthorized()
@@ -0,0 +1,339 @@
+"""Counters, histograms and gauges for the proxy, websockets and the daemon lifecycle.
+
+Instrumented code records into the process-wide :py:data:`metrics` registry with :py:func:`inc`, :py:func:`observe` and :py:func:`add`. Recording is an in-memory dict update, so it is cheap enough for every proxied request and websocket frame.
+
+uWSGI runs several worker processes and each has its own registry. When a :py:class:`MetricsStore` is set up, see ``pyramid_notebook.metrics`` setting, every process which records metrics periodically dumps its registry to its own JSON file in a shared folder. The metrics view reads all the files and sums them up:
+
+* Counters and histograms of workers which have exited are folded into an archive file, so totals do not go backwards when uWSGI recycles workers
+
+* Gauges, like open websocket connections, only count live processes
+
+The view renders Prometheus text exposition format, see :py:func:`render_prometheus`.
+"""
+# Standard Library
+import fcntl
+import logging
+import os
+import threading
+import time
+import uuid
+
+# Pyramid Notebook
+from pyramid_notebook.server import comm
+from pyramid_notebook.utils import ProcessThread
+
+
+logger = logging.getLogger(__name__)
+
+
+#: Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#: Name -> (type, help) of every metric we record
+METRICS = {
+    "pyramid_notebook_proxy_requests_total": ("counter", "Requests proxied to Notebook servers by route and status"),
+    "pyramid_notebook_proxy_response_seconds": ("histogram", "Time until Notebook server response headers by route"),
+    "pyramid_notebook_proxy_errors_total": ("counter", "Requests which could not be proxied by route"),
+    "pyramid_notebook_proxy_cache_hits_total": ("counter", "Requests answered from the shared response cache"),
+    "pyramid_notebook_static_requests_total": ("counter", "Notebook static files served without proxying"),
+    "pyramid_notebook_websocket_connections": ("gauge", "Open proxied websocket connections"),
+    "pyramid_notebook_websocket_frames_total": ("counter", "Websocket messages proxied upstream to Notebook servers and downstream to browsers"),
+    "pyramid_notebook_websocket_bytes_total": ("counter", "Websocket payload bytes proxied by direction"),
+    "pyramid_notebook_launches_total": ("counter", "Notebook launches by result"),
+    "pyramid_notebook_launch_seconds": ("histogram", "Time from launch request until Notebook answers"),
+    "pyramid_notebook_pool_claims_total": ("counter", "Launches by whether a prestarted daemon was available"),
+    "pyramid_notebook_stops_total": ("counter", "Notebook stops"),
+    "pyramid_notebook_stop_seconds": ("histogram", "Time to stop a Notebook daemon"),
+    "pyramid_notebook_culled_total": ("counter", "Notebooks stopped for being idle"),
+    "pyramid_notebook_running_notebooks": ("gauge", "Notebook daemons running"),
+}
+
+#: First URL path segment after the notebook prefix -> route label. Anything else is ``other``, to keep the number of label values bounded.
+ROUTES = {"api", "static", "notebooks", "tree", "files", "edit", "view", "nbextensions", "kernelspecs", "custom", "login", "logout", "terminals"}
+
+
+def get_route_label(parts):
+    """Label proxied requests by Notebook URL space.
+
+    :param parts: URL path segments after the notebook prefix
+    """
+    if parts and parts[0] in ROUTES:
+        return parts[0]
+    return "other"
+
+
+def get_key(name, labels):
+    """Series key: metric name with sorted labels."""
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """In-memory metrics of one process. Thread safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+
+        #: key -> [bucket counts..., +Inf count, sum]
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        """Move a gauge up or down."""
+        key = get_key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a histogram sample."""
+        key = get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(BUCKETS)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        """Get JSON serializable copy of everything recorded."""
+        with self.lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "gauges": [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                "histograms": [[name, labels, list(value)] for (name, labels), value in self.histograms.items()],
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+#: Registry of this process
+metrics = Metrics()
+
+#: Optional :py:class:`MetricsStore` dumping :py:data:`metrics`, see :py:func:`set_metrics_store`
+store = None
+
+
+def set_metrics_store(metrics_store):
+    """Dump the registry of each process recording metrics through a store.
+
+    The dump thread is started lazily by the first recording in each process, so this can be called before the web server forks its workers.
+    """
+    global store
+    store = metrics_store
+
+
+def ensure_store_started():
+    """Start the dump thread of this process, if not running yet. Cheap enough for every recording."""
+    if store is not None and not store.thread.is_running():
+        store.start()
+
+
+def inc(name, value=1, **labels):
+    ensure_store_started()
+    metrics.inc(name, value, **labels)
+
+
+def add(name, value, **labels):
+    ensure_store_started()
+    metrics.add(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    ensure_store_started()
+    metrics.observe(name, value, **labels)
+
+
+def merge(total, snapshot, gauges=True):
+    """Add up a snapshot into totals.
+
+    :param total: dict key -> value, as in :py:class:`Metrics` attributes, keyed by ``counters``, ``gauges`` and ``histograms``
+    """
+    for name, labels, value in snapshot.get("counters", []):
+        key = name, tuple(tuple(label) for label in labels)
+        total["counters"][key] = total["counters"].get(key, 0) + value
+
+    if gauges:
+        for name, labels, value in snapshot.get("gauges", []):
+            key = name, tuple(tuple(label) for label in labels)
+            total["gauges"][key] = total["gauges"].get(key, 0) + value
+
+    for name, labels, value in snapshot.get("histograms", []):
+        key = name, tuple(tuple(label) for label in labels)
+        histogram = total["histograms"].get(key)
+        if histogram is None:
+            total["histograms"][key] = list(value)
+        else:
+            for i, v in enumerate(value):
+                histogram[i] += v
+
+
+def to_snapshot(total):
+    """Turn merged totals back to snapshot format."""
+    return {
+        "counters": [[name, labels, value] for (name, labels), value in total["counters"].items()],
+        "gauges": [],
+        "histograms": [[name, labels, value] for (name, labels), value in total["histograms"].items()],
+    }
+
+
+class MetricsStore:
+    """Share metrics of all web server processes through JSON files in a folder.
+
+    Each process writes its own file, named after its pid and a random token, so a recycled pid never overwrites the file of a dead process.
+    """
+
+    def __init__(self, folder, registry=metrics, interval=5.0):
+        """
+        :param folder: Folder shared by all web server processes
+
+        :param registry: :py:class:`Metrics` we dump
+
+        :param interval: Seconds between dumps
+        """
+        self.folder = folder
+        self.registry = registry
+        self.interval = interval
+        os.makedirs(folder, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.thread = ProcessThread(self.run, "notebook-metrics")
+        self.token = None
+        self.token_pid = None
+
+        #: Process whose recordings the registry holds
+        self.registry_pid = os.getpid()
+
+    def get_file(self):
+        """File of the current process."""
+        with self.lock:
+            if self.token_pid != os.getpid():
+                self.token = uuid.uuid4().hex
+                self.token_pid = os.getpid()
+            return os.path.join(self.folder, "{}-{}.json".format(self.token_pid, self.token))
+
+    def flush(self):
+        """Dump the registry of this process to its file."""
+        data = self.registry.snapshot()
+        data["pid"] = os.getpid()
+        comm.write_json(self.get_file(), data)
+
+    def collect(self):
+        """Add up metrics of all processes.
+
+        :return: Totals, see :py:func:`merge`
+        """
+        self.start()
+        self.flush()
+
+        total = {"counters": {}, "gauges": {}, "histograms": {}}
+        archive_file = os.path.join(self.folder, "archive.json")
+
+        with open(os.path.join(self.folder, "archive.lock"), "wt") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            archive = {"counters": {}, "gauges": {}, "histograms": {}}
+            merge(archive, comm.read_json(archive_file) or {}, gauges=False)
+
+            dead = []
+            for name in sorted(os.listdir(self.folder)):
+                if not name.endswith(".json") or name == "archive.json":
+                    continue
+
+                fname = os.path.join(self.folder, name)
+                data = comm.read_json(fname)
+                if not data:
+                    continue
+
+                if comm.check_pid(data["pid"]):
+                    merge(total, data)
+                else:
+                    merge(archive, data, gauges=False)
+                    dead.append(fname)
+
+            if dead:
+                # Keep totals of exited workers in the archive
+                comm.write_json(archive_file, to_snapshot(archive))
+                for fname in dead:
+                    os.remove(fname)
+                logger.info("Archived metrics of %d exited web server processes", len(dead))
+
+        merge(total, to_snapshot(archive), gauges=False)
+        return total
+
+    def run(self):
+        """Background dump loop."""
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def start(self):
+        """Start dumping in the background in this process, if not running yet."""
+        with self.lock:
+            # Forked worker inherited the registry of the parent, do not count it twice
+            if self.registry_pid != os.getpid():
+                self.registry.reset()
+                self.registry_pid = os.getpid()
+
+        self.thread.start()
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    escaped = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def render_prometheus(total):
+    """Render merged metrics in Prometheus text exposition format.
+
+    :param total: Totals from :py:meth:`MetricsStore.collect` or :py:func:`merge`
+    """
+    series = {}
+    for kind in ("counters", "gauges", "histograms"):
+        for (name, labels), value in total[kind].items():
+            series.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(series):
+        metric_type, help = METRICS.get(name, ("untyped", name))
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+
+        for labels, value in sorted(series[name]):
+            if metric_type == "histogram":
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", bound)]), cumulative))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(value[-1])))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+            else:
+                lines.append("{}{} {}".format(name, format_labels(labels), format_value(value)))
+
+    return "\n".join(lines) + "\n"
@@ -1,13 +1,22 @@
 # Standard Library
+import fcntl
+import http.client
 import logging
 import os
+import signal
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # Third Party
-import port_for
+import psutil
 
+from pyramid_notebook import metrics
+from pyramid_notebook.ports import PortAllocator
+from pyramid_notebook.proxy import drop_connection_pool
 from pyramid_notebook.server import comm
 
 
@@ -23,14 +32,64 @@ class NotebookManager:
     * Pass extra parameters to IPython Nobetook
     """
 
-    def __init__(self, notebook_folder, min_port=40000, port_range=10, kill_timeout=50, python=None):
+    #: Seconds between readiness polls start from this and back off exponentially
+    min_poll_interval = 0.02
+
+    #: Upper limit for readiness poll interval
+    max_poll_interval = 0.5
+
+    #: Seconds between activity file updates from one process, see touch_activity()
+    activity_interval = 10.0
+
+    #: Stop daemons by signalling them from this process instead of running ``notebook_daemon.py stop``. Turn off if daemons run as another user.
+    direct_control = True
+
+    def __init__(self, notebook_folder, min_port=40000, port_range=10, kill_timeout=50, python=None, pool=None, startup_timeout=30, stop_timeout=15, culler=None, launcher=None, stats_interval=30.0, memory_limit=None, cpu_limit=None):
         """
         :param notebook_folder: A folder containing a subfolder for each named IPython Notebook. The subfolder contains pid file, log file, default.ipynb and profile files.
+
+        :param pool: Optional :py:class:`pyramid_notebook.pool.NotebookPool` of prestarted daemons we claim instead of starting new ones
+
+        :param startup_timeout: Minimum seconds we wait for a launched Notebook to answer HTTP. The actual timeout grows if we have seen slow launches.
+
+        :param stop_timeout: Seconds we wait for a stopped Notebook process to exit
+
+        :param culler: Optional :py:class:`pyramid_notebook.culler.IdleCuller` stopping notebooks nobody uses
+
+        :param launcher: Optional :py:class:`pyramid_notebook.server.launcher.LauncherClient` running daemon commands in a fork server instead of a new Python interpreter
+
+        :param stats_interval: Seconds between samples of the resource usage of each notebook and its kernels, see :py:meth:`get_stats`. 0 disables sampling.
+
+        :param memory_limit: Optional address space limit in bytes for the Notebook server and each of its kernels
+
+        :param cpu_limit: Optional CPU time limit in seconds for the Notebook server and each of its kernels, over the whole life of each process
         """
         self.min_port = min_port
         self.port_range = port_range
         self.notebook_folder = notebook_folder
         self.kill_timeout = kill_timeout
+        self.pool = pool
+        self.startup_timeout = startup_timeout
+        self.stop_timeout = stop_timeout
+        self.culler = culler
+        self.launcher = launcher
+        self.stats_interval = stats_interval
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+
+        #: Moving average of seconds it has taken for launched notebooks to become ready
+        self.average_startup_time = None
+
+        #: Work folders we know exist
+        self.work_folders = set()
+
+        #: Background launches by name, see start_notebook_in_background()
+        self.launches = {}
+        self.launches_lock = threading.Lock()
+        self.launch_executor = None
+
+        #: Name -> monotonic time we last touched the activity file, see touch_activity()
+        self.activity_touched = {}
 
         if python:
             self.python = python
@@ -41,6 +100,33 @@ class NotebookManager:
 
         self.cmd = self.get_manager_cmd()
 
+        self.ports = PortAllocator(os.path.join(notebook_folder, "ports.sqlite"), min_port, port_range)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Create a manager configured by ``pyramid_notebook.*`` settings.
+
+        :raise RuntimeError: If a required setting is missing
+        """
+        notebook_folder = settings.get("pyramid_notebook.notebook_folder", None)
+        if not notebook_folder:
+            raise RuntimeError("Setting missing: pyramid_notebook.notebook_folder")
+
+        kill_timeout = settings.get("pyramid_notebook.kill_timeout", None)
+        if not kill_timeout:
+            raise RuntimeError("Setting missing: pyramid_notebook.kill_timeout")
+
+        return cls(
+            notebook_folder,
+            min_port=int(settings.get("pyramid_notebook.port_base", 40000)),
+            port_range=int(settings.get("pyramid_notebook.port_range", 10)),
+            kill_timeout=int(kill_timeout),
+            startup_timeout=float(settings.get("pyramid_notebook.startup_timeout", 30)),
+            stats_interval=float(settings.get("pyramid_notebook.stats_interval", 30)),
+            memory_limit=int(settings.get("pyramid_notebook.memory_limit", 0)) or None,
+            cpu_limit=int(settings.get("pyramid_notebook.cpu_limit", 0)) or None,
+        )
+
     def discover_python(self):
         """Get the Python interpreter we need to use to run our Notebook daemon."""
         python = sys.executable
@@ -53,7 +139,9 @@ class NotebookManager:
 
     def get_work_folder(self, name):
         work_folder = os.path.join(self.notebook_folder, name)
-        os.makedirs(work_folder, exist_ok=True)
+        if work_folder not in self.work_folders:
+            os.makedirs(work_folder, exist_ok=True)
+            self.work_folders.add(work_folder)
         return work_folder
 
     def get_log_file(self, name):
@@ -68,16 +156,138 @@ class NotebookManager:
     def get_context(self, name):
         return comm.get_context(self.get_pid(name))
 
+    @contextmanager
+    def lock_notebook(self, name):
+        """Hold an exclusive lock on a named notebook.
+
+        The lock is a file lock in the work folder, so it serializes threads of this process and all other web server processes.
+        """
+        lock_file = os.path.join(self.get_work_folder(name), "launch.lock")
+        with open(lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_activity_file(self, name):
+        """File whose modification time tells when the user of a notebook was last seen."""
+        return os.path.join(self.get_work_folder(name), "activity")
+
+    def touch_activity(self, name, force=False):
+        """Record that a user is using their notebook.
+
+        Called for every proxied request and websocket frame, so the activity file is touched at most once per ``activity_interval`` seconds per process.
+
+        :param force: Touch the file even if we have just done so
+        """
+        now = time.monotonic()
+        last = self.activity_touched.get(name)
+        if not force and last is not None and now - last < self.activity_interval:
+            return
+
+        self.activity_touched[name] = now
+        activity_file = self.get_activity_file(name)
+        try:
+            os.utime(activity_file)
+        except FileNotFoundError:
+            open(activity_file, "a").close()
+
+        if self.culler:
+            self.culler.start()
+
+    def get_idle_time(self, name):
+        """Get seconds since a notebook was last used.
+
+        Notebooks which have never been used count as idle from the time they were started.
+
+        :return: Seconds or None if there is no notebook
+        """
+        for fname in (self.get_activity_file(name), comm.get_context_file_name(self.get_pid(name))):
+            try:
+                return time.time() - os.stat(fname).st_mtime
+            except FileNotFoundError:
+                continue
+        return None
+
+    def get_notebook_names(self):
+        """List names of notebooks which have a work folder."""
+        try:
+            names = os.listdir(self.notebook_folder)
+        except FileNotFoundError:
+            return []
+
+        # Skip .pool, .metrics and such
+        return [name for name in sorted(names) if not name.startswith(".") and os.path.isdir(os.path.join(self.notebook_folder, name))]
+
+    def get_stats_file(self, name):
+        """File where the daemon writes resource usage of its process tree."""
+        return os.path.join(self.get_work_folder(name), "stats.json")
+
+    def get_stats(self, name):
+        """Get the latest resource usage sample of a notebook and its kernels.
+
+        :return: dict with ``rss`` bytes, ``cpu_percent``, ``cpu_time`` seconds, ``num_fds``, ``processes`` and ``sampled_at`` or None if there are no stats
+        """
+        return comm.read_json(self.get_stats_file(name))
+
+    def get_heaviest_notebooks(self, key="rss", limit=10):
+        """List running notebooks using most resources.
+
+        :param key: Stat to sort by, see :py:meth:`get_stats`
+
+        :return: List of (name, stats) tuples, heaviest first
+        """
+        heaviest = []
+        for name in self.get_notebook_names():
+            context = self.get_context(name)
+            if not context or not context.get("pid") or not comm.check_pid(context["pid"]):
+                continue
+
+            stats = self.get_stats(name)
+            if stats and key in stats:
+                heaviest.append((name, stats))
+
+        heaviest.sort(key=lambda item: item[1][key], reverse=True)
+        return heaviest[:limit]
+
+    def stop_heaviest(self, count=1, key="rss"):
+        """Stop notebooks using most resources.
+
+        :return: List of names of stopped notebooks
+        """
+        stopped = []
+        for name, stats in self.get_heaviest_notebooks(key, count):
+            with self.lock_notebook(name):
+                logger.info("Stopping notebook %s, using %s %s", name, key, stats[key])
+                self.stop_notebook(name)
+                stopped.append(name)
+        return stopped
+
+    def get_launch_error_file(self, name):
+        """File where a failed background launch leaves its error message for other processes to see."""
+        return os.path.join(self.get_work_folder(name), "launch.error")
+
+    def get_launch_error(self, name):
+        """Get error message of the last failed background launch.
+
+        :return: Error message string or None
+        """
+        try:
+            with open(self.get_launch_error_file(name), "rt") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
     def get_manager_cmd(self):
         """Get our daemon script path."""
         cmd = os.path.abspath(os.path.join(os.path.dirname(__file__), "server", "notebook_daemon.py"))
         assert os.path.exists(cmd)
         return cmd
 
-    def pick_port(self):
-        """Pick open TCP/IP port."""
-        ports = set(range(self.min_port, self.min_port + self.port_range))
-        return port_for.select_random(ports)
+    def pick_port(self, name):
+        """Pick open TCP/IP port and lease it to a named notebook."""
+        return self.ports.acquire(name)
 
     def get_notebook_daemon_command(self, name, action, port=0, *extra):
         """
@@ -89,6 +299,10 @@ class NotebookManager:
     def exec_notebook_daemon_command(self, name, cmd, port=0):
         """Run a daemon script command."""
         cmd = self.get_notebook_daemon_command(name, cmd, port)
+        return self.run_daemon_command(cmd)
+
+    def run_daemon_command(self, cmd):
+        """Run notebook_daemon.py with a fully built argument list."""
 
         # Make all arguments explicit strings
         cmd = [str(arg) for arg in cmd]
@@ -100,18 +314,22 @@ class NotebookManager:
         env = os.environ.copy()
         env["PYTHONFAULTHANDLER"] = "true"
 
-        p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
-        time.sleep(0.2)
-        stdout, stderr = p.communicate()
+        # Foreground notebook would tie up the launcher handler for its whole life
+        if self.launcher and cmd[2] != "fg":
+            returncode, stdout, stderr = self.launcher.run(cmd[1:], env)
+        else:
+            p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+            stdout, stderr = p.communicate()
+            returncode = p.returncode
 
         if b"already running" in stderr:
             raise RuntimeError("Looks like notebook_daemon is already running. Please kill it manually pkill -f notebook_daemon. Was: {}".format(stderr.decode("utf-8")))
 
-        if p.returncode != 0:
+        if returncode != 0:
             logger.error("STDOUT: %s", stdout)
             logger.error("STDERR: %s", stderr)
 
-            raise RuntimeError("Could not execute notebook command. Exit code: {} cmd: {}".format(p.returncode, " ".join(cmd)))
+            raise RuntimeError("Could not execute notebook command. Exit code: {} cmd: {}".format(returncode, " ".join(cmd)))
 
         return stdout
 
@@ -137,11 +355,44 @@ class NotebookManager:
         assert "context_hash" in context
         assert type(context["context_hash"]) == int
 
-        http_port = self.pick_port()
+        requested = time.time()
+        pid = self.get_pid(name)
+        assert "terminated" not in context
+
+        # Daemon killed with SIGKILL leaves its pid file behind, which wait_for_notebook() would take for the new daemon having died
+        old_pid = self.read_pid_file(name)
+        if old_pid and not comm.check_pid(old_pid):
+            try:
+                os.remove(pid)
+            except FileNotFoundError:
+                pass
+
+        # Try to get a prestarted daemon from the pool first
+        slot = None
+        if self.pool and not fg:
+            slot = self.pool.claim()
+            metrics.inc("pyramid_notebook_pool_claims_total", result="hit" if slot else "miss")
+
+        if slot:
+            http_port = slot["http_port"]
+            self.ports.transfer(http_port, name)
+        else:
+            http_port = self.pick_port(name)
+
         assert http_port
         context = context.copy()
         context["http_port"] = http_port
 
+        # Daemon adds its own launch phases, see notebook_daemon.mark()
+        context["timings"] = {"requested": requested}
+
+        # Resource accounting and limits applied by the daemon
+        context["stats_interval"] = self.stats_interval
+        if self.memory_limit:
+            context["memory_limit"] = self.memory_limit
+        if self.cpu_limit:
+            context["cpu_limit"] = self.cpu_limit
+
         # We can't proxy websocket URLs, so let them go directly through localhost or have front end server to do proxying (nginx)
         if "websocket_url" not in context:
             context["websocket_url"] = "ws://localhost:{port}".format(port=http_port)
@@ -150,18 +401,251 @@ class NotebookManager:
             # Do port substitution for the websocket URL
             context["websocket_url"] = context["websocket_url"].format(port=http_port)
 
-        pid = self.get_pid(name)
-        assert "terminated" not in context
-
         comm.set_context(pid, context)
 
-        if fg:
+        # Give the new notebook the full idle timeout
+        self.touch_activity(name, force=True)
+
+        if slot:
+            self.pool.bind(slot, pid, self.get_work_folder(name))
+        elif fg:
             self.exec_notebook_daemon_command(name, "fg", port=http_port)
         else:
             self.exec_notebook_daemon_command(name, "start", port=http_port)
 
     def stop_notebook(self, name):
-        self.exec_notebook_daemon_command(name, "stop")
+        started = time.monotonic()
+        context = self.get_context(name)
+
+        if self.direct_control:
+            if not self.terminate_daemons([name]):
+                logger.warning("Notebook %s is not running", name)
+        else:
+            self.exec_notebook_daemon_command(name, "stop")
+
+            # Make sure we don't get race condition over context.json file
+            if context and context.get("pid"):
+                if not self.wait_for_exit(context["pid"], self.stop_timeout):
+                    logger.warning("Notebook process %d for %s did not exit in %s seconds", context["pid"], name, self.stop_timeout)
+
+        self.forget_notebook(name, context)
+
+        metrics.inc("pyramid_notebook_stops_total")
+        metrics.observe("pyramid_notebook_stop_seconds", time.monotonic() - started)
+
+    def forget_notebook(self, name, context):
+        """Release what a stopped notebook held.
+
+        :param context: Context of the notebook before it was stopped, or None
+        """
+        # Do not trust cached liveness of the old process
+        comm.forget_context(self.get_pid(name))
+
+        self.ports.release(name)
+
+        # Kept alive proxy connections point to a dead server now
+        if context and context.get("http_port"):
+            drop_connection_pool(context["http_port"])
+
+    def read_pid_file(self, name):
+        """Get the pid of a running daemon from its pid file.
+
+        :return: pid or None if the daemon has removed its pid file on exit
+        """
+        try:
+            with open(self.get_pid(name), "rt") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def list_notebooks(self):
+        """Get contexts of all notebooks in one scan of the notebook folder.
+
+        Unlike :py:meth:`get_notebook_status`, dead notebooks are included.
+
+        :return: dict name -> context, with ``running`` telling if the daemon process is alive
+        """
+        notebooks = {}
+        for name in self.get_notebook_names():
+            context = comm.get_context(self.get_pid(name), daemon=True)
+            if not context:
+                continue
+            pid = context.get("pid")
+            context["running"] = bool(pid) and comm.check_pid(pid)
+            notebooks[name] = context
+        return notebooks
+
+    def terminate_daemons(self, names):
+        """Stop notebook daemons by signalling them directly.
+
+        Same as ``notebook_daemon.py stop``: send SIGTERM, wait ``stop_timeout`` seconds and SIGKILL the daemons which are still around, as Notebook sometimes hangs on exit. All daemons are signalled and waited for together.
+
+        :return: List of names of notebooks which were running
+
+        :raise RuntimeError: If we are not allowed to signal a daemon
+        """
+        procs = {}
+        for name in names:
+            pid = self.read_pid_file(name)
+            if not pid:
+                continue
+
+            try:
+                proc = psutil.Process(pid)
+                proc.send_signal(signal.SIGTERM)
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.AccessDenied as e:
+                raise RuntimeError("Not allowed to stop notebook {} process {}".format(name, pid)) from e
+            procs[proc] = name
+
+        _, alive = psutil.wait_procs(procs, timeout=self.stop_timeout)
+        for proc in alive:
+            logger.warning("Notebook process %d for %s did not exit in %s seconds, killing it", proc.pid, procs[proc], self.stop_timeout)
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                pass
+        if alive:
+            psutil.wait_procs(alive, timeout=self.max_poll_interval)
+
+        return sorted(procs.values())
+
+    def count_running_notebooks(self):
+        """Count notebooks whose daemon is alive, reading the compact context records where they are up to date."""
+        count = 0
+        for name in self.get_notebook_names():
+            record = comm.get_context_record(self.get_pid(name))
+            if record:
+                pid = record.pid
+            else:
+                # Being written or left behind by a crashed writer
+                context = comm.get_context(self.get_pid(name), daemon=True)
+                pid = context and context.get("pid")
+            if pid and comm.check_pid(int(pid)):
+                count += 1
+        return count
+
+    def stop_many(self, names):
+        """Stop several notebooks at once.
+
+        Unlike :py:meth:`stop_notebook`, this always signals the daemons directly, all at once, see :py:meth:`terminate_daemons`.
+
+        :return: List of names of notebooks which were running and are now stopped
+        """
+        started = time.monotonic()
+        contexts = {name: comm.get_context(self.get_pid(name), daemon=True) for name in names}
+
+        stopped = self.terminate_daemons(names)
+
+        for name in names:
+            self.forget_notebook(name, contexts[name])
+
+        metrics.inc("pyramid_notebook_stops_total", len(stopped))
+        logger.info("Stopped %d notebooks in %f seconds", len(stopped), time.monotonic() - started)
+        return stopped
+
+    def stop_all(self):
+        """Stop all running notebooks, see :py:meth:`stop_many`.
+
+        :return: List of names of stopped notebooks
+        """
+        names = [name for name, context in self.list_notebooks().items() if context["running"]]
+        return self.stop_many(names)
+
+    def poll_intervals(self, timeout):
+        """Generate sleep times for polling until timeout, backing off exponentially."""
+        deadline = time.monotonic() + timeout
+        interval = self.min_poll_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            yield min(interval, remaining)
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def wait_for_exit(self, pid, timeout):
+        """Wait until a process is gone.
+
+        :return: True if the process exited within timeout
+        """
+        if not comm.check_pid(pid):
+            return True
+
+        for interval in self.poll_intervals(timeout):
+            time.sleep(interval)
+            if not comm.check_pid(pid):
+                return True
+        return False
+
+    def probe_http(self, context):
+        """Check if Notebook web server answers HTTP requests.
+
+        :return: True if we got any non-error HTTP response
+        """
+        path = context.get("notebook_path", "/notebook").rstrip("/") + "/api"
+        connection = http.client.HTTPConnection("localhost", context["http_port"], timeout=self.max_poll_interval)
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            return response.status < 500
+        except (OSError, http.client.HTTPException):
+            return False
+        finally:
+            connection.close()
+
+    def get_startup_timeout(self):
+        """How long we wait for a launched Notebook before giving up.
+
+        Loaded servers launch slower, so allow generous headroom over what we have observed so far.
+        """
+        if self.average_startup_time is None:
+            return self.startup_timeout
+        return max(self.startup_timeout, 4 * self.average_startup_time)
+
+    def wait_for_notebook(self, name):
+        """Wait until a launched Notebook daemon has written its context and its web server answers.
+
+        :return: Context of the ready notebook
+
+        :raise RuntimeError: If the daemon dies or does not become ready in time
+        """
+        started = time.monotonic()
+        err_log = os.path.join(self.get_work_folder(name), "notebook.stderr.log")
+
+        # Daemon pid from its pid file, remembered as daemonocle removes the file on exit
+        daemon_pid = None
+
+        for interval in self.poll_intervals(self.get_startup_timeout()):
+            # Daemon fills in pid and notebook name before starting the web server
+            context = comm.get_context(self.get_pid(name), daemon=True)
+            if not context or "notebook_name" not in context:
+                # Do not wait for the whole timeout if the daemon crashed before getting that far
+                daemon_pid = self.read_pid_file(name) or daemon_pid
+                if daemon_pid and not comm.check_pid(daemon_pid):
+                    raise RuntimeError("IPython Notebook died on launch, see {}".format(err_log))
+            else:
+                if not comm.check_pid(context["pid"]):
+                    raise RuntimeError("IPython Notebook died on launch, see {}".format(err_log))
+
+                if self.probe_http(context):
+                    # Record the last launch phase with the ones the daemon wrote
+                    context["timings"] = dict(context.get("timings") or {}, ready=time.time())
+                    comm.set_context(self.get_pid(name), context)
+                    self.ports.set_pid(context["http_port"], context["pid"])
+                    elapsed = time.monotonic() - started
+                    if self.average_startup_time is None:
+                        self.average_startup_time = elapsed
+                    else:
+                        self.average_startup_time = 0.8 * self.average_startup_time + 0.2 * elapsed
+                    logger.info("Notebook %s ready in %f seconds", name, elapsed)
+                    return context
+
+            time.sleep(interval)
+
+        # Failed to launch within timeout
+        raise RuntimeError("Failed to launch IPython Notebook, see {}".format(err_log))
 
     def is_running(self, name):
         status = self.get_notebook_status(name)
@@ -183,28 +667,65 @@ class NotebookManager:
 
         Return the updated settings with a port info.
 
+        Concurrent calls for the same name, from any thread or process, are serialized. The ones waiting for the lock get the notebook launched by the first one instead of launching their own.
+
         :return: (context dict, created flag)
         """
-        if self.is_running(name):
-
-            last_context = self.get_context(name)
-            logger.info("Notebook context change detected for %s", name)
-            if not self.is_same_context(context, last_context):
-                self.stop_notebook(name)
-                # Make sure we don't get race condition over context.json file
-                time.sleep(2.0)
-            else:
-                return last_context, False
-
-        err_log = os.path.join(self.get_work_folder(name), "notebook.stderr.log")
-        logger.info("Launching new Notebook named %s, context is %s", name, context)
-        logger.info("Notebook log is %s", err_log)
-
-        self.start_notebook(name, context)
-        time.sleep(1)
-        context = self.get_context(name)
-        if "notebook_name" not in context:
-            # Failed to launch within timeout
-            raise RuntimeError("Failed to launch IPython Notebook, see {}".format(err_log))
-
-        return context, True
+        with self.lock_notebook(name):
+            if self.is_running(name):
+
+                last_context = self.get_context(name)
+                if not self.is_same_context(context, last_context):
+                    logger.info("Notebook context change detected for %s", name)
+                    self.stop_notebook(name)
+                else:
+                    return last_context, False
+
+            err_log = os.path.join(self.get_work_folder(name), "notebook.stderr.log")
+            logger.info("Launching new Notebook named %s, context is %s", name, context)
+            logger.info("Notebook log is %s", err_log)
+
+            started = time.monotonic()
+            try:
+                self.start_notebook(name, context)
+                context = self.wait_for_notebook(name)
+            except Exception:
+                metrics.inc("pyramid_notebook_launches_total", result="failed")
+                raise
+
+            metrics.inc("pyramid_notebook_launches_total", result="ok")
+            metrics.observe("pyramid_notebook_launch_seconds", time.monotonic() - started)
+            return context, True
+
+    def start_notebook_in_background(self, name, context):
+        """Run :py:meth:`start_notebook_on_demand` on a background thread.
+
+        Calling this again while a launch for the same name is going on returns the pending launch. Progress can be followed with :py:meth:`get_notebook_status` and :py:meth:`get_launch_error` from any process.
+
+        :return: :py:class:`concurrent.futures.Future` resolving to the return value of :py:meth:`start_notebook_on_demand`
+        """
+        with self.launches_lock:
+            future = self.launches.get(name)
+            if future and not future.done():
+                return future
+
+            try:
+                os.remove(self.get_launch_error_file(name))
+            except FileNotFoundError:
+                pass
+
+            if self.launch_executor is None:
+                self.launch_executor = ThreadPoolExecutor(max_workers=4)
+
+            future = self.launch_executor.submit(self._start_notebook_in_background, name, context)
+            self.launches[name] = future
+            return future
+
+    def _start_notebook_in_background(self, name, context):
+        try:
+            return self.start_notebook_on_demand(name, context)
+        except Exception as e:
+            logger.exception("Background launch of notebook %s failed", name)
+            with open(self.get_launch_error_file(name), "wt") as f:
+                f.write(str(e))
+            raise
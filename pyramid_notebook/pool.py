@@ -0,0 +1,187 @@
+"""Pool of prestarted Notebook daemons.
+
+Starting a Notebook daemon from scratch means a new Python interpreter, daemonization and importing IPython and Jupyter, which takes seconds. The pool keeps a number of daemons which have already done all this waiting in the background. When a user launches a notebook, a waiting daemon is claimed and bound to the user and the context instead.
+
+Each pooled daemon lives in its own slot folder under ``.pool`` in the notebook folder. The protocol between the web server and a pooled daemon goes through files in that folder:
+
+* The daemon writes ``ready`` JSON file with its pid and preallocated port once it has imported everything
+
+* The web server claims the slot by renaming ``ready`` to ``claimed``. Rename is atomic, so only one web server process can win the slot.
+
+* The web server writes the user context file and then ``claim.json`` telling the daemon its new work folder and pid file
+
+* The daemon moves itself to the user work folder, removes the slot folder and starts Notebook with the user context
+
+Because Notebook needs the user context (base URL, allowed origin, templates) to configure its web server, the HTTP port is leased to a pooled daemon up front, but bound only after the claim.
+"""
+# Standard Library
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# Pyramid Notebook
+from pyramid_notebook.server import comm
+from pyramid_notebook.utils import ProcessThread
+
+
+logger = logging.getLogger(__name__)
+
+
+class NotebookPool:
+    """Keep a number of prestarted Notebook daemons waiting to be claimed.
+
+    Each web server process can have its own :py:class:`NotebookPool` object pointing to the same notebook folder. They share the pool through the file system.
+    """
+
+    #: Seconds a slot may stay without a running daemon or without finishing a claim before we consider it dead
+    startup_grace = 60.0
+
+    def __init__(self, manager, size, refill_interval=5.0):
+        """
+        :param manager: :py:class:`pyramid_notebook.notebookmanager.NotebookManager` used to launch daemons
+
+        :param size: How many idle daemons we try to keep around
+
+        :param refill_interval: Seconds between checks if the pool needs more daemons
+        """
+        self.manager = manager
+        self.size = size
+        self.refill_interval = refill_interval
+        self.pool_folder = os.path.join(manager.notebook_folder, ".pool")
+        os.makedirs(self.pool_folder, exist_ok=True)
+
+        self.wakeup = threading.Event()
+        self.thread = ProcessThread(self.run, "notebook-pool")
+
+        #: Slots whose daemon pid we have recorded in the port lease table
+        self.recorded_pids = set()
+
+    def get_slot_folders(self):
+        """List existing slot folders."""
+        try:
+            names = os.listdir(self.pool_folder)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.pool_folder, name) for name in sorted(names) if name.startswith("slot-")]
+
+    def get_lease_name(self, slot_folder):
+        """Name under which the port of a slot is leased until it is claimed."""
+        return ".pool/" + os.path.basename(slot_folder)
+
+    def is_slot_alive(self, slot_folder, now):
+        """Check if a slot has a live daemon or is still starting one."""
+        try:
+            age = now - os.stat(slot_folder).st_mtime
+        except FileNotFoundError:
+            return False
+
+        if os.path.exists(os.path.join(slot_folder, "claimed")):
+            # Daemon removes the slot folder when it has moved to the user folder
+            return age < self.startup_grace
+
+        info = comm.read_json(os.path.join(slot_folder, "ready"))
+        if info:
+            if not comm.check_pid(info["pid"]):
+                return False
+
+            # Let the port lease be reclaimed if the daemon dies
+            if slot_folder not in self.recorded_pids:
+                self.manager.ports.set_pid(info["http_port"], info["pid"])
+                self.recorded_pids.add(slot_folder)
+            return True
+
+        # Daemon is still importing stuff
+        return age < self.startup_grace
+
+    def remove_slot(self, slot_folder):
+        """Clean up after a dead pooled daemon."""
+        logger.info("Removing dead Notebook pool slot %s", slot_folder)
+        # Port first, so that whoever sees the slot gone sees its port free too
+        self.manager.ports.release(self.get_lease_name(slot_folder))
+        shutil.rmtree(slot_folder, ignore_errors=True)
+        self.recorded_pids.discard(slot_folder)
+
+    def spawn(self):
+        """Start a new pooled daemon."""
+        slot_folder = os.path.join(self.pool_folder, "slot-{}".format(uuid.uuid4().hex))
+        os.makedirs(slot_folder)
+
+        http_port = self.manager.pick_port(self.get_lease_name(slot_folder))
+
+        pid_file = os.path.join(slot_folder, "notebook.pid")
+        cmd = [self.manager.python, self.manager.cmd, "pool", pid_file, slot_folder, http_port, self.manager.kill_timeout]
+        logger.info("Prestarting pooled Notebook daemon in %s", slot_folder)
+        self.manager.run_daemon_command(cmd)
+
+    def refill(self):
+        """Remove dead slots and start new daemons until the pool is full."""
+
+        # Several web server processes may refill at the same time
+        with open(os.path.join(self.pool_folder, "refill.lock"), "wt") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            now = time.time()
+            alive = 0
+            for slot_folder in self.get_slot_folders():
+                if self.is_slot_alive(slot_folder, now):
+                    alive += 1
+                else:
+                    self.remove_slot(slot_folder)
+
+            for i in range(self.size - alive):
+                self.spawn()
+
+    def run(self):
+        """Background refill loop."""
+        while True:
+            try:
+                self.refill()
+            except Exception as e:
+                logger.exception(e)
+
+            self.wakeup.wait(self.refill_interval)
+            self.wakeup.clear()
+
+    def start(self):
+        """Start background refilling in this process, if not running yet."""
+        self.thread.start()
+
+    def claim(self):
+        """Take a waiting daemon out of the pool.
+
+        :return: Slot info dict or None if there is no daemon ready
+        """
+        self.start()
+
+        for slot_folder in self.get_slot_folders():
+            try:
+                os.rename(os.path.join(slot_folder, "ready"), os.path.join(slot_folder, "claimed"))
+            except FileNotFoundError:
+                # Still starting or somebody else got it
+                continue
+
+            info = comm.read_json(os.path.join(slot_folder, "claimed"))
+            if not info or not comm.check_pid(info["pid"]):
+                self.remove_slot(slot_folder)
+                continue
+
+            info["slot_folder"] = slot_folder
+            self.wakeup.set()
+            return info
+
+        logger.info("Notebook pool is empty")
+        self.wakeup.set()
+        return None
+
+    def bind(self, slot, pid_file, work_folder):
+        """Tell a claimed daemon to become the notebook of a user.
+
+        The user context file must have been written before calling this.
+        """
+        claim = {"pid_file": pid_file, "work_folder": work_folder}
+        claim_file = os.path.join(slot["slot_folder"], "claim.json")
+        comm.write_json(claim_file, claim)
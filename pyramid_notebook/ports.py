@@ -0,0 +1,205 @@
+"""Localhost port leases for Notebook daemons.
+
+All web server processes share a SQLite lease table in the notebook folder. A port is taken from the free list and leased to a notebook name in one transaction, so two processes never hand out the same port, even before the daemon has bound it.
+
+A lease is released when the notebook is stopped. Leases of daemons which have died without being stopped are reclaimed when we run out of free ports or at regular intervals.
+"""
+# Standard Library
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Third Party
+import port_for
+
+# Pyramid Notebook
+from pyramid_notebook.server import comm
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (port INTEGER PRIMARY KEY, name TEXT NOT NULL, pid INTEGER, leased_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS leases_name ON leases (name);
+CREATE TABLE IF NOT EXISTS free_order (seq INTEGER PRIMARY KEY AUTOINCREMENT, port INTEGER UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class PortAllocator:
+    """Lease localhost ports to named notebooks.
+
+    Free ports are kept in a queue, so allocation is constant time however large the port range is. Released ports go to the end of the queue and are reused last.
+    """
+
+    #: Seconds between scans for leases of dead daemons
+    reclaim_interval = 60.0
+
+    def __init__(self, db_file, min_port, port_range, lease_timeout=600.0):
+        """
+        :param db_file: SQLite database file shared by all web server processes
+
+        :param lease_timeout: Seconds after a lease whose daemon has never reported its pid can be reclaimed
+        """
+        self.db_file = db_file
+        self.min_port = min_port
+        self.port_range = port_range
+        self.lease_timeout = lease_timeout
+        self.local = threading.local()
+        self.last_reclaim = 0
+
+        # executescript() commits on its own, so it cannot run inside our transaction
+        self.get_connection().executescript(SCHEMA)
+        with self.transaction() as db:
+            self.sync_range(db)
+
+    def get_connection(self):
+        """Get SQLite connection of the current thread.
+
+        Connections must not be shared across threads or forked processes.
+        """
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def transaction(self):
+        """Exclusive write transaction over the lease table."""
+        return Transaction(self.get_connection())
+
+    def sync_range(self, db):
+        """Rebuild the free list if the configured port range has changed."""
+        wanted = "{}:{}".format(self.min_port, self.port_range)
+        row = db.execute("SELECT value FROM meta WHERE key = 'range'").fetchone()
+        if row and row[0] == wanted:
+            return
+
+        leased = {port for port, in db.execute("SELECT port FROM leases")}
+        db.execute("DELETE FROM free_order")
+        db.executemany(
+            "INSERT INTO free_order (port) VALUES (?)",
+            ((port,) for port in range(self.min_port, self.min_port + self.port_range) if port not in leased))
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('range', ?)", (wanted,))
+
+    def reclaim(self, db):
+        """Return ports of dead daemons to the free list."""
+        now = time.time()
+        dead = []
+        for port, name, pid, leased_at in db.execute("SELECT port, name, pid, leased_at FROM leases"):
+            if pid is None:
+                if now - leased_at > self.lease_timeout:
+                    dead.append(port)
+            elif not comm.check_pid(pid):
+                dead.append(port)
+
+        for port in dead:
+            logger.info("Reclaiming port %d from dead notebook daemon", port)
+            self.free_port(db, port)
+
+        self.last_reclaim = time.monotonic()
+
+    def free_port(self, db, port):
+        db.execute("DELETE FROM leases WHERE port = ?", (port,))
+        if self.min_port <= port < self.min_port + self.port_range:
+            db.execute("INSERT OR IGNORE INTO free_order (port) VALUES (?)", (port,))
+
+    def lease_next(self, name, release=False):
+        """Lease the port at the head of the free list.
+
+        :param release: Release earlier leases of the name first
+
+        :return: Port number or None if there are no free ports
+        """
+        with self.transaction() as db:
+            if release:
+                for port, in db.execute("SELECT port FROM leases WHERE name = ?", (name,)).fetchall():
+                    self.free_port(db, port)
+
+            if time.monotonic() - self.last_reclaim > self.reclaim_interval:
+                self.reclaim(db)
+
+            row = db.execute("SELECT seq, port FROM free_order ORDER BY seq LIMIT 1").fetchone()
+            if row is None:
+                self.reclaim(db)
+                row = db.execute("SELECT seq, port FROM free_order ORDER BY seq LIMIT 1").fetchone()
+
+            if row is None:
+                return None
+
+            seq, port = row
+            db.execute("DELETE FROM free_order WHERE seq = ?", (seq,))
+            db.execute("INSERT OR REPLACE INTO leases (port, name, pid, leased_at) VALUES (?, ?, NULL, ?)", (port, name, time.time()))
+            return port
+
+    def acquire(self, name):
+        """Lease a free port for a named notebook.
+
+        Any earlier lease of the name is released, as a name has one notebook daemon at a time.
+
+        Whether something else is listening on the port is checked after the lease has been committed, so other web server processes are not blocked on the lease table while we probe sockets.
+
+        :return: Port number
+
+        :raise RuntimeError: If all ports are in use
+        """
+        for attempt in range(self.port_range):
+            port = self.lease_next(name, release=(attempt == 0))
+            if port is None:
+                break
+
+            if not port_for.port_is_used(port):
+                return port
+
+            # Ports taken by something else than our daemons are pushed to the end of the queue
+            with self.transaction() as db:
+                self.free_port(db, port)
+
+        raise RuntimeError("No free ports left for notebooks in range {}-{}".format(self.min_port, self.min_port + self.port_range - 1))
+
+    def set_pid(self, port, pid):
+        """Record the daemon process holding a leased port, so the lease can be reclaimed if it dies."""
+        with self.transaction() as db:
+            db.execute("UPDATE leases SET pid = ? WHERE port = ?", (pid, port))
+
+    def transfer(self, port, name):
+        """Move a lease to another name, e.g. when a pooled daemon is claimed by a user."""
+        with self.transaction() as db:
+            for old_port, in db.execute("SELECT port FROM leases WHERE name = ? AND port != ?", (name, port)).fetchall():
+                self.free_port(db, old_port)
+            db.execute("UPDATE leases SET name = ? WHERE port = ?", (name, port))
+
+    def release(self, name):
+        """Release ports leased to a name."""
+        with self.transaction() as db:
+            for port, in db.execute("SELECT port FROM leases WHERE name = ?", (name,)).fetchall():
+                self.free_port(db, port)
+
+    def get_leases(self):
+        """List current leases.
+
+        :return: dict port -> (name, pid)
+        """
+        db = self.get_connection()
+        return {port: (name, pid) for port, name, pid in db.execute("SELECT port, name, pid FROM leases")}
+
+
+class Transaction:
+    """Context manager running ``BEGIN IMMEDIATE`` ... ``COMMIT``, rolling back on error."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
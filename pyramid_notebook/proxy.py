@@ -1,12 +1,20 @@
 # Courtesy of https://bitbucket.org/dahlia/wsgi-proxy/raw/02ab0dfa8e0078add268e91426e1cc1a52664cf5/wsgi_proxy/__init__.py
 
 # Standard Library
+import collections
 import http.client
 import logging
+import select
+import threading
+import time
+from urllib.parse import parse_qsl
 from urllib.parse import unquote_plus
 from urllib.parse import urlparse
 from urllib.parse import urlunparse
 
+# Pyramid Notebook
+from pyramid_notebook import metrics
+
 
 #: (:class:`frozenset`) The set of hop-by-hop headers.  All header names
 #: all normalized to lowercase.
@@ -30,6 +38,352 @@ def is_hop_by_hop(header):
     return header.lower() in HOPPISH_HEADERS
 
 
+#: Headers we never forward upstream. Connection is hop-by-hop too, and the upstream connection is kept alive by the pool regardless what the client asked for.
+REQUEST_SKIP_HEADERS = HOPPISH_HEADERS | frozenset(['connection'])
+
+#: Don't let clients grow the header name caches without limit by sending made up headers
+MAX_CACHED_HEADER_NAMES = 1024
+
+#: WSGI environ key -> upstream header name or None, see get_header_name()
+_header_names = {}
+
+#: Upstream response header name -> whether it is passed downstream, see is_end_to_end()
+_end_to_end = {}
+
+
+def get_header_name(key):
+    """Map a WSGI environ key to the name of the header we forward upstream.
+
+    Computed once per key, as the same few headers come in with every request.
+
+    :return: Lowercase header name or None if the key is not a header we forward
+    """
+    try:
+        return _header_names[key]
+    except KeyError:
+        pass
+
+    name = None
+    if key.startswith('HTTP_'):
+        # This is a hacky way of getting the header names right
+        name = key[5:].lower().replace('_', '-')
+        if name in REQUEST_SKIP_HEADERS:
+            name = None
+
+    if len(_header_names) < MAX_CACHED_HEADER_NAMES:
+        _header_names[key] = name
+    return name
+
+
+def is_end_to_end(header):
+    """Cached negation of :func:`is_hop_by_hop` for response headers."""
+    try:
+        return _end_to_end[header]
+    except KeyError:
+        pass
+
+    result = not is_hop_by_hop(header)
+    if len(_end_to_end) < MAX_CACHED_HEADER_NAMES:
+        _end_to_end[header] = result
+    return result
+
+
+#: Exceptions telling that a kept alive upstream socket was closed under us and the request can be safely retried on a fresh connection
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+#: Methods we may send again after a stale connection error. Upstream may have received the first attempt in full, so anything changing state, like saving a notebook or starting a kernel, is never replayed.
+RETRY_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+
+def is_connection_dropped(connection):
+    """Check if an idle keep-alive connection has been closed by the upstream server.
+
+    An idle HTTP/1.1 connection should have nothing to read. If the socket polls readable, the server has either closed it (EOF) or sent garbage, and either way it cannot be reused.
+    """
+    sock = connection.sock
+    if sock is None:
+        return True
+
+    # poll, unlike select, works with fd numbers over FD_SETSIZE of a worker holding many websockets
+    poller = select.poll()
+    try:
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))
+    except (OSError, ValueError):
+        return True
+
+
+class ConnectionPool:
+    """Keep-alive connections to one upstream Notebook Tornado server.
+
+    The pool only holds idle connections. A connection is checked out with :meth:`acquire` for the duration of one request/response cycle and given back with :meth:`release` once the response has been fully read.
+    """
+
+    def __init__(self, port, max_size=8, idle_timeout=30.0, connection_class=http.client.HTTPConnection):
+        """
+        :param port: localhost port of the upstream Notebook server
+
+        :param max_size: Maximum number of idle connections kept around. Connections released over this limit are closed.
+
+        :param idle_timeout: Seconds after an idle connection is evicted from the pool. Tornado closes idle connections on its own too, so keep this reasonably short.
+        """
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connection_class = connection_class
+        self.lock = threading.Lock()
+        #: Deque of (connection, released at) tuples, most recently released on the right
+        self.idle = collections.deque()
+
+    def evict(self, now):
+        """Close connections which have been idle too long. Must be called holding the lock."""
+        while self.idle and now - self.idle[0][1] > self.idle_timeout:
+            connection, _ = self.idle.popleft()
+            connection.close()
+
+    def acquire(self):
+        """Get a connection to the upstream server.
+
+        :return: tuple (connection, reused flag)
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.evict(now)
+            while self.idle:
+                connection, _ = self.idle.pop()
+                if is_connection_dropped(connection):
+                    connection.close()
+                    continue
+                return connection, True
+
+        return self.connection_class("localhost:{}".format(self.port)), False
+
+    def release(self, connection):
+        """Return a connection whose response has been fully consumed back to the pool."""
+        if connection.sock is None:
+            # Upstream told us to close the connection (Connection: close, HTTP/1.0)
+            connection.close()
+            return
+
+        now = time.monotonic()
+        with self.lock:
+            self.evict(now)
+            if len(self.idle) < self.max_size:
+                self.idle.append((connection, now))
+                return
+
+        connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            while self.idle:
+                connection, _ = self.idle.pop()
+                connection.close()
+
+
+#: port -> ConnectionPool, shared by all requests in this process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(port, **kwargs):
+    """Get the per-process connection pool for a Notebook port, creating it on the first use.
+
+    :param kwargs: Passed to :class:`ConnectionPool` when the pool is created
+    """
+    pool = _pools.get(port)
+    if pool is not None:
+        return pool
+
+    with _pools_lock:
+        pool = _pools.get(port)
+        if pool is None:
+            pool = _pools[port] = ConnectionPool(port, **kwargs)
+        return pool
+
+
+def drop_connection_pool(port):
+    """Close and forget pooled connections to a port, e.g. when the Notebook daemon bound to it is stopped."""
+    with _pools_lock:
+        pool = _pools.pop(port, None)
+
+    if pool is not None:
+        pool.close()
+
+
+class RequestBody:
+    """Iterate a WSGI request body in bounded chunks, so that uploads are streamed upstream instead of read in memory."""
+
+    def __init__(self, input, length, chunk_size):
+        """
+        :param input: ``wsgi.input`` stream
+
+        :param length: Content length or None to read until the stream ends
+        """
+        self.input = input
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+        #: Set when we have given out anything, after which the request cannot be retried
+        self.consumed = False
+
+    def __iter__(self):
+        while self.remaining is None or self.remaining > 0:
+            size = self.chunk_size if self.remaining is None else min(self.chunk_size, self.remaining)
+            chunk = self.input.read(size)
+            if not chunk:
+                return
+
+            self.consumed = True
+            if self.remaining is not None:
+                self.remaining -= len(chunk)
+            yield chunk
+
+
+class CachedResponse:
+    """Response kept in :class:`ResponseCache`."""
+
+    def __init__(self, status, headers, body, etag, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        #: time.monotonic() after which the response must be fetched again
+        self.expires = expires
+
+
+class ResponseCache:
+    """LRU cache of upstream responses shared by all Notebook servers, bounded by total body size.
+
+    All users run the same Notebook version, so static files with the same path and version query are the same for everybody. Only responses upstream marks cacheable are stored, see :func:`get_cache_lifetime`.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes=None):
+        """
+        :param max_bytes: Upper limit for the total size of cached bodies
+
+        :param max_entry_bytes: Larger responses are not cached. Defaults to 1/8 of max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.size = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Get a fresh cached response, marking it recently used."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if time.monotonic() > entry.expires:
+                del self.entries[key]
+                self.size -= len(entry.body)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if len(entry.body) > self.max_entry_bytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+
+            self.entries[key] = entry
+            self.size += len(entry.body)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+
+#: Response cache shared by all requests in this process, see get_response_cache()
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache(max_bytes):
+    """Get the per-process response cache, creating it on the first use."""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(max_bytes)
+    return _response_cache
+
+
+def get_cache_key(environ):
+    """Cache key for a request or None if the request cannot be answered from the cache.
+
+    Only plain GETs of Notebook static files, optionally with Notebook's ``v`` version query, are cached. Everything else, like ``/files/``, may be different for each user and the key does not tell users apart.
+    """
+    if environ['REQUEST_METHOD'] != 'GET' or environ.get('pyramid_notebook.route') != 'static':
+        return None
+
+    query_string = environ.get('QUERY_STRING', '')
+    if query_string and any(name != 'v' for name, value in parse_qsl(query_string, keep_blank_values=True)):
+        return None
+
+    # Upstream may compress according to what the client accepts
+    return environ.get('PATH_INFO', ''), query_string, environ.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def get_cache_lifetime(response):
+    """Tell how long we may keep an upstream response.
+
+    Only static files get here, see :func:`get_cache_key`. Notebook marks versioned ones with a plain ``Cache-Control: max-age``, which is enough for them. Anything upstream says is private to one user, must not be stored or sets a cookie is not shared.
+
+    :return: Seconds or None if the response must not be cached
+    """
+    if response.status != 200 or response.getheader('set-cookie'):
+        return None
+
+    vary = response.getheader('vary')
+    if vary and any(v.strip().lower() != 'accept-encoding' for v in vary.split(',')):
+        return None
+
+    max_age = None
+    for directive in (response.getheader('cache-control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        name = name.lower()
+        if name in ('private', 'no-store', 'no-cache'):
+            return None
+        if name == 'max-age':
+            try:
+                max_age = int(value.strip('"'))
+            except ValueError:
+                return None
+
+    if not max_age or max_age <= 0:
+        return None
+    return max_age
+
+
+def is_not_modified(environ, etag):
+    """Check If-None-Match of a request against ETag of a cached response."""
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    # Weak comparison is fine for GET
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
 def reconstruct_url(environ, port):
     """Reconstruct the remote url from the given WSGI ``environ`` dictionary.
 
@@ -66,6 +420,33 @@ def reconstruct_url(environ, port):
     return url
 
 
+def get_upstream_path(environ):
+    """Get path and query string of the upstream request.
+
+    Gives the same result as taking the path out of :func:`reconstruct_url`, without building and parsing the whole URL.
+    """
+    path = environ.get('PATH_INFO', '')
+    if path.startswith(('http://', 'https://')):
+        # Absolute URI in request line, rare enough to take the slow path
+        url = urlparse(reconstruct_url(environ, 0))
+        return urlunparse(('', '') + url[2:])
+
+    # Fix ;arg=value in url
+    if '%3B' in path:
+        path, arg = path.split('%3B', 1)
+        path = ';'.join([path, arg.replace('%3D', '=')])
+
+    # Stick query string back in
+    query_string = environ.get('QUERY_STRING')
+    if query_string:
+        path += '?' + query_string
+    return path
+
+
+#: Logger of the proxy hot path
+logger = logging.getLogger(__name__ + '.WSGIProxyApplication.handler')
+
+
 class WSGIProxyApplication:
     """WSGI application to handle requests that need to be proxied.
     You have to instantiate the class before using it as WSGI app::
@@ -82,29 +463,42 @@ class WSGIProxyApplication:
     #: Default is :class:`httplib.HTTPConnection`.
     connection_class = http.client.HTTPConnection
 
-    def __init__(self, port):
+    def __init__(self, port, pool_size=8, pool_idle_timeout=30.0, chunk_size=65536, cache=None):
+        """
+        :param chunk_size: Bytes we read at a time when streaming request and response bodies. Request bodies up to this size are read in memory at once.
+
+        :param cache: Optional :class:`ResponseCache` shared with other Notebook servers
+        """
         # Target port where we proxy IPython Notebook
         self.port = port
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.pool = get_connection_pool(port, max_size=pool_size, idle_timeout=pool_idle_timeout, connection_class=self.connection_class)
 
     def handler(self, environ, start_response):
         """Proxy for requests to the actual http server"""
-        logger = logging.getLogger(__name__ + '.WSGIProxyApplication.handler')
-        url = urlparse(reconstruct_url(environ, self.port))
-
-        # Create connection object
-        try:
-            connection = self.connection_class(url.netloc)
-            # Build path
-            path = url.geturl().replace('%s://%s' % (url.scheme, url.netloc),
-                                        '')
-        except Exception:
-            start_response('501 Gateway Error', [('Content-Type', 'text/html')])
-            logger.exception('Could not Connect')
-            yield '<H1>Could not connect</H1>'
-            return
+        debug = logger.isEnabledFor(logging.DEBUG)
+        path = get_upstream_path(environ)
+        started = time.monotonic()
+
+        # Set by the notebook_proxy view
+        route = environ.get('pyramid_notebook.route', 'other')
+
+        cache_key = get_cache_key(environ) if self.cache else None
+        if cache_key:
+            entry = self.cache.get(cache_key)
+            if entry:
+                metrics.inc('pyramid_notebook_proxy_cache_hits_total')
+                if is_not_modified(environ, entry.etag):
+                    start_response('304 Not Modified', [(key, value) for key, value in entry.headers if key.lower() in ('etag', 'cache-control', 'expires', 'last-modified')])
+                else:
+                    start_response(entry.status, entry.headers)
+                    yield entry.body
+                return
 
         # Read in request body if it exists
         body = length = None
+        chunked = False
         try:
             length = int(environ['CONTENT_LENGTH'])
         except (KeyError, ValueError):
@@ -112,37 +506,43 @@ class WSGIProxyApplication:
             # This is a situation where client HTTP POST is missing content-length.
             # This is also situation where (WebOb?) may screw up encoding and isert extranous = in the body.
             # https://github.com/ipython/ipython/issues/8416
-            if environ["REQUEST_METHOD"] == "POST":
-                if environ.get("CONTENT_TYPE") == 'application/x-www-form-urlencoded; charset=UTF-8':
-                    body = environ['wsgi.input'].read()
-                    try:
-                        body = unquote_plus(body.decode("utf-8"))
-
-                        # Fix extra = at end of JSON payload
-                        if body.startswith("{") and body.endswith("}="):
-                            body = body[0:len(body) - 1]
-
-                    except Exception as e:
-                        logger.exception(e)
-                        logger.error("Could not decode body: %s", body)
-
-                    length = len(body)
+            if environ["REQUEST_METHOD"] == "POST" and environ.get("CONTENT_TYPE") == 'application/x-www-form-urlencoded; charset=UTF-8':
+                body = environ['wsgi.input'].read()
+                try:
+                    body = unquote_plus(body.decode("utf-8"))
+
+                    # Fix extra = at end of JSON payload
+                    if body.startswith("{") and body.endswith("}="):
+                        body = body[0:len(body) - 1]
+
+                except Exception as e:
+                    logger.exception(e)
+                    logger.error("Could not decode body: %s", body)
+
+                length = len(body)
+            elif environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+                # Client sent chunked body, pass it on chunked.
+                # wsgi.input_terminated alone does not tell there is a body, servers like Waitress set it on every request.
+                body = RequestBody(environ['wsgi.input'], None, self.chunk_size)
+                chunked = True
         else:
-            body = environ['wsgi.input'].read(length)
+            if length <= self.chunk_size:
+                # Small bodies are kept around, so that the request can be retried on a stale connection
+                body = environ['wsgi.input'].read(length)
+            else:
+                body = RequestBody(environ['wsgi.input'], length, self.chunk_size)
 
         # Build headers
-        logger.debug('environ = %r', environ)
-        headers = dict(
-            (key, value)
-            for key, value in (
-                # This is a hacky way of getting the header names right
-                (key[5:].lower().replace('_', '-'), value)
-                for key, value in environ.items()
-                # Keys that start with HTTP_ are all headers
-                if key.startswith('HTTP_')
-            )
-            if not is_hop_by_hop(key)
-        )
+        if debug:
+            logger.debug('environ = %r', environ)
+
+        headers = {}
+        for key, value in environ.items():
+            # Keys that start with HTTP_ are all headers
+            if key[:5] == 'HTTP_':
+                name = get_header_name(key)
+                if name:
+                    headers[name] = value
 
         # Handler headers that aren't HTTP_ in environ
         try:
@@ -154,47 +554,94 @@ class WSGIProxyApplication:
         if 'host' not in headers:
             headers['host'] = environ['SERVER_NAME']
 
-        # Make the remote request
-        try:
+        # http.client cannot tell the length of a streamed body
+        if isinstance(body, RequestBody) and not chunked:
+            headers['content-length'] = str(length)
 
+        # Make the remote request
+        if debug:
             logger.debug('%s %s %r',
                          environ['REQUEST_METHOD'], path, headers)
-            connection.request(environ['REQUEST_METHOD'], path,
-                               body=body, headers=headers)
-        except Exception as e:
-            # We need extra exception handling in the case the server fails
-            # in mid connection, it's an edge case but I've seen it
-            if isinstance(e, ConnectionRefusedError):
-                # The notebook was shutdown by the user
-                pass
-            else:
-                # This might be a genuine error
-                logger.exception(e)
-
-            start_response('501 Gateway Error', [('Content-Type', 'text/html')])
-            yield '<H1>Could not proxy IPython Notebook running localhost:{}</H1>'.format(self.port).encode("utf-8")
-            return
 
-        try:
-            response = connection.getresponse()
-        except ConnectionResetError:
-            # Notebook shutdown
-            start_response('501 Gateway Error', [('Content-Type', 'text/html')])
-            yield '<H1>Could not proxy IPython Notebook running localhost:{}</H1>'.format(self.port).encode("utf-8")
-            return
+        # encode_chunked is not known by Python 3.5
+        request_kwargs = {'encode_chunked': True} if chunked else {}
+        while True:
+            connection, reused = self.pool.acquire()
+            try:
+                connection.request(environ['REQUEST_METHOD'], path,
+                                   body=body, headers=headers, **request_kwargs)
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS as e:
+                connection.close()
+                if reused and environ['REQUEST_METHOD'] in RETRY_METHODS and not (isinstance(body, RequestBody) and body.consumed):
+                    # Kept alive socket was closed by upstream between our staleness check and the request, retry with a fresh one
+                    logger.debug("Retrying on stale connection to localhost:%d: %s", self.port, e)
+                    continue
+
+                # Notebook shutdown
+                metrics.inc('pyramid_notebook_proxy_errors_total', route=route)
+                start_response('501 Gateway Error', [('Content-Type', 'text/html')])
+                yield '<H1>Could not proxy IPython Notebook running localhost:{}</H1>'.format(self.port).encode("utf-8")
+                return
+            except Exception as e:
+                connection.close()
+
+                # We need extra exception handling in the case the server fails
+                # in mid connection, it's an edge case but I've seen it
+                if isinstance(e, ConnectionRefusedError):
+                    # The notebook was shutdown by the user
+                    pass
+                else:
+                    # This might be a genuine error
+                    logger.exception(e)
+
+                metrics.inc('pyramid_notebook_proxy_errors_total', route=route)
+                start_response('501 Gateway Error', [('Content-Type', 'text/html')])
+                yield '<H1>Could not proxy IPython Notebook running localhost:{}</H1>'.format(self.port).encode("utf-8")
+                return
+            break
+
+        metrics.observe('pyramid_notebook_proxy_response_seconds', time.monotonic() - started, route=route)
+        metrics.inc('pyramid_notebook_proxy_requests_total', route=route, status=response.status)
 
-        hopped_headers = response.getheaders()
         headers = [(key, value)
-                   for key, value in hopped_headers
-                   if not is_hop_by_hop(key)]
+                   for key, value in response.getheaders()
+                   if is_end_to_end(key)]
 
-        start_response('{0.status} {0.reason}'.format(response), headers)
-        while True:
-            chunk = response.read(4096)
-            if chunk:
-                yield chunk
+        status = '{0.status} {0.reason}'.format(response)
+        start_response(status, headers)
+
+        # Keep a copy of a cacheable response while streaming it
+        lifetime = None
+        if cache_key and response.length is not None and response.length <= self.cache.max_entry_bytes:
+            lifetime = get_cache_lifetime(response)
+
+        # Only a fully read response leaves the connection in a reusable state.
+        # Upstream Content-Length, if any, went downstream with the headers, so the WSGI server does not need to chunk.
+        complete = False
+        try:
+            if lifetime or (response.length is not None and response.length <= self.chunk_size):
+                # Most API responses and cacheable static files fit in one go
+                chunk = response.read()
+                if lifetime:
+                    self.cache.put(cache_key, CachedResponse(status, headers, chunk, response.getheader('etag'), time.monotonic() + lifetime))
+                if chunk:
+                    yield chunk
+            else:
+                # Read into one buffer for the whole response. WSGI wants bytes, so each chunk is still copied out once.
+                buf = bytearray(self.chunk_size)
+                view = memoryview(buf)
+                while True:
+                    n = response.readinto(buf)
+                    if not n:
+                        break
+                    yield view[:n].tobytes()
+            complete = True
+        finally:
+            if complete:
+                self.pool.release(connection)
             else:
-                break
+                connection.close()
 
     def __call__(self, environ, start_response):
         return self.handler(environ, start_response)
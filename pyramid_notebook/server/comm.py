@@ -7,16 +7,56 @@
 
 """
 # Standard Library
+import copy
 import datetime
+import fcntl
 import json
 import logging
 import os
 import shutil
+import struct
+import threading
+import time
+from collections import namedtuple
 
 
 logger = logging.getLogger(__name__)
 
 
+#: Seconds we trust a cached answer whether the notebook process is alive
+PID_CHECK_TTL = 1.0
+
+#: Layout of the context record file: magic, layout version, padding, generation, pid, HTTP port, context hash, inode of the context file the record was written for
+RECORD_FORMAT = struct.Struct("<4sH2xQiIQQ")
+
+RECORD_MAGIC = b"PNBC"
+
+RECORD_VERSION = 2
+
+#: Hot fields of the context, see get_context_record()
+ContextRecord = namedtuple("ContextRecord", ["generation", "pid", "http_port", "context_hash"])
+
+
+class CachedContext:
+    """Parsed context file and the file identity it was parsed from."""
+
+    def __init__(self, key, data):
+        #: (inode, mtime, size) of the file when it was read
+        self.key = key
+        self.data = data
+        self.pid_checked_at = None
+        self.alive = None
+
+
+#: Context file name -> CachedContext. Shared by all threads of this process.
+_context_cache = {}
+
+
+def get_file_key(stat):
+    """File identity which changes whenever the file is rewritten."""
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
 # http://stackoverflow.com/a/568285/315168
 def check_pid(pid):
     """ Check For the existence of a unix pid. """
@@ -35,16 +75,149 @@ def get_context_file_name(pid_file):
     return port_file
 
 
+def get_record_file_name(pid_file):
+    """Compact fixed layout record of the hot context fields, next to the context file."""
+    return os.path.join(os.path.dirname(pid_file), "context.rec")
+
+
+def get_lock_file_name(pid_file):
+    """File locked by context writers, see :py:func:`set_context`."""
+    return os.path.join(os.path.dirname(pid_file), "context.lock")
+
+
+def fsync_dir(path):
+    """Make a rename in a folder survive a crash."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(fname, data):
+    """Replace file contents so that readers see either the old or the new data, never a partial write, even if we crash."""
+    tmp = "{}.{}-{}.tmp".format(fname, os.getpid(), threading.get_ident())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, fname)
+    except BaseException:
+        # Do not leave a partial file behind, e.g. when the disk is full
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+    fsync_dir(os.path.dirname(os.path.abspath(fname)))
+
+
+def write_json(fname, data):
+    """Replace a JSON file atomically, see :py:func:`write_atomic`."""
+    write_atomic(fname, json.dumps(data).encode("utf-8"))
+
+
+def read_json(fname):
+    """Read a JSON file written by :py:func:`write_json`.
+
+    :return: Parsed data or None if the file does not exist or cannot be parsed
+    """
+    try:
+        with open(fname, "rt") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_record(pid_file):
+    """Read the record file as is.
+
+    :return: Tuple (generation, pid, HTTP port, context hash, context file inode) or None if there is no valid record
+    """
+    try:
+        with open(get_record_file_name(pid_file), "rb") as f:
+            data = f.read(RECORD_FORMAT.size)
+    except FileNotFoundError:
+        return None
+
+    if len(data) != RECORD_FORMAT.size:
+        return None
+
+    magic, version, *fields = RECORD_FORMAT.unpack(data)
+    if magic != RECORD_MAGIC or version != RECORD_VERSION:
+        return None
+
+    return fields
+
+
+def get_context_record(pid_file):
+    """Read pid, HTTP port and context hash of a notebook without parsing its context file.
+
+    The generation counter grows by one on every :py:func:`set_context`, so readers can tell if the context has changed.
+
+    The record names the inode of the context file it was written for. A writer which crashed between replacing the context file and the record, or a reader racing a writer, would see the record of an older context file, so then there is no record.
+
+    :return: :py:class:`ContextRecord` or None if there is no record matching the context file. Missing fields are 0. The context hash is truncated to 64 bits.
+    """
+    fields = read_record(pid_file)
+    if fields is None:
+        return None
+
+    generation, pid, http_port, context_hash, context_ino = fields
+    try:
+        if os.stat(get_context_file_name(pid_file)).st_ino != context_ino:
+            return None
+    except FileNotFoundError:
+        return None
+
+    return ContextRecord(generation, pid, http_port, context_hash)
+
+
 def set_context(pid_file, context_info):
     """Set context of running notebook.
 
+    The context file is replaced atomically, so a reader in another process never sees it half written. Then the record file, see :py:func:`get_context_record`, is updated with the next generation number.
+
+    Writers in all processes, the daemon and the web server, take turns through a file lock, so generations are not lost and the record is never left describing another writer's context file.
+
     :param context_info: dict of extra context parameters, see comm.py comments
     """
     assert type(context_info) == dict
 
     port_file = get_context_file_name(pid_file)
-    with open(port_file, "wt") as f:
-        f.write(json.dumps(context_info))
+    json_data = json.dumps(context_info)
+
+    with open(get_lock_file_name(pid_file), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        write_atomic(port_file, json_data.encode("utf-8"))
+        stat = os.stat(port_file)
+
+        previous = read_record(pid_file)
+        record = RECORD_FORMAT.pack(
+            RECORD_MAGIC,
+            RECORD_VERSION,
+            previous[0] + 1 if previous else 1,
+            int(context_info.get("pid") or 0),
+            int(context_info.get("http_port") or 0),
+            int(context_info.get("context_hash") or 0) & 0xFFFFFFFFFFFFFFFF,
+            stat.st_ino)
+        write_atomic(get_record_file_name(pid_file), record)
+
+    # Readers in this process see the new data without reading the file again.
+    # Cache what readers would parse from the file, not the object we were given.
+    _context_cache[port_file] = CachedContext(get_file_key(stat), json.loads(json_data))
+
+
+def forget_context(pid_file):
+    """Drop cached context, e.g. after the notebook process has been stopped."""
+    _context_cache.pop(get_context_file_name(pid_file), None)
 
 
 def get_context(pid_file, daemon=False):
@@ -52,31 +225,51 @@ def get_context(pid_file, daemon=False):
 
     A context file is created when notebook starts.
 
+    Parsed context is cached in process and reused until the file changes. Whether the notebook process is alive is rechecked at most every :py:data:`PID_CHECK_TTL` seconds.
+
     :param daemon: Are we trying to fetch the context inside the daemon. Otherwise do the death check.
 
     :return: dict or None if the process is dead/not launcherd
     """
     port_file = get_context_file_name(pid_file)
 
-    if not os.path.exists(port_file):
+    try:
+        stat = os.stat(port_file)
+    except FileNotFoundError:
+        _context_cache.pop(port_file, None)
         return None
 
-    with open(port_file, "rt") as f:
-        json_data = f.read()
-        try:
-            data = json.loads(json_data)
-        except ValueError as e:
+    key = get_file_key(stat)
+    cached = _context_cache.get(port_file)
+    if cached is None or cached.key != key:
+        with open(port_file, "rt") as f:
+            json_data = f.read()
+            try:
+                data = json.loads(json_data)
+            except ValueError as e:
 
-            logger.error("Damaged context json data %s", json_data)
-            return None
+                logger.error("Damaged context json data %s", json_data)
+                return None
+
+        cached = CachedContext(key, data)
+        _context_cache[port_file] = cached
+
+    data = cached.data
+
+    if not daemon:
+        pid = data.get("pid")
+        if pid:
+            now = time.monotonic()
+            if cached.pid_checked_at is None or now - cached.pid_checked_at > PID_CHECK_TTL:
+                cached.alive = check_pid(int(pid))
+                cached.pid_checked_at = now
 
-        if not daemon:
-            pid = data.get("pid")
-            if pid and not check_pid(int(pid)):
+            if not cached.alive:
                 # The Notebook daemon has exited uncleanly, as the PID does not point to any valid process
                 return None
 
-        return data
+    # Callers are free to modify what they get, including nested dicts like timings
+    return copy.deepcopy(data)
 
 
 def clear_context(pid_file):
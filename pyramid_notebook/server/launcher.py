@@ -0,0 +1,361 @@
+"""Fork server running notebook daemon commands without starting a new Python interpreter each time.
+
+Running ``notebook_daemon.py`` as a script pays the interpreter startup and the imports of daemonocle, psutil, nbformat, IPython and traitlets on every start, stop and status call. The launcher is a long-lived process which has imported all of these once. It listens on a Unix socket. For each connection it forks a handler, which forks the actual command process and reports its output and exit code back, like :py:class:`subprocess.Popen` would.
+
+The protocol is one JSON request per connection: the client sends ``{"argv": [...], "env": {...}, "version": str}`` and closes its writing half. The command runs with the environment of the request, as a subprocess would. The launcher answers ``{"returncode": int, "stdout": str, "stderr": str}``.
+
+The launcher would keep running the code it imported at startup even after pyramid_notebook has been upgraded or edited on disk. Both sides compute :py:func:`get_code_version`, the client once when it first sends a command, and if the version of the request does not match, the launcher answers ``{"stale": true}``, gives up its socket and exits. The client then starts a new launcher and sends the request again.
+
+Run the launcher with::
+
+    python launcher.py /path/to/launcher.sock
+
+:py:class:`LauncherClient` starts it automatically on the first use.
+"""
+# Standard Library
+import atexit
+import faulthandler
+import fcntl
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+#: How many bytes we read at a time from sockets and pipes
+READ_SIZE = 65536
+
+
+def read_all(sock):
+    """Read from a socket until the other end closes its writing half."""
+    chunks = []
+    while True:
+        chunk = sock.recv(READ_SIZE)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def get_code_version():
+    """Identify pyramid_notebook code on disk by modification time and size of its modules.
+
+    Installing another version or editing a module rewrites files, which changes this.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    mtimes = 0
+    sizes = 0
+    for root, dirs, files in os.walk(package):
+        for name in files:
+            if name.endswith(".py"):
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                # Sums change when any one module changes, even if it is not the newest
+                mtimes += stat.st_mtime_ns
+                sizes += stat.st_size
+    return "{}:{}".format(mtimes, sizes)
+
+
+def preimport():
+    """Import everything notebook daemons need, so that forked children get them for free."""
+    # Pyramid Notebook
+    from pyramid_notebook.server import notebook_daemon  # noQA
+
+    import IPython  # noQA
+    from nbformat import v4  # noQA
+    from traitlets.config.loader import Config  # noQA
+    try:
+        import notebook.notebookapp  # noQA
+    except ImportError:
+        pass
+
+
+def run_command(argv, stdout_fd, stderr_fd, env=None):
+    """Run notebook_daemon.py command in the current, freshly forked, process. Never returns.
+
+    :param env: Environment variables of the command, replacing ours
+    """
+    code = 0
+    try:
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+
+            # Python reads this at interpreter startup, which a forked command skips
+            if env.get("PYTHONFAULTHANDLER"):
+                faulthandler.enable()
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        for fd in (devnull, stdout_fd, stderr_fd):
+            os.close(fd)
+
+        sys.argv = argv
+
+        from pyramid_notebook.server import notebook_daemon
+        notebook_daemon.main(argv)
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        # As if the interpreter was exiting normally, e.g. to clean up daemon pid files
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def collect_output(pid, stdout_fd, stderr_fd):
+    """Read output of a command process until it closes its pipes and wait for it to exit.
+
+    :return: tuple (exit code, stdout bytes, stderr bytes)
+    """
+    output = {stdout_fd: [], stderr_fd: []}
+    selector = selectors.DefaultSelector()
+    for fd in output:
+        selector.register(fd, selectors.EVENT_READ)
+
+    while selector.get_map():
+        for key, mask in selector.select():
+            chunk = os.read(key.fd, READ_SIZE)
+            if chunk:
+                output[key.fd].append(chunk)
+            else:
+                selector.unregister(key.fd)
+                os.close(key.fd)
+
+    selector.close()
+    _, status = os.waitpid(pid, 0)
+    if os.WIFEXITED(status):
+        returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = -os.WTERMSIG(status)
+    return returncode, b"".join(output[stdout_fd]), b"".join(output[stderr_fd])
+
+
+def retire(socket_path, socket_ino):
+    """Stop a launcher running outdated code. Called in a handler process.
+
+    Removing the socket file first makes new clients start a new launcher instead of connecting to us.
+    """
+    try:
+        # Another launcher may have taken over the path already
+        if os.stat(socket_path).st_ino == socket_ino:
+            os.remove(socket_path)
+    except FileNotFoundError:
+        pass
+    os.kill(os.getppid(), signal.SIGTERM)
+
+
+def handle(conn, socket_path=None, socket_ino=None, version=None):
+    """Serve one request in a forked handler process. Never returns.
+
+    :param version: Code version of the launcher, see :py:func:`get_code_version`
+    """
+    try:
+        # The launcher ignores SIGCHLD to reap handlers automatically, but we need to wait for our command
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        request = json.loads(read_all(conn).decode("utf-8"))
+
+        if version and request.get("version") != version:
+            logger.info("Notebook launcher code has changed on disk, exiting")
+            retire(socket_path, socket_ino)
+            conn.sendall(json.dumps({"stale": True}).encode("utf-8"))
+            conn.close()
+            os._exit(0)
+
+        argv = [str(arg) for arg in request["argv"]]
+        env = request.get("env")
+
+        stdout_r, stdout_w = os.pipe()
+        stderr_r, stderr_w = os.pipe()
+
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            os.close(stdout_r)
+            os.close(stderr_r)
+            run_command(argv, stdout_w, stderr_w, env)
+
+        os.close(stdout_w)
+        os.close(stderr_w)
+        returncode, stdout, stderr = collect_output(pid, stdout_r, stderr_r)
+
+        reply = {"returncode": returncode, "stdout": stdout.decode("utf-8", "replace"), "stderr": stderr.decode("utf-8", "replace")}
+        conn.sendall(json.dumps(reply).encode("utf-8"))
+        conn.close()
+    except BaseException as e:
+        logger.exception(e)
+        os._exit(1)
+
+    os._exit(0)
+
+
+def serve(socket_path):
+    """Run the launcher loop forever."""
+    # Before importing, so that a module changed meanwhile makes us stale rather than being missed
+    version = get_code_version()
+    preimport()
+
+    # Handlers are reaped by the kernel
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # Anybody who can connect can run daemon commands as us
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+
+    socket_ino = os.stat(socket_path).st_ino
+    server.listen(64)
+    logger.info("Notebook launcher listening on %s", socket_path)
+
+    while True:
+        conn, _ = server.accept()
+
+        # Do not let the children write out our buffered output twice
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            handle(conn, socket_path, socket_ino, version)
+        conn.close()
+
+
+class LauncherClient:
+    """Run notebook daemon commands through the launcher, starting the launcher when needed."""
+
+    #: Seconds we wait for a freshly started launcher to start listening
+    startup_timeout = 60.0
+
+    def __init__(self, socket_path, python):
+        """
+        :param socket_path: Path of the Unix socket of the launcher. Note that Unix socket paths are limited to around 100 characters.
+
+        :param python: Python interpreter used to run the launcher
+        """
+        self.socket_path = socket_path
+        self.python = python
+
+        #: Code version of this process, see :py:func:`get_code_version`. Computed on the first command, as it stats every module.
+        self.version = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def start_launcher(self):
+        """Start the launcher process unless another web server process just did it.
+
+        :return: Connected socket
+        """
+        with open(self.socket_path + ".lock", "wt") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                return self.connect()
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+
+            cmd = [self.python, os.path.abspath(__file__), self.socket_path]
+            logger.info("Starting notebook launcher: %s", " ".join(cmd))
+
+            log = open(self.socket_path + ".log", "ab")
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True, close_fds=True)
+            log.close()
+
+            deadline = time.monotonic() + self.startup_timeout
+            while True:
+                try:
+                    return self.connect()
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("Notebook launcher did not start listening on {}, see {}.log".format(self.socket_path, self.socket_path))
+                    time.sleep(0.05)
+
+    def request(self, sock, argv, env):
+        """Send one command to the launcher and read its reply."""
+        try:
+            sock.sendall(json.dumps({"argv": [str(arg) for arg in argv], "env": env, "version": self.version}).encode("utf-8"))
+            sock.shutdown(socket.SHUT_WR)
+            data = read_all(sock)
+        finally:
+            sock.close()
+
+        if not data:
+            raise RuntimeError("Notebook launcher closed connection without reply")
+
+        return json.loads(data.decode("utf-8"))
+
+    def run(self, argv, env=None):
+        """Run notebook_daemon.py with given arguments.
+
+        A launcher running other code than what was on disk when we sent our first command is replaced first.
+
+        :param argv: Command line as in ``sys.argv``
+
+        :param env: Environment variables of the command, defaults to ours
+
+        :return: tuple (exit code, stdout bytes, stderr bytes)
+        """
+        if self.version is None:
+            self.version = get_code_version()
+
+        if env is None:
+            env = dict(os.environ)
+
+        try:
+            sock = self.connect()
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock = self.start_launcher()
+
+        reply = self.request(sock, argv, env)
+        if reply.get("stale"):
+            logger.info("Notebook launcher on %s runs outdated code, restarting it", self.socket_path)
+            reply = self.request(self.start_launcher(), argv, env)
+            if reply.get("stale"):
+                raise RuntimeError("Notebook launcher on {} does not run the code on disk".format(self.socket_path))
+
+        return reply["returncode"], reply["stdout"].encode("utf-8"), reply["stderr"].encode("utf-8")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("Usage: {} socket_path".format(sys.argv[0]))
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    serve(sys.argv[1])
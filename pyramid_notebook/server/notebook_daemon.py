@@ -1,13 +1,17 @@
 """Daemonized Python Notebook process with pre-allocated port, kill timeout and extra argument passing through JSON file."""
 # Standard Library
 import atexit
+import cProfile
 import faulthandler
 import io
+import json
 import logging
 import os
+import resource
 import shutil
 import signal
 import sys
+import threading
 import time
 from pathlib import Path
 
@@ -33,6 +37,43 @@ port = None
 kill_timeout = None
 extra_argv = None
 pid_file = None
+daemon = None
+
+#: How often a pooled daemon checks whether it has been claimed, in seconds
+POOL_CLAIM_POLL_INTERVAL = 0.05
+
+#: Environment variable naming a file where the daemon dumps cProfile stats of its startup. ``{pid}`` in the name is replaced with the process id.
+PROFILE_ENV = "PYRAMID_NOTEBOOK_PROFILE"
+
+#: Launch phase -> time.time() when it was reached, saved in the context file as ``timings``
+timings = {}
+
+profiler = None
+
+
+def mark(phase):
+    """Record the time a launch phase was reached."""
+    timings[phase] = time.time()
+
+
+def start_profiler():
+    """Start profiling if asked to in the environment."""
+    global profiler
+    if os.environ.get(PROFILE_ENV):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(dump_profile)
+
+
+def dump_profile():
+    """Write out startup profile, once."""
+    global profiler
+    if profiler:
+        profiler.disable()
+        fname = os.environ[PROFILE_ENV].format(pid=os.getpid())
+        profiler.dump_stats(fname)
+        print("Dumped startup profile to {}".format(fname), file=sys.stderr)
+        profiler = None
 
 
 class NotebookDaemon(daemonocle.Daemon):
@@ -113,8 +154,82 @@ def create_named_notebook(fname, context):
         writer.write(nb, f)
 
 
+def apply_resource_limits(context):
+    """Cap memory and CPU time of the Notebook server and the kernels it starts.
+
+    Limits are inherited by child processes, but each process is limited on its own. RLIMIT_CPU counts CPU seconds over the whole life of a process, so a CPU limit must leave room for a long-running Notebook server, not only for a runaway kernel.
+    """
+    memory_limit = context.get("memory_limit")
+    if memory_limit:
+        # Address space, not RSS, as Linux does not enforce RLIMIT_RSS
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    cpu_limit = context.get("cpu_limit")
+    if cpu_limit:
+        # Process gets SIGXCPU, which kills it, after this many CPU seconds
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
+
+
+def sample_process_tree(root, procs):
+    """Add up resource usage of a process and all its descendants.
+
+    :param procs: pid -> psutil.Process from the previous sample. CPU percentage is measured since the previous sample of the same process object.
+
+    :return: dict of stats
+    """
+    stats = {"rss": 0, "cpu_percent": 0.0, "cpu_time": 0.0, "num_fds": 0, "processes": 0}
+
+    try:
+        tree = [root] + root.children(recursive=True)
+    except psutil.Error:
+        tree = [root]
+
+    seen = {}
+    for proc in tree:
+        cached = procs.get(proc.pid)
+        if cached is not None and cached == proc:
+            proc = cached
+
+        try:
+            with proc.oneshot():
+                rss = proc.memory_info().rss
+                cpu_percent = proc.cpu_percent()
+                cpu_times = proc.cpu_times()
+                num_fds = proc.num_fds()
+        except psutil.Error:
+            # Kernel exited while we were looking
+            continue
+
+        stats["rss"] += rss
+        stats["cpu_percent"] += cpu_percent
+        stats["cpu_time"] += cpu_times.user + cpu_times.system
+        stats["num_fds"] += num_fds
+        stats["processes"] += 1
+        seen[proc.pid] = proc
+
+    procs.clear()
+    procs.update(seen)
+    stats["sampled_at"] = time.time()
+    return stats
+
+
+def run_stats_sampler(fname, interval):
+    """Write resource usage of our process tree to a JSON file every interval seconds."""
+    root = psutil.Process()
+    procs = {}
+    while True:
+        try:
+            comm.write_json(fname, sample_process_tree(root, procs))
+        except Exception as e:
+            print("Could not write stats: {}".format(e), file=sys.stderr)
+        time.sleep(interval)
+
+
 def run_notebook(foreground=False):
 
+    # Pooled daemons got here long before they were claimed
+    timings.setdefault("daemonized", time.time())
+
     if not foreground:
         # Make it possible to get output what daemonized IPython is doing
         sys.stdout = io.open("notebook.stdout.log", "wt")
@@ -128,6 +243,79 @@ def run_notebook(foreground=False):
         raise
 
 
+def wait_for_claim():
+    """Preload Notebook and wait until the web server hands us to a user.
+
+    See :py:mod:`pyramid_notebook.pool` for the other side of the protocol.
+
+    :return: claim dict or None if nobody claimed us within kill timeout
+    """
+    # Pay the import price before anybody is waiting for us
+    import IPython  # noQA
+    from nbformat import v4  # noQA
+    from traitlets.config.loader import Config  # noQA
+    try:
+        import notebook.notebookapp  # noQA
+    except ImportError:
+        pass
+
+    ready = {"pid": os.getpid(), "http_port": port}
+    comm.write_json("ready", ready)
+
+    print("Pooled daemon ready on port {}".format(port), file=sys.stderr)
+
+    deadline = time.time() + kill_timeout
+    while time.time() < deadline:
+        if os.path.exists("claim.json"):
+            with open("claim.json", "rt") as f:
+                return json.loads(f.read())
+        time.sleep(POOL_CLAIM_POLL_INTERVAL)
+
+    return None
+
+
+def bind_to_claim(claim):
+    """Turn this pooled daemon into the named notebook daemon of a user."""
+    global pid_file
+
+    slot_folder = os.getcwd()
+    pid_file = claim["pid_file"]
+    os.chdir(claim["work_folder"])
+
+    # Move our PID file to where NotebookManager looks for it, daemonocle removes it on exit
+    daemon._close_pidfile()
+    daemon._pid_fd = None
+    if os.path.exists(pid_file):
+        os.remove(pid_file)
+    daemon.pidfile = pid_file
+    daemon._write_pidfile()
+
+    shutil.rmtree(slot_folder, ignore_errors=True)
+
+
+def run_pooled_notebook():
+    """Daemon worker for a prestarted pool member."""
+    mark("daemonized")
+
+    # Make it possible to get output what daemonized IPython is doing
+    sys.stdout = io.open("notebook.stdout.log", "wt")
+    sys.stderr = io.open("notebook.stderr.log", "wt")
+
+    try:
+        claim = wait_for_claim()
+    except Exception:
+        import traceback
+        traceback.print_exc(file=sys.stderr)
+        raise
+
+    if not claim:
+        sys.exit("Pooled daemon was not claimed within {} seconds".format(kill_timeout))
+
+    mark("claimed")
+    bind_to_claim(claim)
+    run_notebook()
+
+
 def _run_notebook(foreground=False):
 
     print("Starting notebook, daemon {}".format(not foreground), file=sys.stderr)
@@ -181,9 +369,19 @@ def _run_notebook(foreground=False):
     context["kill_timeout"] = kill_timeout
     context["notebook_name"] = notebook_name
 
+    context.setdefault("timings", {}).update(timings)
+
     comm.set_context(pid_file, context)
 
+    apply_resource_limits(context)
+
+    stats_interval = context.get("stats_interval")
+    if stats_interval:
+        stats_file = os.path.join(os.path.dirname(pid_file), "stats.json")
+        threading.Thread(target=run_stats_sampler, args=(stats_file, stats_interval), name="notebook-stats", daemon=True).start()
+
     create_named_notebook(notebook_name, context)
+    mark("notebook_created")
 
     # Grind through with print as IPython launcher would mess our loggers
     print("Launching on localhost:{}, having context {}".format(port, str(context)), file=sys.stderr)
@@ -191,6 +389,7 @@ def _run_notebook(foreground=False):
     try:
         import IPython
         from traitlets.config.loader import Config
+        mark("ipython_imported")
 
         # http://jupyter-notebook.readthedocs.io/en/latest/config.html
         config = Config()
@@ -230,6 +429,16 @@ def _run_notebook(foreground=False):
         # We work around this by having custom folder in static paths
         config.NotebookApp.extra_template_paths = [custom_static_folder]
 
+        # Save the timings of phases so far, the web server records when Notebook starts answering
+        mark("app_starting")
+        context["timings"].update(timings)
+        comm.set_context(pid_file, context)
+
+        if profiler:
+            # Include Notebook application setup up to the point its event loop runs
+            from tornado.ioloop import IOLoop
+            IOLoop.current().add_callback(dump_profile)
+
         IPython.start_ipython(argv=argv, config=config)
 
     except Exception as e:
@@ -242,18 +451,28 @@ def clear_context(*args):
     comm.clear_context(pid_file)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        sys.exit("Usage: {} start|stop|status|fg pid_file [work_folder] [notebook port] [kill timeout in seconds] *extra_args")
+def main(argv):
+    """Run a daemon action.
+
+    :param argv: Command line as in ``sys.argv``. Called by :py:mod:`pyramid_notebook.server.launcher` in a forked process, or when this script is executed.
+    """
+    global port, kill_timeout, extra_argv, pid_file, daemon
+
+    timings["process_created"] = psutil.Process().create_time()
+    mark("main")
+    start_profiler()
+
+    if len(argv) == 1:
+        sys.exit("Usage: {} start|stop|status|fg|pool pid_file [work_folder] [notebook port] [kill timeout in seconds] *extra_args")
 
-    action = sys.argv[1]
-    pid_file = sys.argv[2]
+    action = argv[1]
+    pid_file = argv[2]
 
-    if action in ("start", "restart", "fg"):
-        workdir = sys.argv[3]
-        port = int(sys.argv[4])
-        kill_timeout = int(sys.argv[5])
-        extra_argv = sys.argv[6:]
+    if action in ("start", "restart", "fg", "pool"):
+        workdir = argv[3]
+        port = int(argv[4])
+        kill_timeout = int(argv[5])
+        extra_argv = argv[6:]
     else:
         workdir = os.getcwd()
 
@@ -277,5 +496,14 @@ if __name__ == '__main__':
         faulthandler.enable(f)
 
         daemon = NotebookDaemon(pidfile=pid_file, workdir=workdir, shutdown_callback=shutdown)
-        daemon.worker = run_notebook
-        daemon.do_action(action)
+        if action == "pool":
+            # Prestarted daemon waiting in the pool to be claimed by a user
+            daemon.worker = run_pooled_notebook
+            daemon.do_action("start")
+        else:
+            daemon.worker = run_notebook
+            daemon.do_action(action)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
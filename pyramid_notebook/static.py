@@ -0,0 +1,153 @@
+"""Serve Notebook static files without going through the user's Notebook server.
+
+Notebook pages load hundreds of static files, which are the same for every user. Serving them from the web server process saves a context lookup and an HTTP round trip to the Notebook server for each. Files we cannot find here are proxied as before.
+
+Notebook serves ``static/custom/*`` from ``.jupyter/custom`` in the config folder of the daemon, which we look at first, and everything else under ``static/`` from the static folder of the installed notebook package.
+"""
+# Standard Library
+import hashlib
+import mimetypes
+import os
+import threading
+
+# Pyramid
+from pyramid.response import FileResponse
+from pyramid.response import Response
+
+
+#: Seconds browsers may cache versioned static files, i.e. ones requested with ``?v=`` query
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+#: Supported values for ``pyramid_notebook.static_sendfile`` setting
+SENDFILE_HEADERS = {
+    "x-accel-redirect": "X-Accel-Redirect",
+    "x-sendfile": "X-Sendfile",
+}
+
+_static_root = None
+_static_root_resolved = False
+
+#: path -> (file key, ETag)
+_etags = {}
+_etags_lock = threading.Lock()
+
+
+def get_notebook_static_root():
+    """Get the static folder of the installed notebook package.
+
+    :return: Path or None if notebook is not importable in this process
+    """
+    global _static_root, _static_root_resolved
+
+    if not _static_root_resolved:
+        try:
+            import notebook
+        except ImportError:
+            path = None
+        else:
+            path = getattr(notebook, "DEFAULT_STATIC_FILES_PATH", None) or os.path.join(os.path.dirname(notebook.__file__), "static")
+            if not os.path.isdir(path):
+                path = None
+
+        _static_root = path
+        _static_root_resolved = True
+
+    return _static_root
+
+
+def find_file(root, parts):
+    """Map URL path segments to a file inside root.
+
+    :return: Path or None if there is no such file or the path would escape root
+    """
+    if not root or not parts:
+        return None
+
+    for part in parts:
+        if part in ("", ".", "..") or "/" in part or "\0" in part:
+            return None
+
+    path = os.path.join(root, *parts)
+    if not os.path.isfile(path):
+        return None
+
+    # No following symlinks out of root
+    real_root = os.path.realpath(root)
+    if not os.path.realpath(path).startswith(real_root + os.sep):
+        return None
+
+    return path
+
+
+def find_static_file(parts, static_root, custom_folder):
+    """Find the file Notebook would serve for ``static/<parts>``.
+
+    :param parts: URL path segments after ``static``
+
+    :param static_root: Static folder of the notebook package
+
+    :param custom_folder: ``.jupyter/custom`` folder of the user's Notebook daemon
+    """
+    if parts and parts[0] == "custom":
+        path = find_file(custom_folder, parts[1:])
+        if path:
+            return path
+
+    return find_file(static_root, parts)
+
+
+def get_etag(path, stat):
+    """Strong ETag from file contents, computed once per file version."""
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _etags.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    etag = h.hexdigest()
+
+    with _etags_lock:
+        _etags[path] = (key, etag)
+    return etag
+
+
+def get_static_response(request, parts, static_root, custom_folder, sendfile=None, accel_prefix="/"):
+    """Build a response for a Notebook static file.
+
+    :param parts: URL path segments after ``static``
+
+    :param sendfile: None to send the file ourselves, ``x-accel-redirect`` or ``x-sendfile`` to let the front end web server send it
+
+    :param accel_prefix: Internal nginx location whose alias is the file system root, used with ``x-accel-redirect``
+
+    :return: Response or None if we do not have the file and the request should be proxied
+    """
+    path = find_static_file(parts, static_root, custom_folder)
+    if not path:
+        return None
+
+    stat = os.stat(path)
+    content_type, encoding = mimetypes.guess_type(path)
+
+    if sendfile:
+        response = Response(content_type=content_type or "application/octet-stream")
+        value = accel_prefix.rstrip("/") + path if sendfile == "x-accel-redirect" else path
+        response.headers[SENDFILE_HEADERS[sendfile]] = value
+    else:
+        response = FileResponse(path, request=request, content_type=content_type or "application/octet-stream")
+
+    response.etag = get_etag(path, stat)
+    response.last_modified = stat.st_mtime
+
+    if "v" in request.GET:
+        # Notebook puts its version hash in static URLs, so these never change
+        response.cache_control = "public, max-age={}, immutable".format(STATIC_MAX_AGE)
+    else:
+        response.cache_control = "no-cache"
+
+    # Answer If-None-Match with 304
+    response.conditional_response = True
+    return response
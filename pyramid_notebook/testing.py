@@ -0,0 +1,80 @@
+"""Testing helpers.
+
+A stand-in for the ``uwsgi`` module, which only exists inside a uWSGI server, lets the websocket proxy run in tests and ``benchmarks/proxy_benchmark.py``.
+"""
+# Standard Library
+import collections
+import queue
+import socket
+import sys
+import types
+
+
+class FakeUwsgi(types.ModuleType):
+    """Stand-in for the ``uwsgi`` module with one downstream websocket.
+
+    The test plays the browser with :meth:`browser_send` and :meth:`browser_recv`. A socket pair wakes up the proxy loop like uWSGI's connection fd would.
+    """
+
+    def __init__(self):
+        super().__init__("uwsgi")
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.reset()
+
+    def reset(self):
+        """Forget frames and errors of the previous connection."""
+        self.incoming = collections.deque()
+        self.outgoing = queue.Queue()
+        self.error = None
+
+    def connection_fd(self):
+        return self.wake_r.fileno()
+
+    def websocket_recv_nb(self):
+        try:
+            self.wake_r.recv(4096)
+        except BlockingIOError:
+            pass
+
+        if self.error:
+            raise self.error
+
+        try:
+            return self.incoming.popleft()
+        except IndexError:
+            return b""
+
+    def websocket_send(self, data):
+        self.outgoing.put((data, False))
+
+    def websocket_send_binary(self, data):
+        self.outgoing.put((data, True))
+
+    def browser_send(self, data):
+        self.incoming.append(data)
+        self.wake_w.send(b"x")
+
+    def browser_recv_frame(self, timeout=10):
+        """:return: tuple (payload, binary flag) of the next frame sent to the browser"""
+        return self.outgoing.get(timeout=timeout)
+
+    def browser_recv(self, timeout=10):
+        return self.browser_recv_frame(timeout)[0]
+
+    def browser_disconnect(self, error):
+        """Make the next receive fail like uWSGI does when the browser has gone away."""
+        self.error = error
+        self.wake_w.send(b"x")
+
+
+def install_fake_uwsgi():
+    """Put the fake in place of ``uwsgi`` module, before anything imports :py:mod:`pyramid_notebook.uwsgi`.
+
+    :return: The fake, cleared of earlier frames
+    """
+    fake = sys.modules.get("uwsgi")
+    if not isinstance(fake, FakeUwsgi):
+        fake = sys.modules["uwsgi"] = FakeUwsgi()
+    fake.reset()
+    return fake
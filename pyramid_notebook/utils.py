@@ -1,24 +1,37 @@
 # Standard Library
-import copy
+import hashlib
+import json
 import os
 import os.path
+import threading
+
+
+def canonicalize(o):
+    """Turn a nested structure to JSON serializable form where equal structures serialize the same.
+
+    Sets are sorted and tuples become lists. Dictionary keys are sorted by JSON encoder.
+    """
+    if isinstance(o, dict):
+        return {k if isinstance(k, str) else repr(k): canonicalize(v) for k, v in o.items()}
+    elif isinstance(o, (tuple, list)):
+        return [canonicalize(e) for e in o]
+    elif isinstance(o, (set, frozenset)):
+        items = [canonicalize(e) for e in o]
+        return sorted(items, key=lambda e: json.dumps(e, sort_keys=True, default=repr))
+    return o
 
 
-# Courtesy of http://stackoverflow.com/questions/5884066/hashing-a-python-dictionary
 def make_dict_hash(o):
     """Make a hash from a dictionary, list, tuple or set to any level, containing
     only other hashable types (including any lists, tuples, sets, and dictionaries).
-    """
-    if isinstance(o, (set, tuple, list)):
-        return tuple([make_dict_hash(e) for e in o])
-    elif not isinstance(o, dict):
-        return hash(o)
 
-    new_o = copy.deepcopy(o)
-    for k, v in new_o.items():
-        new_o[k] = make_dict_hash(v)
+    The hash is a digest of the canonical JSON form of the data. Unlike built-in ``hash()``, which is randomized per interpreter for strings, it is the same in every web server process and across restarts.
 
-    return hash(tuple(frozenset(sorted(new_o.items()))))
+    :return: Non-negative int which fits in 63 bits
+    """
+    data = json.dumps(canonicalize(o), sort_keys=True, separators=(",", ":"), default=repr)
+    digest = hashlib.sha1(data.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") >> 1
 
 
 class change_directory:
@@ -73,3 +86,58 @@ def route_to_alt_domain(request, url):
         url = url.replace(request.host_url, alternative_domain)
 
     return url
+
+
+class ProcessThread:
+    """Background daemon thread running once in each process.
+
+    Threads do not survive fork. uWSGI loads the application in its master process and forks the workers from it, so a thread started while loading is not running in any worker. :meth:`start` is cheap when the thread already runs, so it can be called on every use, and it starts the thread again in a forked process.
+    """
+
+    def __init__(self, target, name):
+        """
+        :param target: Loop run in the thread
+
+        :param name: Thread name
+        """
+        self.target = target
+        self.name = name
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def is_running(self):
+        """Check if the thread runs in this process."""
+        return self.pid == os.getpid() and self.thread.is_alive()
+
+    def start(self):
+        """Start the thread, if not running in this process yet."""
+        if self.is_running():
+            return
+
+        with self.lock:
+            if self.is_running():
+                return
+
+            self.thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+
+
+
+def run_after_fork(func):
+    """Call a function in each web server worker process.
+
+    Under uWSGI the function is run by a postfork hook when the application is loaded in the master, or right away when it is loaded in a worker with ``lazy-apps``. Other web servers are assumed not to fork after loading the application.
+    """
+    try:
+        import uwsgi
+        from uwsgidecorators import postfork
+    except ImportError:
+        func()
+        return
+
+    if uwsgi.worker_id():
+        func()
+    else:
+        postfork(func)
@@ -1,7 +1,9 @@
 """UWSGI websocket proxy."""
 # Standard Library
+import codecs
 import logging
-import time
+import selectors
+import types
 from urllib.parse import urlparse
 from urllib.parse import urlunparse
 
@@ -9,11 +11,13 @@ from urllib.parse import urlunparse
 from pyramid import httpexceptions
 
 # Third Party
+import ws4py.streaming
 from ws4py import WS_VERSION
 from ws4py.client import WebSocketBaseClient
 
 # Pyramid Notebook
 import uwsgi
+from pyramid_notebook import metrics
 
 
 #: HTTP headers we need to proxy to upstream websocket server when the Connect: upgrade is performed
@@ -23,9 +27,84 @@ CAPTURE_CONNECT_HEADERS = ["sec-websocket-extensions", "sec-websocket-key", "ori
 logger = logging.getLogger(__name__)
 
 
+#: Selector keys telling which side of the proxy has data
+UPSTREAM = "upstream"
+DOWNSTREAM = "downstream"
+
+
+class Utf8Validator:
+    """Drop-in replacement for ws4py's pure Python UTF-8 validator.
+
+    ws4py walks every byte of every incoming text frame through a Python level state machine, which takes seconds for multi-megabyte notebook outputs. This gives the same answers using the incremental C decoder.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.i = 0
+
+    def validate(self, ba):
+        """Incrementally validate a chunk of bytes.
+
+        :return: quad (valid?, ends on code point?, current index, total index) like ws4py's validator
+        """
+        try:
+            self.decoder.decode(ba)
+        except UnicodeDecodeError as e:
+            self.i += e.start
+            return False, False, e.start, self.i
+
+        self.i += len(ba)
+        pending, _ = self.decoder.getstate()
+        return True, not pending, len(ba), self.i
+
+
+class ProxyStream(ws4py.streaming.Stream):
+    """ws4py stream parser validating text frames with :py:class:`Utf8Validator`.
+
+    ``Stream.receiver()`` instantiates the validator by looking up the ``Utf8Validator`` global of its module. We run the same generator code against a copy of the module globals, so other ws4py users in the process keep the stock validator.
+    """
+
+    receiver = types.FunctionType(
+        ws4py.streaming.Stream.receiver.__code__,
+        dict(vars(ws4py.streaming), Utf8Validator=Utf8Validator),
+        "receiver")
+
+
+def is_text_payload(data):
+    """Guess the frame type of a downstream message.
+
+    uWSGI does not tell us the opcode of the frames it receives. Jupyter text frames are JSON, which never contains raw NUL bytes, while its binary frames start with a big-endian buffer count.
+    """
+    if b"\x00" in data:
+        return False
+
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
 class ProxyClient(WebSocketBaseClient):
     """Proxy between upstream WebSocket server and downstream UWSGI."""
 
+    #: How many bytes we read from the upstream socket when it becomes readable
+    upstream_read_size = 65536
+
+    #: Max seconds to wait for data before calling uWSGI anyway, so that it gets a chance to ping the browser and notice dead connections
+    poll_timeout = 5.0
+
+    #: Optional callback telling that frames are moving, set from ``pyramid_notebook.on_activity`` WSGI environ key
+    on_activity = None
+
+    def __init__(self, *args, **kwargs):
+        super(ProxyClient, self).__init__(*args, **kwargs)
+        # Client side masking like WebSocketBaseClient sets up for its own stream
+        self.stream = ProxyStream(always_mask=True, expect_masking=False)
+
     @property
     def handshake_headers(self):
         """
@@ -52,12 +131,24 @@ class ProxyClient(WebSocketBaseClient):
         return headers
 
     def received_message(self, m):
-        """Push upstream messages to downstream."""
+        """Push upstream messages to downstream.
 
-        # TODO: No support for binary messages
-        m = str(m)
-        logger.debug("Incoming upstream WS: %s", m)
-        uwsgi.websocket_send(m)
+        Payload is relayed as raw bytes in the frame type it arrived in.
+        """
+        data = m.data
+        if type(data) is not bytes:
+            # Reassembled from fragments, see relay_upstream()
+            data = bytes(data)
+
+        metrics.inc("pyramid_notebook_websocket_frames_total", direction=DOWNSTREAM)
+        metrics.inc("pyramid_notebook_websocket_bytes_total", len(data), direction=DOWNSTREAM)
+
+        if m.is_binary:
+            logger.debug("Incoming upstream binary WS: %d bytes", len(data))
+            uwsgi.websocket_send_binary(data)
+        else:
+            logger.debug("Incoming upstream WS: %d bytes", len(data))
+            uwsgi.websocket_send(data)
         logger.debug("Send ok")
 
     def handshake_ok(self):
@@ -65,47 +156,87 @@ class ProxyClient(WebSocketBaseClient):
         Called when the upgrade handshake has completed
         successfully.
 
-        Starts the client's thread.
+        The relay loop is started by :func:`serve_websocket` after ws4py has processed any frames that arrived together with the handshake response.
         """
-        self.run()
 
     def terminate(self):
         super(ProxyClient, self).terminate()
 
+    def relay_downstream(self):
+        """Forward all pending downstream frames to upstream.
+
+        uWSGI may have read several frames from the socket into its own buffer, so we keep asking until it has nothing more to give.
+        """
+        while True:
+            msg = uwsgi.websocket_recv_nb()
+            if not msg:
+                return
+            binary = not is_text_payload(msg)
+            metrics.inc("pyramid_notebook_websocket_frames_total", direction=UPSTREAM)
+            metrics.inc("pyramid_notebook_websocket_bytes_total", len(msg), direction=UPSTREAM)
+            logger.debug("Incoming downstream WS: %d bytes, binary: %s", len(msg), binary)
+            self.send(msg, binary=binary)
+
+    def relay_upstream(self):
+        """Read available bytes from upstream and push every complete frame in them downstream.
+
+        :return: False if the upstream connection was closed
+        """
+        data = self.sock.recv(self.upstream_read_size)
+        if not data:
+            return False
+
+        buf = self.buf + data if self.buf else data
+        self.buf = b''
+
+        # Feed the parser the exact number of bytes it asks for, so that one read may yield any number of frames
+        offset = 0
+        while offset < len(buf):
+            requested = self.reading_buffer_size
+            if not self.process(buf[offset:offset + requested]):
+                return False
+            offset += requested
+
+            # ws4py concatenates continuation frames to immutable bytes, copying the whole message for every fragment.
+            # Swap in a bytearray so that fragments of a large message get appended in place.
+            m = self.stream.message
+            if m is not None and not m.completed and type(m.data) is bytes:
+                m.data = bytearray(m.data)
+
+        return True
+
     def run(self):
         """Combine async uwsgi message loop with ws4py message loop.
 
-        TODO: This could do some serious optimizations and behave asynchronously correct instead of just sleep().
+        Sleep until either the upstream socket or the downstream uWSGI websocket becomes readable and then relay everything pending on both sides.
         """
-
-        self.sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        metrics.add("pyramid_notebook_websocket_connections", 1)
         try:
-            while not self.terminated:
-                logger.debug("Doing nothing")
-                time.sleep(0.050)
+            selector.register(self.sock, selectors.EVENT_READ, UPSTREAM)
+            selector.register(uwsgi.connection_fd(), selectors.EVENT_READ, DOWNSTREAM)
 
-                logger.debug("Asking for downstream msg")
-                msg = uwsgi.websocket_recv_nb()
-                if msg:
-                    logger.debug("Incoming downstream WS: %s", msg)
-                    self.send(msg)
+            self.opened()
+
+            while not self.terminated:
+                events = selector.select(self.poll_timeout)
 
-                s = self.stream
+                if events and self.on_activity:
+                    self.on_activity()
 
-                self.opened()
+                # Drain downstream on every wakeup, as uWSGI buffers frames internally and handles pings inside recv
+                self.relay_downstream()
 
-                logger.debug("Asking for upstream msg {s}".format(s=s))
-                try:
-                    bytes = self.sock.recv(self.reading_buffer_size)
-                    if bytes:
-                        self.process(bytes)
-                except BlockingIOError:
-                    pass
+                if any(key.data == UPSTREAM for key, mask in events):
+                    if not self.relay_upstream():
+                        break
 
         except Exception as e:
             logger.exception(e)
         finally:
             logger.info("Terminating WS proxy loop")
+            selector.close()
+            metrics.add("pyramid_notebook_websocket_connections", -1)
             self.terminate()
 
 
@@ -127,7 +258,9 @@ def serve_websocket(request, port):
     logger.info("Connecting to upstream websockets: %s, headers: %s", url, headers)
 
     ws = ProxyClient(url, headers=headers)
+    ws.on_activity = env.get("pyramid_notebook.on_activity")
     ws.connect()
+    ws.run()
 
     # TODO: Will complain loudly about already send headers - how to abort?
     return httpexceptions.HTTPOk()
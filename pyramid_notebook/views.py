@@ -1,15 +1,24 @@
 # Standard Library
+import functools
+import json
 import logging
 import os
+import threading
 
 # Pyramid
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPInternalServerError
+from pyramid.response import Response
+from pyramid.settings import asbool
 from pyramid.util import DottedNameResolver
 
 # Pyramid Notebook
+from pyramid_notebook import metrics
 from pyramid_notebook.notebookmanager import NotebookManager
 from pyramid_notebook.proxy import WSGIProxyApplication
+from pyramid_notebook.proxy import get_response_cache
+from pyramid_notebook.static import get_notebook_static_root
+from pyramid_notebook.static import get_static_response
 from pyramid_notebook.utils import make_dict_hash
 from pyramid_notebook.utils import route_to_alt_domain
 
@@ -17,10 +26,60 @@ from pyramid_notebook.utils import route_to_alt_domain
 logger = logging.getLogger(__name__)
 
 
+#: Page shown while a notebook is being launched on the background, see launch_notebook_async()
+LAUNCH_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Starting notebook</title>
+</head>
+<body>
+<p id="message">Starting IPython Notebook, please wait...</p>
+<script>
+(function() {{
+    var statusUrl = {status_url};
+    function poll() {{
+        var xhr = new XMLHttpRequest();
+        xhr.open("GET", statusUrl);
+        xhr.onload = function() {{
+            var status = xhr.status == 200 ? JSON.parse(xhr.responseText) : {{status: "starting"}};
+            if (status.status == "ready") {{
+                window.location.replace(status.url);
+            }} else if (status.status == "failed") {{
+                document.getElementById("message").textContent = "Could not start IPython Notebook: " + status.message;
+            }} else {{
+                setTimeout(poll, 500);
+            }}
+        }};
+        xhr.onerror = function() {{
+            setTimeout(poll, 2000);
+        }};
+        xhr.send();
+    }}
+    poll();
+}})();
+</script>
+</body>
+</html>
+"""
+
+
+#: Guards creating a manager for applications which do not include pyramid_notebook
+_manager_lock = threading.Lock()
+
+
 def get_notebook_manager(request):
-    settings = request.registry.settings
-    notebook_folder = settings["pyramid_notebook.notebook_folder"]
-    manager = NotebookManager(notebook_folder)
+    """Get the notebook manager shared by all requests.
+
+    The manager is set up by ``config.include("pyramid_notebook")``. If the application has not included us, the manager is created on the first call.
+    """
+    registry = request.registry
+    manager = getattr(registry, "notebook_manager", None)
+    if manager is None:
+        with _manager_lock:
+            manager = getattr(registry, "notebook_manager", None)
+            if manager is None:
+                manager = registry.notebook_manager = NotebookManager.from_settings(registry.settings)
     return manager
 
 
@@ -40,7 +99,13 @@ def proxy_it(request, port):
             # If we run on localhost on pserve, we should never hit here as requests go directly to IPython Notebook kernel, not us
             raise RuntimeError("Websocket proxy support is not configured.")
 
-    proxy_app = WSGIProxyApplication(port)
+    settings = request.registry.settings
+    pool_size = int(settings.get("pyramid_notebook.proxy_pool_size", 8))
+    pool_idle_timeout = float(settings.get("pyramid_notebook.proxy_pool_idle_timeout", 30))
+    chunk_size = int(settings.get("pyramid_notebook.proxy_chunk_size", 65536))
+    cache_size = int(settings.get("pyramid_notebook.proxy_cache_size", 0))
+    cache = get_response_cache(cache_size) if cache_size else None
+    proxy_app = WSGIProxyApplication(port, pool_size=pool_size, pool_idle_timeout=pool_idle_timeout, chunk_size=chunk_size, cache=cache)
 
     return request.get_response(proxy_app)
 
@@ -93,21 +158,12 @@ def prepare_notebook_context(request, notebook_context):
     print(notebook_context)
 
 
-def launch_on_demand(request, username, notebook_context):
-    """See if we have notebook already running this context and if not then launch new one."""
-    security_check(request, username)
-
-    settings = request.registry.settings
-
-    notebook_folder = settings.get("pyramid_notebook.notebook_folder", None)
-    if not notebook_folder:
-        raise RuntimeError("Setting missing: pyramid_notebook.notebook_folder")
-
-    kill_timeout = settings.get("pyramid_notebook.kill_timeout", None)
-    if not kill_timeout:
-        raise RuntimeError("Setting missing: pyramid_notebook.kill_timeout")
+def prepare_launch(request, username, notebook_context):
+    """Get notebook manager and fill in notebook context for launching a notebook.
 
-    kill_timeout = int(kill_timeout)
+    :return: tuple (NotebookManager, notebook context dict)
+    """
+    security_check(request, username)
 
     if not notebook_context:
         notebook_context = {}
@@ -118,15 +174,6 @@ def launch_on_demand(request, username, notebook_context):
 
     # Furious invalid state follows if we let this slip through
     assert type(notebook_context["extra_template_paths"]) == list, "Got bad extra_template_paths {}".format(notebook_context["extra_template_paths"])
-    notebook_folder = settings.get("pyramid_notebook.notebook_folder", None)
-    if not notebook_folder:
-        raise RuntimeError("Setting missing: pyramid_notebook.notebook_folder")
-
-    kill_timeout = settings.get("pyramid_notebook.kill_timeout", None)
-    if not kill_timeout:
-        raise RuntimeError("Setting missing: pyramid_notebook.kill_timeout")
-
-    kill_timeout = int(kill_timeout)
 
     prepare_notebook_context(request, notebook_context)
 
@@ -147,11 +194,42 @@ def launch_on_demand(request, username, notebook_context):
     if "context_hash" not in notebook_context:
         notebook_context["context_hash"] = make_dict_hash(notebook_context)
 
-    manager = NotebookManager(notebook_folder, kill_timeout=kill_timeout)
+    manager = get_notebook_manager(request)
+    return manager, notebook_context
+
+
+def launch_on_demand(request, username, notebook_context):
+    """See if we have notebook already running this context and if not then launch new one."""
+    manager, notebook_context = prepare_launch(request, username, notebook_context)
     notebook_info, creates = manager.start_notebook_on_demand(username, notebook_context)
     return notebook_info
 
 
+def serve_static(request, manager, username):
+    """Serve Notebook static files ourselves if ``pyramid_notebook.serve_static`` is on.
+
+    :return: Response or None if the request should be proxied to the Notebook server
+    """
+    settings = request.registry.settings
+    if not asbool(settings.get("pyramid_notebook.serve_static", False)):
+        return None
+
+    parts = (request.matchdict or {}).get("remainder", ())
+    if not parts or parts[0] != "static":
+        return None
+
+    static_root = settings.get("pyramid_notebook.static_path", "").strip() or get_notebook_static_root()
+    custom_folder = os.path.join(manager.get_work_folder(username), ".jupyter", "custom")
+
+    sendfile = settings.get("pyramid_notebook.static_sendfile", "").strip().lower() or None
+    accel_prefix = settings.get("pyramid_notebook.static_accel_prefix", "/_notebook_files/")
+
+    response = get_static_response(request, parts[1:], static_root, custom_folder, sendfile=sendfile, accel_prefix=accel_prefix)
+    if response is not None:
+        metrics.inc("pyramid_notebook_static_requests_total")
+    return response
+
+
 def notebook_proxy(request, username):
     """Renders a IPython Notebook frame wrapper.
 
@@ -160,6 +238,11 @@ def notebook_proxy(request, username):
     security_check(request, username)
 
     manager = get_notebook_manager(request)
+
+    response = serve_static(request, manager, username)
+    if response is not None:
+        return response
+
     notebook_info = manager.get_context(username)
 
     if not notebook_info:
@@ -168,23 +251,77 @@ def notebook_proxy(request, username):
     if 'http_port' not in notebook_info:
         raise RuntimeError("Notebook terminated prematurely before managed to tell us its HTTP port")
 
+    # Keep the notebook from being culled as idle, see pyramid_notebook.idle_timeout
+    manager.touch_activity(username)
+    request.environ["pyramid_notebook.on_activity"] = functools.partial(manager.touch_activity, username)
+    request.environ["pyramid_notebook.route"] = metrics.get_route_label((request.matchdict or {}).get("remainder", ()))
+
     return proxy_it(request, notebook_info["http_port"])
 
 
+def get_notebook_url(request, notebook_info):
+    """Get URL of the default notebook of a running Notebook session."""
+    proxy_route = request.route_url("notebook_proxy", remainder="notebooks/{}".format(notebook_info["notebook_name"]))
+    return route_to_alt_domain(request, proxy_route)
+
+
 def launch_notebook(request, username, notebook_context):
     """Renders a IPython Notebook frame wrapper.
 
     Starts or reattachs ot an existing Notebook session.
     """
+    if asbool(request.registry.settings.get("pyramid_notebook.async_launch", False)):
+        return launch_notebook_async(request, username, notebook_context)
+
     # The notebook manage now tries too hard to get the port allocated for the notebook user, making it slow
     # TODO: Manage a proper state e.g. using Redis
     notebook_info = launch_on_demand(request, username, notebook_context)
 
     # Jump to the detault notebook
-    proxy_route = request.route_url("notebook_proxy", remainder="notebooks/{}".format(notebook_info["notebook_name"]))
-    proxy_route = route_to_alt_domain(request, proxy_route)
+    return HTTPFound(get_notebook_url(request, notebook_info))
+
+
+def launch_notebook_async(request, username, notebook_context):
+    """Start a Notebook session on the background and render a page waiting for it.
+
+    The page polls ``notebook_status`` route, see :py:func:`notebook_status`, and moves on to the notebook when it is ready. This way slow launches do not tie up a web server worker.
+    """
+    manager, notebook_context = prepare_launch(request, username, notebook_context)
+
+    # Already running with this context
+    notebook_info = manager.get_notebook_status(username)
+    if notebook_info and "notebook_name" in notebook_info and manager.is_same_context(notebook_context, notebook_info):
+        return HTTPFound(get_notebook_url(request, notebook_info))
+
+    manager.start_notebook_in_background(username, notebook_context)
+
+    status_url = request.route_url("notebook_status", _query={"context_hash": notebook_context["context_hash"]})
+    return Response(LAUNCH_PAGE.format(status_url=json.dumps(status_url)))
+
+
+def notebook_status(request, username):
+    """Tell the launch page whether the Notebook session of a user is ready.
 
-    return HTTPFound(proxy_route)
+    Map this to ``notebook_status`` route when using ``pyramid_notebook.async_launch``.
+
+    :return: JSON response with ``status`` ``starting``, ``ready`` or ``failed``. Ready status comes with ``url`` of the notebook and failed with ``message``.
+    """
+    security_check(request, username)
+
+    manager = get_notebook_manager(request)
+
+    error = manager.get_launch_error(username)
+    if error:
+        return Response(json_body={"status": "failed", "message": error})
+
+    notebook_info = manager.get_notebook_status(username)
+    if notebook_info and "notebook_name" in notebook_info:
+        context_hash = request.params.get("context_hash")
+        if context_hash is None or str(notebook_info.get("context_hash")) == context_hash:
+            if manager.probe_http(notebook_info):
+                return Response(json_body={"status": "ready", "url": get_notebook_url(request, notebook_info)})
+
+    return Response(json_body={"status": "starting"})
 
 
 def shutdown_notebook(request, username):
@@ -193,3 +330,21 @@ def shutdown_notebook(request, username):
     manager = get_notebook_manager(request)
     if manager.is_running(username):
         manager.stop_notebook(username)
+
+
+def notebook_metrics(request):
+    """Render metrics of all web server processes in Prometheus text format.
+
+    Set ``pyramid_notebook.metrics_path`` to map this view, see :py:func:`pyramid_notebook.includeme`. Without ``pyramid_notebook.metrics`` only the metrics of the process serving the request are shown.
+    """
+    store = getattr(request.registry, "notebook_metrics_store", None)
+    if store:
+        total = store.collect()
+    else:
+        total = {"counters": {}, "gauges": {}, "histograms": {}}
+        metrics.merge(total, metrics.metrics.snapshot())
+
+    manager = get_notebook_manager(request)
+    total["gauges"][("pyramid_notebook_running_notebooks", ())] = manager.count_running_notebooks()
+
+    return Response(metrics.render_prometheus(total), content_type="text/plain", charset="utf-8")
@@ -47,6 +47,7 @@ setup(
         'daemonocle>=1.0.1',
         'PasteDeploy',
         'port-for',
+        'psutil',
         'pyramid',
         'sqlalchemy',
         'ws4py'
@@ -6,6 +6,8 @@ import logging
 import os
 import threading
 import time
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
 from urllib.parse import urlparse
 from wsgiref.simple_server import make_server
 
@@ -17,11 +19,19 @@ from pyramid.paster import setup_logging
 import pytest
 from webtest import TestApp  # noQA
 
+# Pyramid Notebook
+from pyramid_notebook.notebookmanager import NotebookManager
+from pyramid_notebook.server import comm
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+#: PID way above pid_max, never alive
+DEAD_PID = 2 ** 30
+
+
 def pytest_addoption(parser):
     parser.addoption("--ini", action="store", metavar="INI_FILE", help="use INI_FILE to configure SQLAlchemy")
 
@@ -122,3 +132,73 @@ def pyramid_request(request):
 
     _request = testing.DummyRequest()
     return _request
+
+
+@pytest.fixture()
+def dead_pid():
+    """PID of a process which never exists."""
+    return DEAD_PID
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """Pretend to be Notebook REST API."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+
+@pytest.fixture()
+def api_server(request):
+    """Run a fake Notebook REST API in a background thread."""
+    server = HTTPServer(("localhost", 0), APIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def teardown():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(teardown)
+    return server
+
+
+class FakeStopManager(NotebookManager):
+    """Record stops instead of running the daemon script."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stopped = []
+
+    def stop_notebook(self, name):
+        self.stopped.append(name)
+
+
+@pytest.fixture()
+def stop_manager(tmpdir):
+    """Notebook manager which records stops."""
+    return FakeStopManager(notebook_folder=str(tmpdir))
+
+
+@pytest.fixture()
+def make_running():
+    """Make a notebook look like it is running, without starting a daemon.
+
+    :return: Function ``make_running(manager, name, idle=None, pid=None, rss=None)``. Set ``idle`` seconds to backdate the last activity and ``rss`` bytes to write resource usage stats.
+    """
+
+    def make_running(manager, name, idle=None, pid=None, rss=None):
+        comm.set_context(manager.get_pid(name), {"context_hash": 1, "pid": pid or os.getpid()})
+        if idle is not None:
+            manager.touch_activity(name, force=True)
+            past = time.time() - idle
+            os.utime(manager.get_activity_file(name), (past, past))
+        if rss is not None:
+            comm.write_json(manager.get_stats_file(name), {"rss": rss, "cpu_percent": 0.0})
+
+    return make_running
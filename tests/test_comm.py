@@ -0,0 +1,129 @@
+"""Context file communication tests."""
+# Standard Library
+import json
+import os
+import threading
+
+# Third Party
+import pytest
+
+# Pyramid Notebook
+from pyramid_notebook.server import comm
+
+
+def test_context_roundtrip(tmpdir):
+    pid_file = str(tmpdir.join("notebook.pid"))
+    assert comm.get_context(pid_file) is None
+
+    comm.set_context(pid_file, {"context_hash": 1, "pid": os.getpid(), "timings": {"requested": 1.0}})
+    context = comm.get_context(pid_file)
+    assert context == {"context_hash": 1, "pid": os.getpid(), "timings": {"requested": 1.0}}
+
+    # Callers may modify the returned dict, nested ones included, without affecting others
+    context["http_port"] = 1
+    context["timings"]["ready"] = 2.0
+    context = comm.get_context(pid_file)
+    assert "http_port" not in context
+    assert context["timings"] == {"requested": 1.0}
+
+
+def test_context_file_change(tmpdir):
+    """Cached context is replaced when another process rewrites the file."""
+    pid_file = str(tmpdir.join("notebook.pid"))
+    comm.set_context(pid_file, {"context_hash": 1})
+    assert comm.get_context(pid_file)["context_hash"] == 1
+
+    with open(comm.get_context_file_name(pid_file), "wt") as f:
+        f.write('{"context_hash": 22}')
+
+    assert comm.get_context(pid_file)["context_hash"] == 22
+
+    os.remove(comm.get_context_file_name(pid_file))
+    assert comm.get_context(pid_file) is None
+
+
+def test_context_dead_pid(tmpdir, dead_pid):
+    """Context of a dead process is not returned, except to the daemon itself."""
+    pid_file = str(tmpdir.join("notebook.pid"))
+    comm.set_context(pid_file, {"context_hash": 1, "pid": dead_pid})
+    assert comm.get_context(pid_file) is None
+    assert comm.get_context(pid_file, daemon=True)["pid"] == dead_pid
+
+
+def test_context_record(tmpdir):
+    """Hot fields are mirrored in a compact record with a generation counter."""
+    pid_file = str(tmpdir.join("notebook.pid"))
+    assert comm.get_context_record(pid_file) is None
+
+    comm.set_context(pid_file, {"context_hash": 2 ** 62, "pid": 123})
+    assert comm.get_context_record(pid_file) == comm.ContextRecord(1, 123, 0, 2 ** 62)
+
+    comm.set_context(pid_file, {"context_hash": 5, "pid": 123, "http_port": 40001})
+    assert comm.get_context_record(pid_file) == comm.ContextRecord(2, 123, 40001, 5)
+
+
+def test_context_atomic_write(tmpdir):
+    """Context file is replaced, not rewritten in place, and no temporary files are left behind."""
+    pid_file = str(tmpdir.join("notebook.pid"))
+    comm.set_context(pid_file, {"context_hash": 1})
+    fname = comm.get_context_file_name(pid_file)
+    with open(fname, "rt") as reader:
+        comm.set_context(pid_file, {"context_hash": 2})
+
+        # Reader which opened the old file still sees all of it
+        assert reader.read() == '{"context_hash": 1}'
+
+    assert comm.get_context(pid_file)["context_hash"] == 2
+    assert sorted(os.listdir(str(tmpdir))) == ["context.json", "context.lock", "context.rec"]
+
+
+def test_context_record_mismatch(tmpdir):
+    """Record written for another context file is not trusted."""
+    pid_file = str(tmpdir.join("notebook.pid"))
+    comm.set_context(pid_file, {"context_hash": 1, "pid": 123})
+
+    # Context file replaced without the record, like by a writer which crashed in between
+    comm.write_atomic(comm.get_context_file_name(pid_file), b'{"context_hash": 2, "pid": 456}')
+    assert comm.get_context_record(pid_file) is None
+
+    # Generations go on from the record on disk
+    comm.set_context(pid_file, {"context_hash": 3, "pid": 789})
+    assert comm.get_context_record(pid_file) == comm.ContextRecord(2, 789, 0, 3)
+
+
+def test_context_concurrent_writers(tmpdir):
+    """Every write gets its own generation and the record matches the last context written."""
+    pid_file = str(tmpdir.join("notebook.pid"))
+
+    def run(n):
+        for i in range(20):
+            comm.set_context(pid_file, {"context_hash": n, "pid": i})
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    record = comm.get_context_record(pid_file)
+    assert record.generation == 80
+    with open(comm.get_context_file_name(pid_file), "rt") as f:
+        context = json.load(f)
+    assert (record.pid, record.context_hash) == (context["pid"], context["context_hash"])
+
+
+def test_write_atomic_failure(tmpdir, monkeypatch):
+    """Failed write leaves the old file and no temporary file behind."""
+    fname = str(tmpdir.join("context.json"))
+    comm.write_atomic(fname, b"old")
+
+    def fail(src, dst):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        comm.write_atomic(fname, b"new")
+
+    assert os.listdir(str(tmpdir)) == ["context.json"]
+    with open(fname, "rb") as f:
+        assert f.read() == b"old"
@@ -0,0 +1,33 @@
+"""Idle notebook culling."""
+# Pyramid Notebook
+from pyramid_notebook.culler import IdleCuller
+from pyramid_notebook.notebookmanager import NotebookManager
+
+
+def test_cull_idle(stop_manager, make_running):
+    """Only notebooks idle longer than the timeout are stopped."""
+    manager = stop_manager
+    culler = IdleCuller(manager, idle_timeout=600)
+    make_running(manager, "idle", 3600)
+    make_running(manager, "busy", 60)
+
+    # Work folder without running notebook
+    manager.get_work_folder("stopped")
+
+    assert culler.cull() == ["idle"]
+    assert manager.stopped == ["idle"]
+
+
+def test_touch_activity_throttled(tmpdir, make_running):
+    """Activity file is not rewritten for every proxied request."""
+    manager = NotebookManager(notebook_folder=str(tmpdir))
+    make_running(manager, "user", 3600)
+    assert manager.get_idle_time("user") > 3000
+
+    # Touched recently by this process
+    manager.touch_activity("user")
+    assert manager.get_idle_time("user") > 3000
+
+    manager.activity_touched.clear()
+    manager.touch_activity("user")
+    assert manager.get_idle_time("user") < 60
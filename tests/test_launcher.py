@@ -0,0 +1,90 @@
+"""Fork server launcher tests."""
+# Standard Library
+import os
+import sys
+import time
+
+# Third Party
+import psutil
+import pytest
+
+# Pyramid Notebook
+from pyramid_notebook.notebookmanager import NotebookManager
+from pyramid_notebook.server import comm
+from pyramid_notebook.server.launcher import LauncherClient
+
+
+@pytest.fixture()
+def launcher(request, tmpdir):
+    socket_path = str(tmpdir.join("launcher.sock"))
+    client = LauncherClient(socket_path, sys.executable)
+
+    def teardown():
+        for proc in psutil.process_iter(["cmdline"]):
+            if socket_path in (proc.info["cmdline"] or []):
+                proc.kill()
+
+    request.addfinalizer(teardown)
+    return client
+
+
+def test_launcher_status(tmpdir, launcher):
+    """Commands run in the launcher give the same output and exit code as the script."""
+    manager = NotebookManager(notebook_folder=str(tmpdir), launcher=launcher)
+    cmd = [str(arg) for arg in manager.get_notebook_daemon_command("user", "status")]
+
+    returncode, stdout, stderr = launcher.run(cmd[1:])
+    assert returncode == 1
+    assert b"not running" in stdout
+
+    # Second call goes to the already running launcher
+    returncode, stdout, stderr = launcher.run(cmd[1:])
+    assert b"not running" in stdout
+
+
+def get_launcher_pids(socket_path):
+    """Find launcher processes, but not their forked handlers."""
+    procs = {proc.pid: proc.info["ppid"] for proc in psutil.process_iter(["cmdline", "ppid", "status"]) if socket_path in (proc.info["cmdline"] or []) and proc.info["status"] != psutil.STATUS_ZOMBIE}
+    return {pid for pid, ppid in procs.items() if ppid not in procs}
+
+
+def test_launcher_restart_on_code_change(tmpdir, launcher):
+    """Launcher running code older than what is on disk is replaced."""
+    manager = NotebookManager(notebook_folder=str(tmpdir), launcher=launcher)
+    cmd = [str(arg) for arg in manager.get_notebook_daemon_command("user", "status")]
+
+    launcher.run(cmd[1:])
+    old_pids = get_launcher_pids(launcher.socket_path)
+    assert len(old_pids) == 1
+
+    # Pretend pyramid_notebook was upgraded and the web server restarted
+    fname = comm.__file__
+    stat = os.stat(fname)
+    try:
+        os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        launcher = LauncherClient(launcher.socket_path, sys.executable)
+        returncode, stdout, stderr = launcher.run(cmd[1:])
+        assert b"not running" in stdout
+    finally:
+        os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    deadline = time.monotonic() + 5
+    while get_launcher_pids(launcher.socket_path) & old_pids and time.monotonic() < deadline:
+        time.sleep(0.05)
+    new_pids = get_launcher_pids(launcher.socket_path)
+    assert new_pids and not new_pids & old_pids
+
+
+
+def test_launcher_env(tmpdir, launcher):
+    """Commands run with the environment the web server passes, like subprocesses."""
+    manager = NotebookManager(notebook_folder=str(tmpdir), launcher=launcher)
+    cmd = [str(arg) for arg in manager.get_notebook_daemon_command("user", "status")]
+
+    launcher.run(cmd[1:])
+
+    # Launcher started without the variable, the command gets it anyway
+    env = dict(os.environ, PYRAMID_NOTEBOOK_PROFILE=str(tmpdir.join("status-{pid}.prof")))
+    returncode, stdout, stderr = launcher.run(cmd[1:], env)
+    assert b"Dumped startup profile" in stderr
+    assert tmpdir.listdir(lambda p: p.basename.startswith("status-"))
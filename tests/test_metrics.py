@@ -0,0 +1,159 @@
+"""Metrics registry, cross-process aggregation and Prometheus output."""
+# Standard Library
+import json
+import os
+import threading
+
+# Pyramid
+from pyramid import testing
+
+# Pyramid Notebook
+from pyramid_notebook.metrics import Metrics
+from pyramid_notebook.metrics import MetricsStore
+from pyramid_notebook.metrics import get_route_label
+from pyramid_notebook.metrics import merge
+from pyramid_notebook.metrics import render_prometheus
+from pyramid_notebook.views import notebook_metrics
+
+
+def write_process_file(store, pid, registry):
+    data = registry.snapshot()
+    data["pid"] = pid
+    with open(os.path.join(store.folder, "{}-test.json".format(pid)), "wt") as f:
+        json.dump(data, f)
+
+
+def test_render():
+    registry = Metrics()
+    registry.inc("pyramid_notebook_proxy_requests_total", route="api", status=200)
+    registry.inc("pyramid_notebook_proxy_requests_total", route="api", status=200)
+    registry.observe("pyramid_notebook_launch_seconds", 0.3)
+    registry.observe("pyramid_notebook_launch_seconds", 100)
+
+    total = {"counters": {}, "gauges": {}, "histograms": {}}
+    merge(total, registry.snapshot())
+    text = render_prometheus(total)
+
+    assert "# TYPE pyramid_notebook_proxy_requests_total counter" in text
+    assert 'pyramid_notebook_proxy_requests_total{route="api",status="200"} 2' in text
+    assert "# TYPE pyramid_notebook_launch_seconds histogram" in text
+    assert 'pyramid_notebook_launch_seconds_bucket{le="0.25"} 0' in text
+    assert 'pyramid_notebook_launch_seconds_bucket{le="0.5"} 1' in text
+    assert 'pyramid_notebook_launch_seconds_bucket{le="+Inf"} 2' in text
+    assert "pyramid_notebook_launch_seconds_count 2" in text
+    assert "pyramid_notebook_launch_seconds_sum 100.3" in text
+
+
+def test_aggregate_processes(tmpdir, dead_pid):
+    """Counters of all processes are summed, gauges only of live ones and exited processes are archived."""
+    own = Metrics()
+    store = MetricsStore(str(tmpdir), registry=own)
+    own.inc("pyramid_notebook_stops_total")
+    own.add("pyramid_notebook_websocket_connections", 2)
+
+    dead = Metrics()
+    dead.inc("pyramid_notebook_stops_total", 3)
+    dead.add("pyramid_notebook_websocket_connections", 5)
+    dead.observe("pyramid_notebook_stop_seconds", 0.1)
+
+    write_process_file(store, dead_pid, dead)
+
+    for i in range(2):
+        total = store.collect()
+        assert total["counters"][("pyramid_notebook_stops_total", ())] == 4
+        assert total["gauges"][("pyramid_notebook_websocket_connections", ())] == 2
+        assert total["histograms"][("pyramid_notebook_stop_seconds", ())][-1] == 0.1
+
+    assert not os.path.exists(os.path.join(str(tmpdir), "{}-test.json".format(dead_pid)))
+    assert os.path.exists(os.path.join(str(tmpdir), "archive.json"))
+
+
+def test_route_label():
+    assert get_route_label(("api", "contents")) == "api"
+    assert get_route_label(("user-controlled", "x")) == "other"
+    assert get_route_label(()) == "other"
+
+
+def test_metrics_view(request, tmpdir):
+    settings = {"pyramid_notebook.notebook_folder": str(tmpdir), "pyramid_notebook.kill_timeout": "60"}
+    testing.setUp(settings=settings)
+    request.addfinalizer(testing.tearDown)
+
+    resp = notebook_metrics(testing.DummyRequest())
+    assert resp.content_type == "text/plain"
+    assert "pyramid_notebook_running_notebooks 0" in resp.text
+
+
+def test_store_started_lazily(tmpdir):
+    """Dump thread starts on the first recording, also in processes forked after set up."""
+    from pyramid_notebook import metrics
+
+    store = MetricsStore(str(tmpdir), interval=3600)
+    metrics.set_metrics_store(store)
+    try:
+        assert not store.thread.is_running()
+        metrics.inc("pyramid_notebook_stops_total")
+        assert store.thread.is_running()
+    finally:
+        metrics.set_metrics_store(None)
+
+
+def test_store_forked(tmpdir):
+    """Forked worker does not count what its parent recorded before the fork."""
+    own = Metrics()
+    store = MetricsStore(str(tmpdir), registry=own, interval=3600)
+    own.inc("pyramid_notebook_stops_total")
+
+    pid = os.fork()
+    if pid == 0:
+        store.start()
+        os._exit(0 if not own.counters and store.thread.is_running() else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert own.counters
+
+
+def test_concurrent_flush(tmpdir):
+    """Metrics view and the dump thread may flush the same process file at once."""
+    store = MetricsStore(str(tmpdir), registry=Metrics(), interval=3600)
+    errors = []
+
+    def flush():
+        try:
+            for i in range(200):
+                store.flush()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=flush) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert os.listdir(str(tmpdir)) == [os.path.basename(store.get_file())]
+
+
+def make_metrics_app(tmpdir, **settings):
+    """WSGI app with the metrics route and a security policy denying everything."""
+    from pyramid.authentication import RemoteUserAuthenticationPolicy
+    from pyramid.authorization import ACLAuthorizationPolicy
+    from pyramid.config import Configurator
+    from webtest import TestApp
+
+    settings.update({"pyramid_notebook.notebook_folder": str(tmpdir), "pyramid_notebook.kill_timeout": "60", "pyramid_notebook.metrics_path": "/notebook-metrics"})
+    config = Configurator(settings=settings)
+    config.set_authentication_policy(RemoteUserAuthenticationPolicy())
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    config.include("pyramid_notebook")
+    return TestApp(config.make_wsgi_app())
+
+
+def test_metrics_route_permission(tmpdir):
+    """Metrics route needs a permission unless configured public."""
+    make_metrics_app(tmpdir).get("/notebook-metrics", status=403)
+
+    app = make_metrics_app(tmpdir, **{"pyramid_notebook.metrics_permission": "__no_permission_required__"})
+    assert "pyramid_notebook_running_notebooks" in app.get("/notebook-metrics").text
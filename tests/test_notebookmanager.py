@@ -0,0 +1,155 @@
+"""NotebookManager tests which do not need a running Notebook."""
+# Standard Library
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Third Party
+import pytest
+
+# Pyramid Notebook
+from pyramid_notebook.notebookmanager import NotebookManager
+from pyramid_notebook.server import comm
+
+
+def test_wait_for_notebook(tmpdir, api_server):
+    """Notebook is ready when the daemon has written its context and HTTP answers."""
+    m = NotebookManager(notebook_folder=str(tmpdir))
+    context = {"context_hash": 1, "pid": os.getpid(), "http_port": api_server.server_address[1], "notebook_name": "default-1.ipynb", "timings": {"requested": 1.0}}
+    comm.set_context(m.get_pid("user"), context)
+
+    context = m.wait_for_notebook("user")
+    assert context["notebook_name"] == "default-1.ipynb"
+    assert m.average_startup_time is not None
+
+    # Ready time is recorded in the context file
+    assert context["timings"]["requested"] == 1.0
+    assert comm.get_context(m.get_pid("user"))["timings"] == context["timings"]
+
+
+def test_wait_for_dead_notebook(tmpdir, dead_pid):
+    """Daemon which died during launch is reported straight away."""
+    m = NotebookManager(notebook_folder=str(tmpdir))
+    context = {"context_hash": 1, "pid": dead_pid, "http_port": 1, "notebook_name": "default-1.ipynb"}
+    comm.set_context(m.get_pid("user"), context)
+
+    with pytest.raises(RuntimeError):
+        m.wait_for_notebook("user")
+
+
+def test_wait_for_notebook_early_crash(tmpdir, dead_pid):
+    """Daemon which died before writing its pid to the context is reported without waiting for the timeout."""
+    m = NotebookManager(notebook_folder=str(tmpdir), startup_timeout=30)
+    comm.set_context(m.get_pid("user"), {"context_hash": 1})
+    with open(m.get_pid("user"), "wt") as f:
+        f.write(str(dead_pid))
+
+    started = time.monotonic()
+    with pytest.raises(RuntimeError):
+        m.wait_for_notebook("user")
+    assert time.monotonic() - started < 5
+
+
+def test_wait_for_notebook_timeout(tmpdir):
+    """Daemon which never writes its context times out."""
+    m = NotebookManager(notebook_folder=str(tmpdir), startup_timeout=0.1)
+    comm.set_context(m.get_pid("user"), {"context_hash": 1})
+
+    with pytest.raises(RuntimeError):
+        m.wait_for_notebook("user")
+
+
+def test_wait_for_exit(tmpdir, dead_pid):
+    m = NotebookManager(notebook_folder=str(tmpdir))
+    assert m.wait_for_exit(dead_pid, 1)
+    assert not m.wait_for_exit(os.getpid(), 0.05)
+
+
+class FakeLaunchManager(NotebookManager):
+    """Count launches, pretending this process is the notebook daemon."""
+
+    spawns = 0
+
+    def start_notebook(self, name, context, fg=False):
+        self.spawns += 1
+        context = dict(context, pid=os.getpid(), http_port=1, notebook_name="default.ipynb")
+        comm.set_context(self.get_pid(name), context)
+
+    def wait_for_notebook(self, name):
+        # Give the other threads a chance to pile up
+        time.sleep(0.2)
+        return self.get_context(name)
+
+
+def test_concurrent_launch_single_flight(tmpdir):
+    """Simultaneous launches of the same notebook share one spawn."""
+    m = FakeLaunchManager(notebook_folder=str(tmpdir))
+    results = []
+
+    def launch():
+        results.append(m.start_notebook_on_demand("user", {"context_hash": 1}))
+
+    threads = [threading.Thread(target=launch) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert m.spawns == 1
+    assert sorted(created for context, created in results) == [False, False, False, True]
+
+
+def make_fake_daemon(manager, name, code="import time; time.sleep(60)"):
+    """Run a process standing in for a notebook daemon of name."""
+    proc = subprocess.Popen([sys.executable, "-c", code])
+    with open(manager.get_pid(name), "wt") as f:
+        f.write(str(proc.pid))
+    comm.set_context(manager.get_pid(name), {"context_hash": 1, "pid": proc.pid, "http_port": 40000})
+    return proc
+
+
+def test_list_notebooks(tmpdir, dead_pid):
+    m = NotebookManager(str(tmpdir))
+    proc = make_fake_daemon(m, "alive")
+    comm.set_context(m.get_pid("dead"), {"context_hash": 1, "pid": dead_pid})
+
+    # Work folder without context
+    m.get_work_folder("never")
+
+    try:
+        notebooks = m.list_notebooks()
+        assert sorted(notebooks) == ["alive", "dead"]
+        assert notebooks["alive"]["running"]
+        assert not notebooks["dead"]["running"]
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_stop_all(tmpdir):
+    """Daemons are stopped together and the ones ignoring SIGTERM are killed."""
+    m = NotebookManager(str(tmpdir), stop_timeout=0.5)
+    procs = [make_fake_daemon(m, "user{}".format(i)) for i in range(3)]
+    stubborn = make_fake_daemon(m, "stubborn", "import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(60)")
+
+    # Let it install its signal handler
+    time.sleep(0.5)
+
+    assert m.stop_all() == ["stubborn", "user0", "user1", "user2"]
+    for proc in procs + [stubborn]:
+        assert proc.poll() is not None
+
+
+def test_stop_notebook_direct(tmpdir):
+    """Stopping does not need to run the daemon script."""
+    m = NotebookManager(str(tmpdir), stop_timeout=5)
+    proc = make_fake_daemon(m, "user")
+
+    assert m.read_pid_file("user") == proc.pid
+
+    m.exec_notebook_daemon_command = None
+    m.stop_notebook("user")
+    assert proc.poll() is not None
+    assert m.get_context("user") is None
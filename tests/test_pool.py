@@ -0,0 +1,48 @@
+"""Notebook daemon pool claiming."""
+# Standard Library
+import json
+import os
+
+# Pyramid Notebook
+from pyramid_notebook.notebookmanager import NotebookManager
+from pyramid_notebook.pool import NotebookPool
+
+
+def make_slot(pool, name, pid):
+    """Fake a pooled daemon which has finished its imports."""
+    slot_folder = os.path.join(pool.pool_folder, name)
+    os.makedirs(slot_folder)
+    http_port = pool.manager.ports.acquire(pool.get_lease_name(slot_folder))
+    with open(os.path.join(slot_folder, "ready"), "wt") as f:
+        f.write(json.dumps({"pid": pid, "http_port": http_port}))
+    return slot_folder
+
+
+def test_claim_and_bind(tmpdir):
+    """Ready daemon is claimed once and gets told where its user lives."""
+    manager = NotebookManager(notebook_folder=str(tmpdir))
+    pool = NotebookPool(manager, size=0)
+    manager.pool = pool
+    slot_folder = make_slot(pool, "slot-a", os.getpid())
+
+    slot = pool.claim()
+    assert slot["http_port"] == 40000
+    assert pool.claim() is None
+
+    pool.bind(slot, manager.get_pid("user"), manager.get_work_folder("user"))
+    with open(os.path.join(slot_folder, "claim.json"), "rt") as f:
+        claim = json.loads(f.read())
+    assert claim["pid_file"] == manager.get_pid("user")
+
+
+def test_dead_slot_skipped(tmpdir, dead_pid):
+    """Slot whose daemon has died is cleaned up instead of claimed."""
+    manager = NotebookManager(notebook_folder=str(tmpdir))
+    pool = NotebookPool(manager, size=0)
+    slot_folder = make_slot(pool, "slot-a", dead_pid)
+
+    assert pool.claim() is None
+    assert not os.path.exists(slot_folder)
+
+    # Port of the dead daemon went back to the free list
+    assert manager.ports.get_leases() == {}
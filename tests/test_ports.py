@@ -0,0 +1,98 @@
+"""Port lease table tests."""
+# Standard Library
+import os
+import sqlite3
+import threading
+
+# Third Party
+import pytest
+
+# Pyramid Notebook
+from pyramid_notebook.ports import PortAllocator
+
+
+def test_unique_ports(tmpdir):
+    """Concurrent allocators sharing the lease file never hand out the same port."""
+    db_file = str(tmpdir.join("ports.sqlite"))
+    allocators = [PortAllocator(db_file, 41000, 200) for i in range(4)]
+    ports = []
+
+    def run(allocator, n):
+        for i in range(20):
+            ports.append(allocator.acquire("user-{}-{}".format(n, i)))
+
+    threads = [threading.Thread(target=run, args=(allocator, n)) for n, allocator in enumerate(allocators)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(ports) == 80
+    assert len(set(ports)) == 80
+
+
+def test_release_reuse_order(tmpdir):
+    """Released ports are reused last and one name holds one port."""
+    allocator = PortAllocator(str(tmpdir.join("ports.sqlite")), 41000, 3)
+    assert allocator.acquire("a") == 41000
+    assert allocator.acquire("b") == 41001
+
+    # Restarting a notebook gives up its old port
+    assert allocator.acquire("a") == 41002
+    assert allocator.acquire("c") == 41000
+
+    allocator.release("b")
+    assert 41001 not in allocator.get_leases()
+
+
+def test_reclaim_dead(tmpdir, dead_pid):
+    """Ports of daemons which died without being stopped are reclaimed when the range runs out."""
+    allocator = PortAllocator(str(tmpdir.join("ports.sqlite")), 41000, 2)
+    allocator.set_pid(allocator.acquire("a"), dead_pid)
+    allocator.set_pid(allocator.acquire("b"), os.getpid())
+
+    assert allocator.acquire("c") == 41000
+    assert allocator.get_leases()[41001] == ("b", os.getpid())
+
+
+def test_transfer(tmpdir):
+    allocator = PortAllocator(str(tmpdir.join("ports.sqlite")), 41000, 10)
+    port = allocator.acquire(".pool/slot-a")
+    allocator.transfer(port, "user")
+    assert allocator.get_leases() == {port: ("user", None)}
+
+
+def test_large_range(tmpdir):
+    """Thousands of ports do not slow down allocation."""
+    allocator = PortAllocator(str(tmpdir.join("ports.sqlite")), 30000, 5000)
+    ports = {allocator.acquire("user-{}".format(i)) for i in range(500)}
+    assert len(ports) == 500
+
+
+def test_probe_outside_transaction(tmpdir, monkeypatch):
+    """Ports are probed without holding the lease table write lock and ports in use go to the end of the queue."""
+    import port_for
+
+    db_file = str(tmpdir.join("ports.sqlite"))
+    allocator = PortAllocator(db_file, 41000, 3)
+    probed = []
+
+    def port_is_used(port):
+        # Another process can write to the lease table meanwhile
+        db = sqlite3.connect(db_file, timeout=0, isolation_level=None)
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("ROLLBACK")
+        db.close()
+        probed.append(port)
+        return port == 41000
+
+    monkeypatch.setattr(port_for, "port_is_used", port_is_used)
+    assert allocator.acquire("a") == 41001
+    assert probed == [41000, 41001]
+    assert allocator.get_leases() == {41001: ("a", None)}
+
+    # Only the port in use is left
+    assert allocator.acquire("b") == 41002
+    with pytest.raises(RuntimeError):
+        allocator.acquire("c")
+    assert allocator.get_leases() == {41001: ("a", None), 41002: ("b", None)}
@@ -0,0 +1,367 @@
+"""WSGI proxy tests against a local stand-in upstream server."""
+# Standard Library
+import io
+import os
+import resource
+import socket
+import threading
+import types
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+# Third Party
+import pytest
+from webob import Request
+from webtest import TestApp
+
+# Pyramid Notebook
+from pyramid_notebook.proxy import ResponseCache
+from pyramid_notebook.proxy import WSGIProxyApplication
+from pyramid_notebook.proxy import drop_connection_pool
+from pyramid_notebook.proxy import get_connection_pool
+from pyramid_notebook.proxy import get_header_name
+from pyramid_notebook.proxy import get_upstream_path
+from pyramid_notebook.proxy import is_connection_dropped
+from pyramid_notebook.proxy import reconstruct_url
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """Echo request details back, keeping HTTP/1.1 connections alive."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def reply(self, body, content_type="text/plain"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.path.startswith("/static/"):
+            body = self.path.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/javascript")
+            self.send_header("Content-Length", str(len(body)))
+            # What Notebook's FileFindHandler sends: versioned files are cached for ten years, others revalidated
+            if "v=" in self.path:
+                self.send_header("Cache-Control", "private, max-age=3600" if "private" in self.path else "max-age=315360000")
+            else:
+                self.send_header("Cache-Control", "no-cache")
+            self.send_header("ETag", '"abc"')
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith("/files/"):
+            self.reply("{} {}".format(self.path, self.headers.get("X-User")).encode("utf-8"))
+        elif self.path.startswith("/big/"):
+            self.reply(b"x" * int(self.path[5:]), "application/octet-stream")
+        elif self.path.startswith("/chunked/"):
+            # Response of unknown length
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(int(self.path[9:])):
+                chunk = b"y" * 10000
+                self.wfile.write("{:x}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path.startswith("/close/"):
+            # Close the connection without telling the client, like a restarting server would
+            self.reply(self.path.encode("utf-8"))
+            self.close_connection = True
+        else:
+            self.reply(self.path.encode("utf-8"))
+
+    def do_POST(self):
+        self.server.posts += 1
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            self.server.chunked += 1
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    break
+                body += chunk
+        else:
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+        self.reply(body)
+
+
+@pytest.fixture()
+def upstream(request):
+    """Run a keep-alive HTTP server in a background thread."""
+    server = ThreadingHTTPServer(("localhost", 0), UpstreamHandler)
+    server.connections = 0
+    server.chunked = 0
+    server.requests = 0
+    server.posts = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    port = server.server_address[1]
+
+    def teardown():
+        drop_connection_pool(port)
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(teardown)
+    return server
+
+
+def test_proxy_get(upstream):
+    """Path and query string are forwarded upstream."""
+    app = TestApp(WSGIProxyApplication(upstream.server_address[1]))
+    resp = app.get("/notebook/api/contents?type=directory")
+    assert resp.body == b"/notebook/api/contents?type=directory"
+
+
+def test_proxy_post(upstream):
+    """Request body is forwarded upstream."""
+    app = TestApp(WSGIProxyApplication(upstream.server_address[1]))
+    resp = app.post("/notebook/api/contents", params=b'{"type": "notebook"}', content_type="application/json")
+    assert resp.body == b'{"type": "notebook"}'
+
+
+def test_keep_alive_reuse(upstream):
+    """Consecutive requests share one pooled upstream connection."""
+    port = upstream.server_address[1]
+    app = TestApp(WSGIProxyApplication(port))
+    for i in range(5):
+        app.get("/notebook/static/{}.js".format(i))
+
+    assert upstream.connections == 1
+    assert len(get_connection_pool(port).idle) == 1
+
+
+def test_stale_connection_retry(upstream):
+    """A pooled connection closed by upstream is replaced transparently."""
+    port = upstream.server_address[1]
+    app = TestApp(WSGIProxyApplication(port))
+    app.get("/first")
+
+    # Simulate upstream dropping the idle keep-alive connection
+    connection, _ = get_connection_pool(port).idle[0]
+    connection.sock.close()
+
+    resp = app.get("/second")
+    assert resp.body == b"/second"
+    assert upstream.connections == 2
+
+
+def test_stale_connection_no_post_retry(upstream, monkeypatch):
+    """A request which may change state is not replayed on a fresh connection."""
+    from pyramid_notebook import proxy
+    monkeypatch.setattr(proxy, "is_connection_dropped", lambda connection: False)
+
+    port = upstream.server_address[1]
+    app = TestApp(WSGIProxyApplication(port))
+
+    app.get("/close/1")
+    resp = app.get("/second")
+    assert resp.body == b"/second"
+    assert upstream.connections == 2
+
+    app.get("/close/2")
+    resp = app.post("/notebook/api/contents", params=b"{}", content_type="application/json", status=501)
+    assert upstream.posts == 0
+
+
+def test_connection_dropped_high_fd():
+    """Idle connection check works for fd numbers select() cannot handle."""
+    high_fd = 2000
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= high_fd:
+        pytest.skip("Open file limit too low")
+
+    ours, theirs = socket.socketpair()
+    os.dup2(ours.fileno(), high_fd)
+    ours.close()
+    connection = types.SimpleNamespace(sock=socket.socket(fileno=high_fd))
+    try:
+        assert not is_connection_dropped(connection)
+        theirs.close()
+        assert is_connection_dropped(connection)
+    finally:
+        connection.sock.close()
+
+
+def test_drop_connection_pool(upstream):
+    """Stopping a notebook forgets its pooled connections."""
+    port = upstream.server_address[1]
+    app = TestApp(WSGIProxyApplication(port))
+    app.get("/")
+    pool = get_connection_pool(port)
+    drop_connection_pool(port)
+    assert not pool.idle
+    assert get_connection_pool(port) is not pool
+
+
+def test_proxy_large_post(upstream):
+    """Bodies larger than one chunk are streamed upstream with their length."""
+    app = TestApp(WSGIProxyApplication(upstream.server_address[1]))
+    body = bytes(range(256)) * 4096
+    resp = app.post("/notebook/api/contents", params=body, content_type="application/octet-stream")
+    assert resp.body == body
+    assert upstream.chunked == 0
+
+
+def test_proxy_chunked_post(upstream):
+    """Body without Content-Length is passed on chunked."""
+    body = b"x" * 200000
+    req = Request.blank("/notebook/api/contents", method="POST")
+    req.environ.pop("CONTENT_LENGTH", None)
+    req.environ["wsgi.input"] = io.BytesIO(body)
+    req.environ["wsgi.input_terminated"] = True
+    req.environ["HTTP_TRANSFER_ENCODING"] = "chunked"
+    resp = req.get_response(WSGIProxyApplication(upstream.server_address[1]))
+    assert resp.body == body
+    assert upstream.chunked == 1
+
+
+def test_proxy_input_terminated_no_body(upstream):
+    """Request without a body is not sent chunked just because the WSGI server terminates input streams."""
+    port = upstream.server_address[1]
+    app = WSGIProxyApplication(port)
+    for i in range(2):
+        req = Request.blank("/notebook/api/sessions", method="GET")
+        req.environ.pop("CONTENT_LENGTH", None)
+        req.environ["wsgi.input"] = io.BytesIO(b"")
+        req.environ["wsgi.input_terminated"] = True
+        resp = req.get_response(app)
+        assert resp.body == b"/notebook/api/sessions"
+
+    # Nothing was left unread on the kept alive connection
+    assert upstream.connections == 1
+
+
+def test_proxy_large_response(upstream):
+    """Multi-megabyte response comes through whole with its length."""
+    port = upstream.server_address[1]
+    app = TestApp(WSGIProxyApplication(port, chunk_size=16384))
+    resp = app.get("/big/3000000")
+    assert resp.headers["Content-Length"] == "3000000"
+    assert resp.body == b"x" * 3000000
+
+    # Connection was left reusable
+    assert len(get_connection_pool(port).idle) == 1
+
+
+def test_proxy_chunked_response(upstream):
+    """Response of unknown length is read until upstream says it ends."""
+    port = upstream.server_address[1]
+    app = TestApp(WSGIProxyApplication(port))
+    resp = app.get("/chunked/50")
+    assert resp.body == b"y" * 500000
+    assert len(get_connection_pool(port).idle) == 1
+
+
+#: Set by the notebook_proxy view for /notebook/static/ URLs
+STATIC_ROUTE = {"pyramid_notebook.route": "static"}
+
+
+def test_response_cache_shared(upstream):
+    """Cacheable static file is fetched once for all Notebook servers sharing the cache."""
+    cache = ResponseCache(1024 * 1024)
+    app = TestApp(WSGIProxyApplication(upstream.server_address[1], cache=cache), extra_environ=STATIC_ROUTE)
+
+    for i in range(3):
+        resp = app.get("/static/main.js", params={"v": "1"})
+        assert resp.body == b"/static/main.js?v=1"
+    assert upstream.requests == 1
+
+    # Other version, other query parameters and API responses go upstream
+    app.get("/static/main.js", params={"v": "2"})
+    app.get("/static/main.js", params={"x": "1"})
+    app.get("/api/contents")
+    app.get("/api/contents")
+    assert upstream.requests == 5
+
+
+def test_response_cache_other_routes(upstream):
+    """Only static files upstream lets anybody cache are shared between users."""
+    cache = ResponseCache(1024 * 1024)
+    proxy_app = WSGIProxyApplication(upstream.server_address[1], cache=cache)
+
+    # User files with a version query are fetched for each user
+    app = TestApp(proxy_app, extra_environ={"pyramid_notebook.route": "files"})
+    assert app.get("/files/data.csv", params={"v": "1"}, headers={"X-User": "a"}).body == b"/files/data.csv?v=1 a"
+    assert app.get("/files/data.csv", params={"v": "1"}, headers={"X-User": "b"}).body == b"/files/data.csv?v=1 b"
+    assert upstream.requests == 2
+
+    # Unversioned static file is no-cache and private one is for one user only
+    app = TestApp(proxy_app, extra_environ=STATIC_ROUTE)
+    app.get("/static/main.js")
+    app.get("/static/main.js")
+    app.get("/static/private.js", params={"v": "1"})
+    app.get("/static/private.js", params={"v": "1"})
+    assert upstream.requests == 6
+
+
+def test_response_cache_not_modified(upstream):
+    cache = ResponseCache(1024 * 1024)
+    app = TestApp(WSGIProxyApplication(upstream.server_address[1], cache=cache), extra_environ=STATIC_ROUTE)
+    app.get("/static/main.js", params={"v": "1"})
+
+    resp = app.get("/static/main.js", params={"v": "1"}, headers={"If-None-Match": '"abc"'}, status=304)
+    assert resp.headers["ETag"] == '"abc"'
+    assert upstream.requests == 1
+
+
+def test_response_cache_lru():
+    """Least recently used responses are evicted when the cache is full."""
+    from pyramid_notebook.proxy import CachedResponse
+    cache = ResponseCache(250, max_entry_bytes=100)
+
+    def entry():
+        return CachedResponse("200 OK", [], b"x" * 100, None, float("inf"))
+
+    cache.put("a", entry())
+    cache.put("b", entry())
+    cache.get("a")
+    cache.put("c", entry())
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+    assert cache.size == 200
+
+    cache.put("big", CachedResponse("200 OK", [], b"x" * 101, None, float("inf")))
+    assert cache.get("big") is None
+
+
+@pytest.mark.parametrize("path_info,query_string", [
+    ("/notebook/api/contents", None),
+    ("/notebook/api/contents", ""),
+    ("/notebook/api/contents/default.ipynb", "type=notebook&_=1514764800000"),
+    ("/notebook/files/a%3Bb%3Dc", "x=1"),
+    ("http://example.com/notebook/tree", "a=b"),
+])
+def test_upstream_path(path_info, query_string):
+    """Upstream path matches what the full URL reconstruction gives."""
+    environ = {"PATH_INFO": path_info, "wsgi.url_scheme": "http", "HTTP_HOST": "example.com"}
+    if query_string is not None:
+        environ["QUERY_STRING"] = query_string
+
+    url = urlparse(reconstruct_url(dict(environ), 40000))
+    expected = url.geturl().replace("%s://%s" % (url.scheme, url.netloc), "")
+    assert get_upstream_path(environ) == expected
+
+
+def test_header_names():
+    assert get_header_name("HTTP_X_REQUESTED_WITH") == "x-requested-with"
+    assert get_header_name("HTTP_CONNECTION") is None
+    assert get_header_name("HTTP_TRANSFER_ENCODING") is None
+    assert get_header_name("wsgi.input") is None
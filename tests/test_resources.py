@@ -0,0 +1,71 @@
+"""Per-notebook resource accounting."""
+# Standard Library
+import os
+import resource
+import subprocess
+import sys
+
+# Third Party
+import psutil
+
+# Pyramid Notebook
+from pyramid_notebook.notebookmanager import NotebookManager
+from pyramid_notebook.server.notebook_daemon import apply_resource_limits
+from pyramid_notebook.server.notebook_daemon import sample_process_tree
+
+
+def test_sample_process_tree():
+    """Children, like kernels, are counted with the notebook server."""
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        procs = {}
+        root = psutil.Process()
+        stats = sample_process_tree(root, procs)
+        assert stats["processes"] >= 2
+        assert stats["rss"] > root.memory_info().rss
+        assert stats["num_fds"] > 0
+        assert child.pid in procs
+
+        # Process objects are kept for measuring CPU between samples
+        kept = procs[child.pid]
+        sample_process_tree(root, procs)
+        assert procs[child.pid] is kept
+    finally:
+        child.kill()
+        child.wait()
+
+
+def test_heaviest(stop_manager, make_running, dead_pid):
+    manager = stop_manager
+    make_running(manager, "small", rss=100)
+    make_running(manager, "large", rss=3000)
+    make_running(manager, "medium", rss=2000)
+
+    # Dead notebook with stale stats
+    make_running(manager, "dead", rss=5000, pid=dead_pid)
+
+    heaviest = manager.get_heaviest_notebooks(limit=2)
+    assert [name for name, stats in heaviest] == ["large", "medium"]
+    assert heaviest[0][1]["rss"] == 3000
+
+    assert manager.stop_heaviest(count=1) == ["large"]
+    assert manager.stopped == ["large"]
+
+
+def test_cpu_limit_setting(tmpdir):
+    """CPU limit is off unless set."""
+    settings = {"pyramid_notebook.notebook_folder": str(tmpdir), "pyramid_notebook.kill_timeout": "60"}
+    assert NotebookManager.from_settings(settings).cpu_limit is None
+    settings["pyramid_notebook.cpu_limit"] = "3600"
+    assert NotebookManager.from_settings(settings).cpu_limit == 3600
+
+
+def test_apply_cpu_limit():
+    """CPU limit is set for the daemon process, so its kernels inherit it."""
+    pid = os.fork()
+    if pid == 0:
+        apply_resource_limits({"cpu_limit": 3600})
+        os._exit(0 if resource.getrlimit(resource.RLIMIT_CPU) == (3600, 3600) else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
@@ -0,0 +1,85 @@
+"""Static file fast path tests."""
+# Standard Library
+import os
+
+# Pyramid
+from pyramid import testing
+from pyramid.request import Request
+
+# Third Party
+import pytest
+
+# Pyramid Notebook
+from pyramid_notebook.static import get_static_response
+from pyramid_notebook.views import notebook_proxy
+
+
+@pytest.fixture()
+def folders(tmpdir):
+    static_root = tmpdir.mkdir("static")
+    static_root.mkdir("base").join("main.js").write("main();")
+    static_root.mkdir("custom").join("custom.js").write("// default")
+    custom_folder = tmpdir.mkdir("user").mkdir("custom")
+    custom_folder.join("custom.js").write("// user")
+    tmpdir.join("secret.txt").write("secret")
+    return str(static_root), str(custom_folder)
+
+
+def get(folders, path, **kwargs):
+    static_root, custom_folder = folders
+    request = Request.blank(path, **kwargs)
+    parts = tuple(request.path.split("/")[3:])
+    response = get_static_response(request, parts, static_root, custom_folder)
+    return response and request.get_response(response)
+
+
+def test_static_versioned(folders):
+    resp = get(folders, "/notebook/static/base/main.js?v=123")
+    assert resp.body == b"main();"
+    assert resp.content_type.endswith("javascript")
+    assert "max-age=31536000" in resp.headers["Cache-Control"]
+    assert not resp.etag.startswith("W/")
+
+
+def test_static_not_modified(folders):
+    etag = get(folders, "/notebook/static/base/main.js").etag
+    resp = get(folders, "/notebook/static/base/main.js", headers={"If-None-Match": '"{}"'.format(etag)})
+    assert resp.status_int == 304
+    assert resp.body == b""
+
+
+def test_static_custom_first(folders):
+    """custom.js comes from the user's .jupyter/custom folder."""
+    assert get(folders, "/notebook/static/custom/custom.js").body == b"// user"
+
+
+def test_static_missing_or_outside(folders):
+    """Unknown files and path tricks are left for the proxy."""
+    assert get(folders, "/notebook/static/base/other.js") is None
+    assert get(folders, "/notebook/static/../secret.txt") is None
+    assert get_static_response(Request.blank("/"), ("..", "secret.txt"), folders[0], folders[1]) is None
+
+
+def test_static_sendfile(folders):
+    static_root, custom_folder = folders
+    request = Request.blank("/notebook/static/base/main.js")
+    response = get_static_response(request, ("base", "main.js"), static_root, custom_folder, sendfile="x-accel-redirect", accel_prefix="/_files/")
+    assert response.headers["X-Accel-Redirect"] == "/_files" + os.path.join(static_root, "base", "main.js")
+    assert response.body == b""
+
+
+def test_notebook_proxy_static(tmpdir, folders):
+    """Static files are served without a running notebook."""
+    settings = {
+        "pyramid_notebook.notebook_folder": str(tmpdir.join("notebooks")),
+        "pyramid_notebook.kill_timeout": "60",
+        "pyramid_notebook.serve_static": "true",
+        "pyramid_notebook.static_path": folders[0],
+    }
+    testing.setUp(settings=settings)
+    try:
+        request = testing.DummyRequest(matchdict={"remainder": ("static", "base", "main.js")})
+        resp = notebook_proxy(request, "user")
+        assert b"".join(resp.app_iter) == b"main();"
+    finally:
+        testing.tearDown()
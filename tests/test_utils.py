@@ -0,0 +1,104 @@
+"""Utility function tests."""
+# Standard Library
+import os
+import subprocess
+import sys
+import threading
+import types
+
+# Pyramid Notebook
+from pyramid_notebook.utils import ProcessThread
+from pyramid_notebook.utils import make_dict_hash
+from pyramid_notebook.utils import run_after_fork
+
+
+CONTEXT = {
+    "greeting": "Hello",
+    "extra_template_paths": ["/tmp/templates"],
+    "jinja_environment_options": {},
+    "tags": {"a", "b", "c"},
+}
+
+
+def test_dict_hash_order():
+    """Hash does not depend on key or set order."""
+    reordered = {
+        "tags": {"c", "b", "a"},
+        "jinja_environment_options": {},
+        "extra_template_paths": ["/tmp/templates"],
+        "greeting": "Hello",
+    }
+    assert make_dict_hash(CONTEXT) == make_dict_hash(reordered)
+    assert make_dict_hash(CONTEXT) != make_dict_hash(dict(CONTEXT, greeting="Hi"))
+
+
+def test_dict_hash_type():
+    """Hash is a positive int fit for notebook file names and context checks."""
+    h = make_dict_hash(CONTEXT)
+    assert type(h) == int
+    assert 0 <= h < 2 ** 63
+
+
+def test_dict_hash_stable_across_processes():
+    """Every web server process computes the same hash regardless of hash randomization."""
+    code = "from pyramid_notebook.utils import make_dict_hash; print(make_dict_hash({}))".format(repr(CONTEXT))
+    hashes = set()
+    for seed in ("1", "2", "random"):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        hashes.add(subprocess.check_output([sys.executable, "-c", code], env=env).strip())
+    assert hashes == {str(make_dict_hash(CONTEXT)).encode("ascii")}
+
+
+def test_process_thread():
+    """Thread is started once per process and again in a forked child."""
+    stop = threading.Event()
+    runs = []
+
+    def run():
+        runs.append(os.getpid())
+        stop.wait()
+
+    thread = ProcessThread(run, "test-thread")
+    thread.start()
+    thread.start()
+    first = thread.thread
+
+    pid = os.fork()
+    if pid == 0:
+        started = not thread.is_running()
+        thread.start()
+        os._exit(0 if started and thread.is_running() and thread.thread is not first else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert thread.thread is first
+    stop.set()
+    first.join(5)
+    assert runs == [os.getpid()]
+
+
+def test_run_after_fork(monkeypatch):
+    """Under uWSGI master the call is left to the postfork hook, elsewhere it is made right away."""
+    calls = []
+    hooks = []
+    uwsgi = types.ModuleType("uwsgi")
+    uwsgidecorators = types.ModuleType("uwsgidecorators")
+    uwsgidecorators.postfork = hooks.append
+    monkeypatch.setitem(sys.modules, "uwsgi", uwsgi)
+    monkeypatch.setitem(sys.modules, "uwsgidecorators", uwsgidecorators)
+
+    uwsgi.worker_id = lambda: 0
+    run_after_fork(lambda: calls.append("master"))
+    assert not calls
+    hooks[0]()
+    assert calls == ["master"]
+
+    # lazy-apps loads the application in the worker
+    uwsgi.worker_id = lambda: 1
+    run_after_fork(lambda: calls.append("worker"))
+    assert calls == ["master", "worker"]
+    assert len(hooks) == 1
+
+    monkeypatch.setitem(sys.modules, "uwsgidecorators", None)
+    run_after_fork(lambda: calls.append("other"))
+    assert calls[-1] == "other"
@@ -0,0 +1,219 @@
+"""uWSGI websocket proxy loop tests against a local Tornado websocket server and a fake uwsgi module."""
+# Standard Library
+import asyncio
+import threading
+
+# Third Party
+import pytest
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+from ws4py.framing import OPCODE_BINARY
+from ws4py.framing import OPCODE_CONTINUATION
+from ws4py.framing import OPCODE_TEXT
+from ws4py.framing import Frame
+from ws4py.websocket import DEFAULT_READING_SIZE
+
+# Pyramid Notebook
+from pyramid_notebook.testing import install_fake_uwsgi
+
+# Imports uwsgi, so it must come after the fake is in place
+install_fake_uwsgi()
+from pyramid_notebook import metrics  # noQA
+from pyramid_notebook.uwsgi import ProxyClient  # noQA
+from pyramid_notebook.uwsgi import ProxyStream  # noQA
+from pyramid_notebook.uwsgi import Utf8Validator  # noQA
+from pyramid_notebook.uwsgi import is_text_payload  # noQA
+
+
+class EchoWebSocket(tornado.websocket.WebSocketHandler):
+    """Echo messages back in the frame type they came in. ``close`` message closes the connection."""
+
+    def check_origin(self, origin):
+        return True
+
+    def on_message(self, message):
+        if message == "close":
+            self.close()
+        else:
+            self.write_message(message, binary=isinstance(message, bytes))
+
+
+@pytest.fixture()
+def upstream(request):
+    """Run a websocket echo server in a background thread.
+
+    :return: URL of the echo websocket
+    """
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    started = threading.Event()
+    loops = []
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        app = tornado.web.Application([(r"/api/kernels/test/channels", EchoWebSocket)], websocket_max_message_size=64 * 1024 * 1024)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+        loops.append(tornado.ioloop.IOLoop.current())
+        started.set()
+        loops[0].start()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+
+    def teardown():
+        loops[0].add_callback(loops[0].stop)
+        thread.join(5)
+
+    request.addfinalizer(teardown)
+    return "ws://127.0.0.1:{}/api/kernels/test/channels".format(sockets[0].getsockname()[1])
+
+
+@pytest.fixture()
+def relay(request, upstream):
+    """Connect the proxy to upstream and run its loop in a background thread.
+
+    :return: tuple (fake uwsgi, ProxyClient, loop thread)
+    """
+    fake = install_fake_uwsgi()
+    ws = ProxyClient(upstream, headers=[("Origin", "http://localhost")])
+    ws.activity = []
+    ws.on_activity = lambda: ws.activity.append(True)
+    ws.connect()
+
+    # Open connections before this one
+    ws.connections = metrics.metrics.gauges.get(("pyramid_notebook_websocket_connections", ()), 0)
+    thread = threading.Thread(target=ws.run, daemon=True)
+    thread.start()
+
+    def teardown():
+        if not ws.terminated:
+            ws.close()
+        thread.join(5)
+
+    request.addfinalizer(teardown)
+    return fake, ws, thread
+
+
+def test_relay_text(relay):
+    """Text frames go upstream and come back as text."""
+    fake, ws, thread = relay
+    fake.browser_send(b'{"msg_type": "execute_request"}')
+    assert fake.browser_recv_frame() == (b'{"msg_type": "execute_request"}', False)
+    assert ws.activity
+
+
+def test_relay_binary(relay):
+    """Binary frames, like widget buffers, keep their frame type both ways."""
+    fake, ws, thread = relay
+    payload = b"\x00\x00\x00\x01" + bytes(range(256))
+    fake.browser_send(payload)
+    assert fake.browser_recv_frame() == (payload, True)
+
+
+def test_relay_large(relay):
+    """Message spanning many socket reads is relayed whole."""
+    fake, ws, thread = relay
+    payload = b'{"data": "' + b"x" * (4 * 1024 * 1024) + b'"}'
+    fake.browser_send(payload)
+    data, binary = fake.browser_recv_frame()
+    assert not binary
+    assert data == payload
+
+
+def test_relay_many(relay):
+    """Frames queued together downstream are all relayed."""
+    fake, ws, thread = relay
+    for i in range(10):
+        fake.incoming.append('{{"n": {}}}'.format(i).encode("ascii"))
+    fake.browser_send(b'{"n": 10}')
+    assert [fake.browser_recv() for i in range(11)] == ['{{"n": {}}}'.format(i).encode("ascii") for i in range(11)]
+
+
+def test_upstream_close(relay):
+    """Loop ends when the Notebook server closes the websocket."""
+    fake, ws, thread = relay
+    fake.browser_send(b"close")
+    thread.join(5)
+    assert not thread.is_alive()
+    assert ws.terminated
+    assert metrics.metrics.gauges[("pyramid_notebook_websocket_connections", ())] == ws.connections
+
+
+def test_downstream_error(relay):
+    """Loop ends and upstream is closed when the browser has gone away."""
+    fake, ws, thread = relay
+    fake.browser_disconnect(IOError("unable to receive websocket message"))
+    thread.join(5)
+    assert not thread.is_alive()
+    assert ws.terminated
+
+
+@pytest.mark.parametrize("data,text", [
+    (b'{"msg_type": "comm_msg", "content": {"text": "\xc3\xa4"}}', True),
+    (b"", True),
+    (b"\x00\x00\x00\x02" + b"\x00" * 16, False),
+    (b"\xff\xfe\xfd", False),
+])
+def test_is_text_payload(data, text):
+    assert is_text_payload(data) == text
+
+
+def test_utf8_validator():
+    """Code point split between chunks is valid once complete, garbage is not."""
+    validator = Utf8Validator()
+    assert validator.validate(b"ab\xe2\x82") == (True, False, 4, 4)
+    assert validator.validate(b"\xac") == (True, True, 1, 5)
+
+    validator.reset()
+    valid, end_on_code_point, i, total = validator.validate(b"ab\xff")
+    assert not valid
+    assert total == 2
+
+
+def test_validator_scoped():
+    """Proxy streams use the fast validator without changing ws4py for everybody else."""
+    import ws4py.streaming
+    assert ws4py.streaming.Utf8Validator is not Utf8Validator
+    assert ProxyStream.receiver.__globals__["Utf8Validator"] is Utf8Validator
+
+    ws = ProxyClient("ws://localhost:1/api/kernels/test/channels")
+    assert isinstance(ws.stream, ProxyStream)
+    assert ws.stream.always_mask and not ws.stream.expect_masking
+    ws.sock.close()
+
+
+def feed(stream, data):
+    """Feed the stream parser the number of bytes it asks for at a time, like ProxyClient.relay_upstream()."""
+    requested = DEFAULT_READING_SIZE
+    while data:
+        chunk, data = data[:requested], data[requested:]
+        requested = stream.parser.send(chunk) or DEFAULT_READING_SIZE
+
+
+def test_stream_text_frames():
+    """Upstream text frames are validated by the proxy stream: fragmented multibyte text passes, invalid UTF-8 is refused with 1007."""
+    stream = ProxyStream(always_mask=False, expect_masking=False)
+    text = "ä€𝄞".encode("utf-8")
+    feed(stream, Frame(opcode=OPCODE_TEXT, body=text[:3], fin=0).build())
+    feed(stream, Frame(opcode=OPCODE_CONTINUATION, body=text[3:], fin=1).build())
+    assert stream.has_message
+    assert stream.message.data == text
+    assert not stream.errors
+
+    stream = ProxyStream(always_mask=False, expect_masking=False)
+    feed(stream, Frame(opcode=OPCODE_TEXT, body=b"ok\xff\xfe", fin=1).build())
+    assert stream.errors[0].code == 1007
+
+
+def test_stream_binary_frame():
+    """Binary frames are not UTF-8 validated."""
+    stream = ProxyStream(always_mask=False, expect_masking=False)
+    payload = b"\x00\x00\x00\x01\xff\xfe"
+    feed(stream, Frame(opcode=OPCODE_BINARY, body=payload, fin=1).build())
+    assert stream.has_message
+    assert stream.message.is_binary
+    assert stream.message.data == payload
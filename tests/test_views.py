@@ -0,0 +1,64 @@
+"""View function tests which do not need a running Notebook."""
+# Standard Library
+import os
+
+# Pyramid
+from pyramid import testing
+
+# Third Party
+import pytest
+
+# Pyramid Notebook
+from pyramid_notebook.notebookmanager import NotebookManager
+from pyramid_notebook.server import comm
+from pyramid_notebook.views import notebook_status
+
+
+@pytest.fixture()
+def status_request(request, tmpdir):
+    """Request with notebook routes configured."""
+    settings = {"pyramid_notebook.notebook_folder": str(tmpdir), "pyramid_notebook.kill_timeout": "60"}
+    config = testing.setUp(settings=settings)
+    config.add_route("notebook_status", "/notebook/status")
+    config.add_route("notebook_proxy", "/notebook/*remainder")
+
+    request.addfinalizer(testing.tearDown)
+    return testing.DummyRequest()
+
+
+def test_status_starting(status_request):
+    resp = notebook_status(status_request, "user")
+    assert resp.json_body == {"status": "starting"}
+
+
+def test_shared_manager(status_request):
+    """All requests use the same manager."""
+    from pyramid_notebook.views import get_notebook_manager
+    manager = get_notebook_manager(status_request)
+    assert manager.kill_timeout == 60
+    assert get_notebook_manager(testing.DummyRequest()) is manager
+
+
+def test_status_failed(status_request, tmpdir):
+    m = NotebookManager(str(tmpdir))
+    with open(m.get_launch_error_file("user"), "wt") as f:
+        f.write("Boom")
+
+    resp = notebook_status(status_request, "user")
+    assert resp.json_body == {"status": "failed", "message": "Boom"}
+
+
+def test_status_ready(status_request, tmpdir, api_server):
+    m = NotebookManager(str(tmpdir))
+    context = {"context_hash": 1, "pid": os.getpid(), "http_port": api_server.server_address[1], "notebook_name": "default-1.ipynb"}
+    comm.set_context(m.get_pid("user"), context)
+
+    status_request.params["context_hash"] = "1"
+    resp = notebook_status(status_request, "user")
+    assert resp.json_body["status"] == "ready"
+    assert resp.json_body["url"].endswith("/notebook/notebooks/default-1.ipynb")
+
+    # Running notebook has a different context than the one being launched
+    status_request.params["context_hash"] = "2"
+    resp = notebook_status(status_request, "user")
+    assert resp.json_body["status"] == "starting"